@@ -1,5 +1,7 @@
 import argparse
+import atexit
 import os
+import sys
 
 
 def positive_int_type(value):
@@ -12,16 +14,13 @@ def positive_int_type(value):
     return i
 
 
-def bound_positive_int_type(value, max_value):
-    """Raise an error if the value is not a positive integer and less than the max_value. Return it otherwise."""
+def non_negative_int_type(value):
+    """Raise an error if the value is not an integer of at least 0. Return it otherwise."""
     try:
         i = int(value)
-        assert i > 0
+        assert i >= 0
     except (ValueError, AssertionError):
-        raise argparse.ArgumentTypeError(f'{value} is not a positive int.')
-
-    if i > max_value:
-        raise argparse.ArgumentTypeError(f'{value} is greater than than {max_value}.')
+        raise argparse.ArgumentTypeError(f'{value} is not a non-negative int.')
     return i
 
 
@@ -43,7 +42,10 @@ def is_default_args(namespace):
     """Return true if all of the arguments in the namespace are the default value. Return false otherwise."""
     return (namespace.content is None) and (namespace.content_filename is None) and (namespace.filename is None) and \
            (not namespace.print) and (namespace.num_samples == 1) and (namespace.num_words == 1023) and \
-           (namespace.output_filename is None) and (namespace.title is None) and (namespace.title_filename is None)
+           (namespace.output_filename is None) and (namespace.title is None) and \
+           (namespace.title_filename is None) and (not namespace.serve) and (namespace.manifest is None) and \
+           (namespace.jsonl_output_filename is None) and (namespace.num_workers is None) and \
+           (not namespace.tune) and (namespace.queue is None) and (namespace.best_of is None)
 
 
 def create_parser():
@@ -61,6 +63,31 @@ def create_parser():
                     OR  python ArticleGenerator.py -title 'Example title' -content 'Example content' -print
                         - Generate 1 article with the title being 'Example title' and the content being 
                         'Example content' and print it to the console.
+                    (4) python ArticleGenerator.py -m titles.csv -j articles.jsonl -n 2
+                        - Generate 2 articles for each row of 'titles.csv' and append them to 'articles.jsonl' as 
+                        they are generated. Running it again after it stopped resumes where it stopped.
+                    (5) python ArticleGenerator.py --serve --port 8000
+                        - Keep the model loaded and serve requests over HTTP on port 8000. POST a JSON object with 
+                        a 'title' and optionally 'initial_content', 'num_samples', 'num_words' and the 'run_name' 
+                        of another model in the checkpoint folder to '/generate', and GET '/stats' for the queue 
+                        depth and latency.
+                    (6) python ArticleGenerator.py --export --precision int8
+                        - Export the model with int8 weights to the export folder, so that later runs with 
+                        '--precision int8' load it from there instead of the checkpoint.
+                    (7) python ArticleGenerator.py -T 'Example title' -p --backend numpy
+                        - Generate 1 article from the exported model with NumPy instead of TensorFlow.
+                    (8) python ArticleGenerator.py -m titles.csv --queue /mnt/shared/job -n 2
+                    AND python ArticleGenerator.py --queue /mnt/shared/job
+                    AND python ArticleGenerator.py --queue /mnt/shared/job -j articles.jsonl
+                        - Split 'titles.csv' into batches in a shared directory, generate them on as many hosts as
+                        run the second command, then write every article to 'articles.jsonl' once all are done.
+                    (9) python ArticleGenerator.py --tune
+                        - Find the fastest number of workers, threads and batch size on this host. Later runs use 
+                        them, tuned for throughput or for latency as chosen with '--objective'. The tuned number of
+                        workers is only used for a manifest or a queue, or with '--objective throughput'.
+                    (10) python ArticleGenerator.py -T 'Example title' -n 2 --best_of 8 -p
+                        - Generate 8 articles and print the 2 the model finds most likely, scored as they are 
+                        generated. Articles that fall far behind the others are stopped early.
         """
     parser = argparse.ArgumentParser(usage_str)
     parser.add_argument('-f', '--filename', dest='filename', type=existing_filename_type,
@@ -72,15 +99,39 @@ def create_parser():
                         help='Write the generated sample to a new file with the filename specified by OUTPUT_FILENAME. '
                              'The file must not already exist. The sample number is appended to the filename before '
                              'the extension if multiple samples are to be generated.')
+    parser.add_argument('--output_format', dest='output_format', default='files',
+                        choices=['files', 'jsonl', 'gzip', 'zstd'],
+                        help='How the samples are written to OUTPUT_FILENAME as they are generated. \'files\' writes '
+                             'each sample to its own file, \'jsonl\' appends them all to a single JSONL file, and '
+                             '\'gzip\' and \'zstd\' write compressed JSONL shards of up to 10000 samples, numbered '
+                             'before the extension. \'zstd\' needs the zstandard package. Default: files')
     parser.add_argument('-p', '--print', dest='print', action='store_true',
                         help='Print the generated sample(s) to console.')
     parser.add_argument('-n', '--num_samples', dest='num_samples', default=1, type=positive_int_type,
                         help='Generate a number of samples equal to NUM_SAMPLES. It must be a positive integer. '
                              'Default: 1')
-    parser.add_argument('-w', '--num_words', dest='num_words', default=1023,
-                        type=lambda i: bound_positive_int_type(i, 1023),
+    parser.add_argument('--best_of', dest='best_of', default=None, type=positive_int_type,
+                        help='Generate a number of samples equal to BEST_OF and keep the NUM_SAMPLES of them the model '
+                             'finds most likely, scored as they are generated. Samples falling far behind are stopped '
+                             'early. It must be an integer that is not less than NUM_SAMPLES.')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=1023, type=positive_int_type,
                         help='Generate samples with a number of words that is not greater than NUM_WORDS. It must be a '
-                             'positive integer that does not exceed 1023. Default: 1023')
+                             'positive integer that does not exceed 1023, unless \'--sliding_window\' is specified. '
+                             'Default: 1023')
+    parser.add_argument('--sliding_window', dest='sliding_window', action='store_true',
+                        help='Allow samples longer than the 1023 words the model can see at once. Once a sample '
+                             'reaches that length, its oldest words after the prompt are forgotten to make room for '
+                             'new ones, so the text may drift from the title further into the sample.')
+    parser.add_argument('--seed', dest='seed', type=non_negative_int_type,
+                        help='Seed the random numbers the articles are sampled with by SEED, so that the same options '
+                             'generate the same articles again.')
+    parser.add_argument('--cache_directory', dest='cache_directory',
+                        help='Store the articles generated with \'--seed\' in the directory specified by '
+                             'CACHE_DIRECTORY, and return them from there when the same article is requested again '
+                             'with the same options instead of generating it.')
+    parser.add_argument('--cache_megabytes', dest='cache_megabytes', default=256, type=positive_int_type,
+                        help='The number of megabytes the articles in \'--cache_directory\' may take up. The least '
+                             'recently used articles are removed to make room. Default: 256')
     parser.add_argument('-t', '--title_filename', dest='title_filename', type=existing_filename_type,
                         help='Use the text in the first line of the file specified by TITLE_FILENAME as the title. '
                              'This will be ignored if a filename for \'--filename\' is specified.')
@@ -93,35 +144,213 @@ def create_parser():
     parser.add_argument('-C', '--content', dest='content',
                         help='Use the text specified by CONTENT as the initial content. This will be ignored if '
                              'no title for \'--title\' is specified.')
+    parser.add_argument('-W', '--num_workers', dest='num_workers', default=None, type=positive_int_type,
+                        help='Generate with a number of worker processes equal to NUM_WORKERS, each with its own copy '
+                             'of the model and an equal share of the cores. It must be a positive integer. Default: '
+                             'the number tuned for this host with \'--tune\' for a manifest, a queue or '
+                             '\'--objective throughput\', or 1 otherwise')
+    parser.add_argument('--tune', dest='tune', action='store_true',
+                        help='Measure a short generation workload with each number of workers, TensorFlow threads and '
+                             'batch size on this host, save the best for throughput and for latency to the profile '
+                             'file that later runs use, and exit. This loads the model many times.')
+    parser.add_argument('--objective', dest='objective', default=None, choices=['throughput', 'latency'],
+                        help='Which of the settings tuned with \'--tune\' to use: \'throughput\' for the most '
+                             'tokens per second over many samples, or \'latency\' for the fastest single sample. '
+                             'The tuned number of workers is used for a manifest or a queue, or if \'throughput\' '
+                             'is given. Default: throughput')
+    parser.add_argument('--precision', dest='precision', default='float32', choices=['float32', 'int8'],
+                        help='The precision the weights of the model are held in. \'int8\' uses about a quarter of '
+                             'the memory for the weights at a small cost in quality, so more workers fit on a host. '
+                             'Default: float32')
+    parser.add_argument('--backend', dest='backend', default='tensorflow', choices=['tensorflow', 'numpy'],
+                        help='What runs the model. \'numpy\' runs the export of the model made with \'--export\' '
+                             'without TensorFlow, which starts faster and uses less memory. Default: tensorflow')
+    parser.add_argument('--draft_layers', dest='draft_layers', default=0, type=non_negative_int_type,
+                        help='Decode speculatively, with a draft model made of the first DRAFT_LAYERS layers of the '
+                             'model proposing tokens that the whole model checks several at a time. The samples '
+                             'follow the same distribution. It must be less than the number of layers of the model. '
+                             '0 disables it. Default: 0')
+    parser.add_argument('--draft_tokens', dest='draft_tokens', default=4, type=positive_int_type,
+                        help='The number of tokens the draft model proposes at a time when decoding speculatively. '
+                             'Default: 4')
+    parser.add_argument('--export', dest='export', action='store_true',
+                        help='Export the model at the precision specified by \'--precision\' to the export folder and '
+                             'exit. Later runs load the export instead of the checkpoint, which starts faster and lets '
+                             'worker processes share the memory of the weights.')
+    parser.add_argument('-m', '--manifest', dest='manifest', type=existing_filename_type,
+                        help='Generate articles for every row of the manifest specified by MANIFEST. A \'.csv\' '
+                             'manifest must have a header row with a \'title\' column and optionally an '
+                             '\'initial_content\' column. Any other manifest must have a JSON object with a \'title\' '
+                             'and optionally an \'initial_content\' on each line.')
+    parser.add_argument('-j', '--jsonl_output_filename', dest='jsonl_output_filename',
+                        help='Append the articles generated for each row of the manifest to the file specified by '
+                             'JSONL_OUTPUT_FILENAME as a JSON object per line. Progress is saved alongside it so that '
+                             'running the same command again resumes where it stopped.')
+    parser.add_argument('--queue', dest='queue',
+                        help='Use a work queue in the directory specified by QUEUE, shared by every host working on '
+                             'it, such as an NFS mount. With \'--manifest\', split the manifest into batches in the '
+                             'queue. With \'--jsonl_output_filename\', write the results of a finished queue to the '
+                             'JSONL file. Otherwise claim and generate batches alongside the other hosts until every '
+                             'batch is done.')
+    parser.add_argument('--lease_seconds', dest='lease_seconds', default=300, type=positive_int_type,
+                        help='The number of seconds a batch claimed from the queue stays claimed without being '
+                             'renewed. The batches of a host that stops are claimed by another host after this long. '
+                             'Default: 300')
+    parser.add_argument('--metrics_log', dest='metrics_log',
+                        help='Record the time spent in each stage of generation and append each timing to the file '
+                             'specified by METRICS_LOG as a JSON object per line.')
+    parser.add_argument('--metrics_dump', dest='metrics_dump',
+                        help='Record the time spent in each stage of generation, tokens per second and decode step '
+                             'latency, and write them to the file specified by METRICS_DUMP in the Prometheus text '
+                             'format before exiting.')
+    parser.add_argument('--serve', dest='serve', action='store_true',
+                        help='Keep the model loaded and serve generation requests over HTTP. All other options except '
+                             'the server options are ignored.')
+    parser.add_argument('--host', dest='host', default='127.0.0.1',
+                        help='The address the server listens on. Default: 127.0.0.1')
+    parser.add_argument('--port', dest='port', default=8000, type=positive_int_type,
+                        help='The port the server listens on. Default: 8000')
+    parser.add_argument('--batch_window', dest='batch_window', default=50, type=positive_int_type,
+                        help='The number of milliseconds the server waits for other requests to batch with a request. '
+                             'Default: 50')
+    parser.add_argument('--preload', dest='preload', nargs='+', default=[], metavar='RUN_NAME',
+                        help='Load the models in the checkpoint folder named by RUN_NAME in the background when the '
+                             'server starts, so that requests naming them in \'run_name\' do not wait for them to '
+                             'load. Other models are loaded when they are first requested.')
+    parser.add_argument('--memory_budget', dest='memory_budget', default=4096, type=positive_int_type,
+                        help='The number of megabytes the weights of the models loaded by the server for requests '
+                             'naming a \'run_name\' may take up together. The least recently used models are '
+                             'unloaded to make room. Default: 4096')
+    parser.add_argument('--stub_model', dest='stub_model', action='store_true',
+                        help='Serve or generate the queue with placeholder articles from a stub instead of the model, '
+                             'for testing the server or a queue locally without TensorFlow or the checkpoint.')
     return parser
 
 
+def serve(namespace):
+    """Serve generation requests over HTTP with the model or stub specified by the arguments until interrupted."""
+    from server import GenerationServer, StubModel
+
+    registry = None
+    if namespace.stub_model:
+        model = StubModel()
+    else:
+        from gpt2handler import Gpt2Handler
+        from model_registry import REGISTRY_CONFIG, ModelRegistry
+        model = Gpt2Handler.get_instance()
+        REGISTRY_CONFIG['memory_budget_megabytes'] = namespace.memory_budget
+        REGISTRY_CONFIG['preload'] = namespace.preload
+        registry = ModelRegistry.get_instance()
+    GenerationServer(model, namespace.host, namespace.port, namespace.batch_window / 1000,
+                     registry=registry).serve_forever()
+
+
+def manage_queue(namespace):
+    """Split the manifest into batches in the work queue, or write the results of the finished queue to the JSONL output
+    file, as specified by the arguments."""
+    import work_queue
+
+    if namespace.manifest:
+        num_batches = work_queue.create_queue(namespace.queue, namespace.manifest, namespace.num_samples,
+                                              namespace.num_words)
+        print(f'Added {num_batches} batches to the queue in \'{namespace.queue}\'.')
+    else:
+        num_rows = work_queue.collect_results(namespace.queue, namespace.jsonl_output_filename)
+        print(f'Wrote {num_rows} rows to \'{namespace.jsonl_output_filename}\'.')
+
+
 def parse_arguments():
     """Create a parser and use it to parse the arguments given by Python, then return the parsed arguments."""
     parser = create_parser()
     parsed_args = parser.parse_args()
+    if parsed_args.num_words > 1023 and not parsed_args.sliding_window:
+        parser.error(f'argument -w/--num_words: {parsed_args.num_words} is greater than than 1023. '
+                     f'Specify \'--sliding_window\' to generate longer samples.')
+    if parsed_args.best_of is not None and parsed_args.best_of < parsed_args.num_samples:
+        parser.error(f'argument --best_of: {parsed_args.best_of} is less than the {parsed_args.num_samples} samples '
+                     f'to keep.')
     return parsed_args
 
 
 if __name__ == '__main__':
     args = parse_arguments()
+    import gpt2handler
+    from metrics import Metrics
+    from output_sinks import OUTPUT_CONFIG
+    from tuning import TUNING_CONFIG
+
+    if args.objective:
+        TUNING_CONFIG['objective'] = args.objective
+    gpt2handler.MODEL_CONFIG['backend'] = 'tensorflow' if args.export else args.backend  # Exporting needs TensorFlow
+    gpt2handler.MODEL_CONFIG['precision'] = args.precision
+    gpt2handler.MODEL_CONFIG['draft_layers'] = args.draft_layers
+    gpt2handler.MODEL_CONFIG['draft_tokens'] = args.draft_tokens
+    gpt2handler.MODEL_CONFIG['sliding_window'] = args.sliding_window
+    if args.seed is not None:
+        gpt2handler.DEFAULT_CONFIG['seed'] = str(args.seed)
+    gpt2handler.CACHE_CONFIG['directory'] = args.cache_directory
+    gpt2handler.CACHE_CONFIG['max_megabytes'] = args.cache_megabytes
+    OUTPUT_CONFIG['format'] = args.output_format
+    if args.metrics_log:
+        Metrics.log_to_file(args.metrics_log)
+    if args.metrics_dump:
+        Metrics.enable()
+        atexit.register(Metrics.get_instance().write_prometheus, args.metrics_dump)
+    if args.serve:
+        serve(args)
+        sys.exit()
+    if args.tune:
+        from tuning import tune
+        profile = tune()
+        print(f'Saved the settings for throughput {profile["throughput"]} and for latency {profile["latency"]} to '
+              f'\'{TUNING_CONFIG["profile_filename"]}\'.')
+        sys.exit()
+    if args.queue and (args.manifest or args.jsonl_output_filename):
+        manage_queue(args)
+        sys.exit()
+    if args.export:
+        from gpt2handler import Gpt2Handler
+        print(f'Exported the model to \'{Gpt2Handler.get_instance().export_model()}\'.')
+        sys.exit()
+
     from generator import Generator
 
     gen = Generator.get_instance()
+    num_workers = args.num_workers
+    if num_workers is None and (args.queue or args.manifest or args.objective == 'throughput'):
+        # Only bulk runs and runs that ask for throughput use the tuned workers. The gui and a single title generate in
+        # this process, which streams the text and holds only one copy of the model.
+        num_workers = gen.get_tuned_num_workers()
+    if num_workers and num_workers > 1:
+        gen.start_worker_pool(num_workers)
 
     if is_default_args(args):
         gen.launch_gui()
+    elif args.queue:
+        stub_model = None
+        if args.stub_model:
+            from server import StubModel
+            stub_model = StubModel()
+        print(f'Generated {gen.generate_from_queue(args.queue, args.lease_seconds, stub_model)} batches of the queue.')
+    elif args.manifest:
+        if not args.jsonl_output_filename:
+            raise Exception('Output for the manifest has not been set to a JSONL output file.\n'
+                            'Use the -h argument for help.')
+        gen.generate_from_manifest(args.manifest, args.jsonl_output_filename, args.num_samples, args.num_words,
+                                   args.best_of)
     elif not args.output_filename and not args.print:
         raise Exception('Output has not been set to either console or an output file.\nUse the -h argument for help.')
     elif args.output_filename and (args.output_filename in [args.filename, args.title_filename, args.content_filename]):
         raise Exception('Output filename cannot be the same as an input filename.\nUse the -h argument for help.')
     elif args.filename:
-        gen.generate_from_single_file(args.filename, args.num_samples, args.print, args.output_filename, args.num_words)
+        gen.generate_from_single_file(args.filename, args.num_samples, args.print, args.output_filename, args.num_words,
+                                      args.best_of)
     elif args.title_filename:
         gen.generate_from_files(args.title_filename, args.content_filename, args.num_samples, args.print,
-                                args.output_filename, args.num_words)
+                                args.output_filename, args.num_words, args.best_of)
     elif args.title:
-        gen.generate(args.title, args.content, args.num_samples, args.print, args.output_filename, args.num_words)
+        gen.generate(args.title, args.content, args.num_samples, args.print, args.output_filename, args.num_words,
+                     args.best_of)
     else:
         raise Exception('Input filename, input title filename, or input title have been set.\n'
                         'Use the -h argument for help.')
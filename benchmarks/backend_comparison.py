@@ -0,0 +1,121 @@
+"""Compare the TensorFlow and NumPy backends on the time to load the model, the memory of the process and the tokens
+decoded per second, and check that the NumPy backend gives the same log probabilities as TensorFlow.
+
+The model is exported at the precision given first if it has not been exported yet, since the NumPy backend loads the
+export. Each backend runs in a new process so that nothing is already imported or loaded. Run from the root of the
+repository so the checkpoint folder can be found:
+    python benchmarks/backend_comparison.py --precision float32
+Pass --tiny to use the tiny model with random weights from tiny_model.py instead.
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cold_start import get_rss_megabytes
+
+TEXT = 'The announcement came late on Tuesday after hours of talks between the two sides. ' * 8
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark the TensorFlow and NumPy backends.')
+    parser.add_argument('-P', '--precision', dest='precision', default='float32', choices=['float32', 'int8'],
+                        help='The precision the model is loaded at. Default: float32')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=256, type=int,
+                        help='Number of words to generate per sample. Default: 256')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=1, type=int,
+                        help='Number of samples to generate at a time. Default: 1')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=3, type=int,
+                        help='Number of times each backend is measured. Default: 3')
+    parser.add_argument('--tiny', dest='tiny', action='store_true',
+                        help='Use the tiny model with random weights instead of the fine-tuned model')
+    return parser
+
+
+def use_model(precision, tiny_directory):
+    """Make the model at a precision the one Gpt2Handler loads, using the tiny model if tiny_directory is given."""
+    import gpt2handler
+
+    if tiny_directory:
+        from tiny_model import use_tiny_model
+        use_tiny_model(tiny_directory)
+    gpt2handler.MODEL_CONFIG['precision'] = precision
+
+
+def compare_logits(precision, tiny_directory):
+    """Export the model at a precision if it has not been exported yet, then return the largest difference between the
+    log probabilities TensorFlow and NumPy give the tokens of a text."""
+    import numpy as np
+
+    from export import is_exported
+    from gpt2handler import Gpt2Handler
+    from numpy_sampler import NumpySampler
+
+    use_model(precision, tiny_directory)
+    handler = Gpt2Handler.get_instance()
+    if not is_exported(handler.get_export_path()):
+        handler.export_model()
+
+    context_tokens = [handler.enc.encode(TEXT)[:handler.hparams.n_ctx]]
+    numpy_sampler = NumpySampler.load(handler.hparams, handler.get_export_path())
+    return float(np.max(np.abs(handler.sampler.score(context_tokens) - numpy_sampler.score(context_tokens))))
+
+
+def measure(backend, precision, num_words, num_samples, tiny_directory):
+    """Load the model with a backend and generate with it. Return the seconds it took to load, the resident memory
+    after loading and the peak memory in megabytes, and the tokens decoded per second."""
+    start = time.perf_counter()
+    import gpt2handler
+    from gpt2handler import Gpt2Handler
+    from metrics import Metrics
+
+    use_model(precision, tiny_directory)
+    gpt2handler.MODEL_CONFIG['backend'] = backend
+    gpt2handler.DEFAULT_CONFIG['seed'] = '0'
+    Metrics.enable()
+    handler = Gpt2Handler.get_instance()
+    seconds = time.perf_counter() - start
+    rss_megabytes = get_rss_megabytes()
+
+    start_tokens = Metrics.get_instance().get_stats()['decode']['tokens']
+    start = time.perf_counter()
+    handler.generate('Example title', num_samples=num_samples, num_words=num_words)
+    tokens_per_second = (Metrics.get_instance().get_stats()['decode']['tokens'] - start_tokens) / (
+        time.perf_counter() - start)
+    peak_megabytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kilobytes on Linux
+    return seconds, rss_megabytes, peak_megabytes, tokens_per_second
+
+
+def main():
+    """Print the median load time, memory and tokens per second of each backend, and the largest difference between
+    their log probabilities."""
+    args = create_parser().parse_args()
+    tiny_directory = tempfile.mkdtemp() if args.tiny else None
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        difference = pool.apply(compare_logits, (args.precision, tiny_directory))
+
+    print(f'{"backend":>10} {"load s":>7} {"RSS MB":>8} {"peak MB":>8} {"tokens/s":>9}')
+    for backend in ['tensorflow', 'numpy']:
+        results = []
+        for _ in range(args.repeats):
+            with context.Pool(1) as pool:
+                results.append(pool.apply(measure, (backend, args.precision, args.num_words, args.num_samples,
+                                                    tiny_directory)))
+        seconds, rss_megabytes, peak_megabytes, tokens_per_second = zip(*results)
+        rss = f'{statistics.median(rss_megabytes):>8.0f}' if None not in rss_megabytes else f'{"n/a":>8}'
+        print(f'{backend:>10} {statistics.median(seconds):>7.2f} {rss} {statistics.median(peak_megabytes):>8.0f} '
+              f'{statistics.median(tokens_per_second):>9.1f}')
+    print(f'Largest difference in log probability between the backends: {difference:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Measure the number of samples per second Gpt2Handler.generate produces at batch sizes from 1 to 32.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/batch_throughput.py
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32]
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark batched sample generation.')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=256, type=int,
+                        help='Number of words to generate per sample. Default: 256')
+    parser.add_argument('-T', '--title', dest='title', default='Example title',
+                        help='Title to generate samples for. Default: \'Example title\'')
+    return parser
+
+
+def main():
+    """Generate batch_size samples in a single batch for each batch size and print the throughput."""
+    args = create_parser().parse_args()
+    from gpt2handler import Gpt2Handler
+
+    handler = Gpt2Handler.get_instance()
+    handler.generate(args.title, num_samples=1, num_words=1)  # Warm up the session
+
+    print(f'{"batch size":>10} {"seconds":>10} {"samples/sec":>12}')
+    for batch_size in BATCH_SIZES:
+        start = time.perf_counter()
+        handler.generate(args.title, num_samples=batch_size, num_words=args.num_words, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f'{batch_size:>10} {elapsed:>10.2f} {batch_size / elapsed:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compare picking the best of several samples by scoring them in a second pass of the model, as was needed before,
+against scoring them as they are sampled, with and without pruning the samples that fall behind.
+
+Each way reports the seconds taken, the tokens decoded and the mean log probability of the samples kept. The log
+probabilities accumulated while sampling are checked against a second pass over the same tokens. Run from the root of
+the repository so the checkpoint folder can be found:
+    python benchmarks/best_of.py --best_of 8 -n 2
+Pass --tiny to use the tiny model with random weights from tiny_model.py instead, which only checks that it runs.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TITLE = 'Council approves plan for new bridge'
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark best-of-N generation.')
+    parser.add_argument('-b', '--best_of', dest='best_of', default=8, type=int,
+                        help='Number of samples generated to pick the best from. Default: 8')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=2, type=int,
+                        help='Number of samples kept. Default: 2')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=256, type=int,
+                        help='Number of words to generate per sample. Default: 256')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=3, type=int,
+                        help='Number of times each way is measured. Default: 3')
+    parser.add_argument('--tiny', dest='tiny', action='store_true',
+                        help='Use the tiny model with random weights instead of the fine-tuned model')
+    return parser
+
+
+def rescore(handler, title, samples):
+    """Score samples generated without scores in a second pass of the model, the way it was done before, and return
+    the (sample, mean log probability) of each."""
+    num_prompt_tokens = len(handler.encode_prompt(title, ''))
+    scored = []
+    for sample, metadata in samples:
+        context_tokens = handler.enc.encode(sample)[:handler.hparams.n_ctx]
+        log_probs = handler.sampler.score([context_tokens])[0][num_prompt_tokens - 1:]
+        scored.append((sample, float(log_probs.mean()) if len(log_probs) else None))
+    return scored
+
+
+def check_scores(handler, num_samples, num_words):
+    """Return the largest difference between the log probabilities accumulated while sampling num_samples samples and
+    those a second pass of the model gives the same tokens."""
+    import numpy as np
+
+    from gpt2handler import DECODE_CHUNK_SIZE, DEFAULT_CONFIG
+
+    prefix, context_tokens, length = handler.create_prompt(TITLE, '', num_words)
+    log_probs = {}
+    difference = 0.0
+    for index, tokens, finished in handler.sample_batches([context_tokens] * num_samples, [length] * num_samples,
+                                                          range(num_samples), None,
+                                                          handler.parse_generate_arguments(DEFAULT_CONFIG),
+                                                          chunk_size=DECODE_CHUNK_SIZE, log_probs=log_probs):
+        if finished:
+            second_pass = handler.sampler.score([list(context_tokens) + list(tokens)])[0][len(context_tokens) - 1:]
+            difference = max(difference, float(np.max(np.abs(np.array(log_probs[index]) - second_pass))))
+    return difference
+
+
+def main():
+    """Print the median seconds, tokens decoded and mean log probability of the samples kept for each way, and the
+    largest difference between the in-pass scores and those of a second pass."""
+    args = create_parser().parse_args()
+    import gpt2handler
+    from gpt2handler import BEST_OF_CONFIG, Gpt2Handler
+    from metrics import Metrics
+
+    if args.tiny:
+        from tiny_model import use_tiny_model
+        use_tiny_model(tempfile.mkdtemp())
+    gpt2handler.DEFAULT_CONFIG['seed'] = '0'
+    gpt2handler.DEFAULT_CONFIG['include_prefix'] = 'True'
+    Metrics.enable()
+    handler = Gpt2Handler.get_instance()
+    handler.generate(TITLE, num_words=1)  # Warm up the session
+    prompts = [(TITLE, '', args.best_of, args.num_words)]
+
+    def two_pass():
+        samples = handler.generate_many(prompts)[0]
+        scored = sorted(rescore(handler, TITLE, samples), key=lambda pair: pair[1] or float('-inf'), reverse=True)
+        return [mean_log_prob for sample, mean_log_prob in scored[:args.num_samples]]
+
+    def in_pass():
+        samples = handler.generate_many(prompts, score=True)[0]
+        return [metadata['mean_log_prob'] for sample, metadata in handler.rank_samples(samples)[:args.num_samples]]
+
+    def pruned():
+        samples = handler.generate_many(prompts, num_best=args.num_samples)[0]
+        return [metadata['mean_log_prob'] for sample, metadata in samples]
+
+    prune_margin = BEST_OF_CONFIG['prune_margin']
+    print(f'{"way":>10} {"seconds":>8} {"tokens":>7} {"kept mean log prob":>19}')
+    for name, generate in [('two pass', two_pass), ('in pass', in_pass), ('pruned', pruned)]:
+        BEST_OF_CONFIG['prune_margin'] = prune_margin if name == 'pruned' else None
+        seconds, tokens, means = [], [], []
+        for _ in range(args.repeats):
+            start_tokens = Metrics.get_instance().get_stats()['decode']['tokens']
+            start = time.perf_counter()
+            kept = generate()
+            seconds.append(time.perf_counter() - start)
+            tokens.append(Metrics.get_instance().get_stats()['decode']['tokens'] - start_tokens)
+            means.append(statistics.mean(mean for mean in kept if mean is not None))
+        print(f'{name:>10} {statistics.median(seconds):>8.2f} {statistics.median(tokens):>7.0f} '
+              f'{statistics.median(means):>19.3f}')
+    BEST_OF_CONFIG['prune_margin'] = prune_margin
+
+    difference = check_scores(handler, args.best_of, args.num_words)
+    print(f'Largest difference between the log probabilities of a token in pass and in a second pass: {difference:.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compare the load time and memory of a process loading the model from the checkpoint and from an export.
+
+The model is exported at the precision given first if it has not been exported yet. Each load runs in a new process so
+that nothing is already imported or loaded. Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/cold_start.py --precision float32
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+NO_EXPORT_DIRECTORY = os.devnull  # An export directory that never holds an export, to force loading the checkpoint
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark loading the model from the checkpoint and from an export.')
+    parser.add_argument('-P', '--precision', dest='precision', default='float32', choices=['float32', 'int8'],
+                        help='The precision the model is loaded at. Default: float32')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=3, type=int,
+                        help='Number of times each way of loading is measured. Default: 3')
+    return parser
+
+
+def get_rss_megabytes():
+    """Return the resident memory of this process in megabytes, or None if it cannot be determined."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def export_if_missing(precision):
+    """Export the model at the precision if it has not been exported yet."""
+    import gpt2handler
+    from export import is_exported
+    from gpt2handler import Gpt2Handler
+
+    gpt2handler.MODEL_CONFIG['precision'] = precision
+    handler = Gpt2Handler.get_instance()
+    if not is_exported(handler.get_export_path()):
+        handler.export_model()
+
+
+def measure(precision, export_directory):
+    """Load the model and return the number of seconds it took, the resident memory after loading it and the peak
+    memory, both in megabytes."""
+    start = time.perf_counter()
+    import gpt2handler
+    from gpt2handler import Gpt2Handler
+
+    gpt2handler.MODEL_CONFIG['precision'] = precision
+    gpt2handler.MODEL_CONFIG['export_directory'] = export_directory
+    Gpt2Handler.get_instance()
+    seconds = time.perf_counter() - start
+    peak_megabytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kilobytes on Linux
+    return seconds, get_rss_megabytes(), peak_megabytes
+
+
+def main():
+    """Print the median load time and memory of loading the model from the checkpoint and from the export."""
+    args = create_parser().parse_args()
+    import gpt2handler
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        pool.apply(export_if_missing, (args.precision,))
+
+    print(f'{"load from":>10} {"median s":>9} {"RSS MB":>8} {"peak MB":>8}')
+    for name, export_directory in [('checkpoint', NO_EXPORT_DIRECTORY),
+                                   ('export', gpt2handler.MODEL_CONFIG['export_directory'])]:
+        results = []
+        for _ in range(args.repeats):
+            with context.Pool(1) as pool:
+                results.append(pool.apply(measure, (args.precision, export_directory)))
+        seconds, rss_megabytes, peak_megabytes = zip(*results)
+        rss = f'{statistics.median(rss_megabytes):>8.0f}' if None not in rss_megabytes else f'{"n/a":>8}'
+        print(f'{name:>10} {statistics.median(seconds):>9.2f} {rss} {statistics.median(peak_megabytes):>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
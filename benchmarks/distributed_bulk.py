@@ -0,0 +1,91 @@
+"""Measure the rows per second of a work queue generated by several worker processes sharing a directory, as hosts
+sharing a network filesystem would, and check that every row of the manifest is written exactly once after one of the
+workers is killed partway through.
+
+The workers generate with StubModel, so the model is not needed and the time is spent in the queue. The queue is
+created in a temporary directory, unless another is given, which can be on a network filesystem:
+    python benchmarks/distributed_bulk.py -r 2000 -W 4
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark a work queue shared by several workers.')
+    parser.add_argument('-r', '--rows', dest='rows', default=2000, type=int,
+                        help='Number of rows in the manifest. Default: 2000')
+    parser.add_argument('-W', '--num_workers', dest='num_workers', default=4, type=int,
+                        help='Number of worker processes. Default: 4')
+    parser.add_argument('-b', '--rows_per_batch', dest='rows_per_batch', default=32, type=int,
+                        help='Number of rows in each batch of the queue. Default: 32')
+    parser.add_argument('--delay', dest='delay', default=0.05, type=float,
+                        help='Seconds the stub takes to generate each batch. Default: 0.05')
+    parser.add_argument('--lease_seconds', dest='lease_seconds', default=3, type=int,
+                        help='Seconds a batch stays leased without being renewed. Default: 3')
+    parser.add_argument('-d', '--directory', dest='directory', default=None,
+                        help='The directory the queue is created in. Default: a new temporary directory')
+    return parser
+
+
+def run_worker(queue_directory, worker_id, delay, lease_seconds):
+    """Generate batches of the queue with the stub until every batch is done."""
+    import work_queue
+    from server import StubModel
+
+    work_queue.POLL_SECONDS = 0.1  # The batches of the killed worker are claimed as soon as its leases expire
+    work_queue.QueueWorker(queue_directory, StubModel(delay), worker_id, lease_seconds).run()
+
+
+def main():
+    """Print the rows per second with and without a worker killed partway through, and whether every row was written
+    exactly once."""
+    args = create_parser().parse_args()
+    import work_queue
+
+    directory = args.directory or tempfile.mkdtemp()
+    manifest_filename = os.path.join(directory, 'manifest.csv')
+    with open(manifest_filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['title', 'initial_content'])
+        writer.writerows([f'Title {i}', ''] for i in range(args.rows))
+
+    context = multiprocessing.get_context('spawn')
+    print(f'{"run":>8} {"seconds":>8} {"rows/s":>8} {"rows":>7} {"exactly once":>13}')
+    for name in ['clean', 'killed']:
+        queue_directory = os.path.join(directory, name)
+        work_queue.create_queue(queue_directory, manifest_filename, 1, 8, args.rows_per_batch)
+        start = time.perf_counter()
+        workers = [context.Process(target=run_worker, args=(queue_directory, f'worker{i}', args.delay,
+                                                             args.lease_seconds))
+                   for i in range(args.num_workers)]
+        for worker in workers:
+            worker.start()
+        if name == 'killed':
+            # Kill a worker once it is likely to be holding a lease, without giving it a chance to give the lease up
+            while work_queue.get_queue_status(queue_directory)['done'] < args.num_workers:
+                time.sleep(0.01)
+            os.kill(workers[0].pid, signal.SIGKILL)
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        output_filename = os.path.join(directory, name + '.jsonl')
+        num_rows = work_queue.collect_results(queue_directory, output_filename)
+        with open(output_filename, 'r', encoding='utf-8') as f:
+            titles = [json.loads(line)['title'] for line in f]
+        exactly_once = titles == [f'Title {i}' for i in range(args.rows)]
+        print(f'{name:>8} {seconds:>8.2f} {num_rows / seconds:>8.0f} {num_rows:>7} {str(exactly_once):>13}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Check that consecutive generations neither grow the TensorFlow graph nor the memory or latency of the process.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/graph_reuse.py
+The exit status is non-zero if the graph grew, or the memory or latency regressed by more than the allowed tolerance.
+"""
+import argparse
+import os
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Check for graph, memory and latency growth across generations.')
+    parser.add_argument('-n', '--num_generations', dest='num_generations', default=1000, type=int,
+                        help='Number of consecutive generations to run. Default: 1000')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=16, type=int,
+                        help='Number of words to generate per sample. Default: 16')
+    parser.add_argument('--max_rss_growth_mb', dest='max_rss_growth_mb', default=64.0, type=float,
+                        help='Largest allowed growth of the peak resident set size in MB. Default: 64')
+    parser.add_argument('--max_latency_ratio', dest='max_latency_ratio', default=1.5, type=float,
+                        help='Largest allowed ratio between the median latency of the last and first 10%% of the '
+                             'generations. Default: 1.5')
+    return parser
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+
+
+def main():
+    """Run the generations and return a non-zero exit status if any of the checks failed."""
+    args = create_parser().parse_args()
+    from gpt2handler import Gpt2Handler
+
+    handler = Gpt2Handler.get_instance()
+    handler.generate('Example title', num_words=args.num_words)  # Warm up the session
+    num_operations = len(handler.sess.graph.get_operations())
+    start_rss = get_peak_rss_mb()
+
+    latencies = []
+    for i in range(args.num_generations):
+        start = time.perf_counter()
+        handler.generate(f'Example title {i}', num_words=args.num_words)
+        latencies.append(time.perf_counter() - start)
+
+    window = max(1, args.num_generations // 10)
+    first_latency = statistics.median(latencies[:window])
+    last_latency = statistics.median(latencies[-window:])
+    rss_growth = get_peak_rss_mb() - start_rss
+    operation_growth = len(handler.sess.graph.get_operations()) - num_operations
+
+    print(f'graph operations added: {operation_growth}')
+    print(f'peak RSS growth: {rss_growth:.1f} MB')
+    print(f'median latency: {first_latency * 1000:.1f} ms (first) -> {last_latency * 1000:.1f} ms (last)')
+
+    failed = False
+    if operation_growth > 0:
+        print('FAIL: the graph grew between generations.')
+        failed = True
+    if rss_growth > args.max_rss_growth_mb:
+        print(f'FAIL: the peak RSS grew by more than {args.max_rss_growth_mb} MB.')
+        failed = True
+    if last_latency > first_latency * args.max_latency_ratio:
+        print(f'FAIL: the latency grew by more than a factor of {args.max_latency_ratio}.')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""Measure the decode time per token of a sample generated well beyond the context of the model with a sliding window,
+in segments of the sample, to check that it stays about the same as the sample grows.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/long_generation.py -w 4096
+Pass --tiny to use the tiny model with random weights from tiny_model.py instead.
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark sliding window generation.')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=4096, type=int,
+                        help='Number of words to generate. Default: 4096')
+    parser.add_argument('-s', '--segment', dest='segment', default=256, type=int,
+                        help='Number of tokens in each segment the time per token is reported for. Default: 256')
+    parser.add_argument('--tiny', dest='tiny', action='store_true',
+                        help='Use the tiny model with random weights instead of the fine-tuned model')
+    return parser
+
+
+def main():
+    """Print the milliseconds per token spent decoding each segment of a long sample."""
+    args = create_parser().parse_args()
+    import gpt2handler
+    from gpt2handler import Gpt2Handler
+    from metrics import Metrics
+
+    if args.tiny:
+        from tiny_model import use_tiny_model
+        use_tiny_model(tempfile.mkdtemp())
+    gpt2handler.MODEL_CONFIG['sliding_window'] = True
+    gpt2handler.DEFAULT_CONFIG['seed'] = '0'
+    gpt2handler.DEFAULT_CONFIG['truncate'] = ''  # Keep generating past the end of an article
+    Metrics.enable()
+    metrics = Metrics.get_instance()
+
+    handler = Gpt2Handler.get_instance()
+    handler.generate('Example title', num_words=1)  # Warm up the session
+    print(f'{"tokens":>13} {"ms/token":>9}')
+    segment_start = metrics.get_stats()['decode']
+    for _ in handler.generate_stream('Example title', num_words=args.num_words):
+        decode = metrics.get_stats()['decode']
+        tokens = decode['tokens'] - segment_start['tokens']
+        if tokens >= args.segment:
+            seconds = decode['seconds'] - segment_start['seconds']
+            start_token = segment_start['tokens'] - 1  # Less the warm up token
+            print(f'{f"{start_token}-{start_token + tokens}":>13} {seconds / tokens * 1000:>9.2f}')
+            segment_start = decode
+
+
+if __name__ == '__main__':
+    main()
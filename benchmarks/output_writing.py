@@ -0,0 +1,85 @@
+"""Compare the time generation is blocked, the total time taken and the number of files created writing many samples
+in each output format, against writing each sample to its own file synchronously as Generator.write_samples_to_file did
+before. With a sink, generation is only blocked while the queue of samples waiting to be written is full.
+
+The samples are made up rather than generated, so the model is not needed. They are written to a temporary directory,
+unless another is given:
+    python benchmarks/output_writing.py -n 100000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE = 'Example title\n' + 'The announcement came late on Tuesday after hours of talks. ' * 50
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark writing samples in each output format.')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=100000, type=int,
+                        help='Number of samples to write. Default: 100000')
+    parser.add_argument('-d', '--directory', dest='directory', default=None,
+                        help='The directory the samples are written to. Default: a new temporary directory')
+    return parser
+
+
+def write_synchronously(filename, num_samples):
+    """Write each sample to its own file one after another, as the samples used to be written. Return the seconds the
+    caller was blocked, which is all of it."""
+    start = time.perf_counter()
+    base, extension = os.path.splitext(filename)
+    for i in range(num_samples):
+        with open(base + str(i) + extension, 'w+', errors='surrogateescape', encoding='utf-8') as f:
+            f.write(SAMPLE)
+    return time.perf_counter() - start
+
+
+def write_to_sink(filename, num_samples, output_format):
+    """Write the samples with the sink for an output format. Return the seconds the caller was blocked queueing
+    them."""
+    from output_sinks import create_sink
+
+    with create_sink(filename, num_samples, output_format) as sink:
+        start = time.perf_counter()
+        for i in range(num_samples):
+            sink.write(i, SAMPLE)
+        return time.perf_counter() - start
+
+
+def main():
+    """Print the seconds blocked and taken, samples per second, files created and bytes written for each way of
+    writing."""
+    args = create_parser().parse_args()
+    from output_sinks import OUTPUT_FORMATS
+
+    directory = args.directory or tempfile.mkdtemp()
+    print(f'{"format":>12} {"blocked s":>9} {"total s":>8} {"samples/s":>10} {"files":>7} {"MB":>8}')
+    for name in ['synchronous'] + OUTPUT_FORMATS:
+        output_directory = os.path.join(directory, name)
+        os.makedirs(output_directory, exist_ok=True)
+        filename = os.path.join(output_directory, 'sample.txt' if name in ('synchronous', 'files') else 'samples.jsonl')
+        start = time.perf_counter()
+        try:
+            if name == 'synchronous':
+                blocked = write_synchronously(filename, args.num_samples)
+            else:
+                blocked = write_to_sink(filename, args.num_samples, name)
+        except Exception as e:  # zstd is only available with the zstandard package
+            print(f'{name:>12} {e}')
+            continue
+        seconds = time.perf_counter() - start
+
+        filenames = os.listdir(output_directory)
+        megabytes = sum(os.path.getsize(os.path.join(output_directory, f)) for f in filenames) / 1024 / 1024
+        print(f'{name:>12} {blocked:>9.2f} {seconds:>8.2f} {args.num_samples / seconds:>10.0f} {len(filenames):>7} '
+              f'{megabytes:>8.1f}')
+        shutil.rmtree(output_directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Compare the CPU time spent encoding prompts and turning samples into tuples before and after caching the prompt
+tokens and building tuples from tokens.
+
+The samples are made up from a fixed text rather than generated, so only the encoder of the model is exercised. Run from
+the root of the repository so the model folder can be found:
+    python benchmarks/post_processing.py -n 100000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TITLES = ['Election results announced', 'Stocks fall as markets react to new tariffs', 'Local team wins the cup',
+          'New species of frog discovered in the Amazon rainforest', 'Storm warning issued for the coast']
+ARTICLE = ('The announcement came late on Tuesday after hours of talks.  Officials said the decision had not been '
+           'taken lightly, and that further details would follow in the coming days. "We are confident this is the '
+           'right step," a spokesperson told reporters. Critics were quick to respond, arguing that the plan did '
+           'little to address the concerns raised earlier in the year. ') * 8
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark prompt encoding and sample post-processing.')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=100000, type=int,
+                        help='Number of samples to process. Default: 100000')
+    return parser
+
+
+def legacy_sample_to_tuple(sample, title_header, content_header):
+    """Turn a sample into a tuple the way Gpt2Handler.sample_to_tuple did before, for comparison."""
+    no_title_header = sample.split(title_header)[1]
+    no_tokens = re.sub('<\\|[^|>]*\\|>', '', no_title_header)
+    no_repeating_spaces = re.sub(' +', ' ', no_tokens)
+    return no_repeating_spaces.split(content_header)[:2]
+
+
+def create_samples(handler, num_samples):
+    """Return num_samples (title, generated tokens) pairs, with about half of the samples ending in <|endoftext|>."""
+    article_tokens = handler.enc.encode(ARTICLE)
+    end_token = handler.enc.encoder['<|endoftext|>']
+    rng = random.Random(0)
+    samples = []
+    for _ in range(num_samples):
+        start = rng.randrange(len(article_tokens) // 2)
+        tokens = article_tokens[start:start + rng.randrange(50, len(article_tokens) // 2)]
+        samples.append((rng.choice(TITLES), tokens + [end_token] if rng.random() < 0.5 else tokens))
+    return samples
+
+
+def main():
+    """Print the microseconds per sample spent on each stage before and after, and check they give the same tuples."""
+    args = create_parser().parse_args()
+    from gpt2handler import CONTENT_HEADER, TITLE_HEADER, Gpt2Handler
+
+    handler = Gpt2Handler.get_instance()
+    samples = create_samples(handler, args.num_samples)
+
+    start = time.perf_counter()
+    legacy_contexts = [handler.enc.encode(TITLE_HEADER + title + CONTENT_HEADER) for title, _ in samples]
+    legacy_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    legacy_tuples = [legacy_sample_to_tuple(handler.enc.decode(context + tokens), TITLE_HEADER, CONTENT_HEADER)
+                     for context, (_, tokens) in zip(legacy_contexts, samples)]
+    legacy_tuple = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for title, _ in samples:
+        handler.encode_prompt(title, '')
+    cached_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    tuples = [handler.tokens_to_tuple(title, '', tokens) for title, tokens in samples]
+    tokens_tuple = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(legacy_tuples, tuples))
+    print(f'{"stage":>16} {"before us":>10} {"after us":>10} {"speedup":>8}')
+    for stage, before, after in [('prompt encoding', legacy_encode, cached_encode),
+                                 ('sample to tuple', legacy_tuple, tokens_tuple),
+                                 ('total', legacy_encode + legacy_tuple, cached_encode + tokens_tuple)]:
+        before_us, after_us = before / args.num_samples * 1e6, after / args.num_samples * 1e6
+        print(f'{stage:>16} {before_us:>10.1f} {after_us:>10.1f} {before / after:>7.2f}x')
+    print(f'{mismatches} of {args.num_samples} tuples differ')
+
+
+if __name__ == '__main__':
+    main()
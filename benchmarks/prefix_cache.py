@@ -0,0 +1,52 @@
+"""Compare the time to first token when sampling from an empty cache and from the cached title header.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/prefix_cache.py
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TITLES = ['Election', 'Stocks fall', 'New species of frog discovered in the Amazon rainforest']
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark cold-prefix and warm-prefix time to first token.')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=20, type=int,
+                        help='Number of times each title is sampled from. Default: 20')
+    return parser
+
+
+def time_first_token(sampler, context_tokens, past, repeats):
+    """Return the median number of seconds taken to sample a single token after the context."""
+    latencies = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        sampler.sample([context_tokens], 1, [(i, 0)], past=past)
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies)
+
+
+def main():
+    """Print the cold-prefix and warm-prefix time to first token for titles of different lengths."""
+    args = create_parser().parse_args()
+    from gpt2handler import CONTENT_HEADER, TITLE_HEADER, Gpt2Handler
+
+    handler = Gpt2Handler.get_instance()
+    print(f'{"title tokens":>12} {"cold ms":>10} {"warm ms":>10} {"speedup":>8}')
+    for title in TITLES:
+        context_tokens = handler.enc.encode(TITLE_HEADER + title + CONTENT_HEADER)
+        past, uncached_tokens = handler.split_cached_prefix(context_tokens)
+        cold = time_first_token(handler.sampler, context_tokens, None, args.repeats)
+        warm = time_first_token(handler.sampler, uncached_tokens, past, args.repeats)
+        num_title_tokens = len(handler.enc.encode(title))
+        print(f'{num_title_tokens:>12} {cold * 1000:>10.1f} {warm * 1000:>10.1f} {cold / warm:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Compare the perplexity, peak memory and scoring speed of the float32 and int8 models on a held-out set of articles.
+
+The held-out set is a manifest in the same format as for bulk generation, a '.csv' file with 'title' and
+'initial_content' columns or a JSONL file, where the initial content is the full text of each article.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/quantization_quality.py held_out.jsonl
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PRECISIONS = ['float32', 'int8']
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Compare the perplexity of the float32 and int8 models.')
+    parser.add_argument('manifest', help='A manifest of held-out articles to score.')
+    parser.add_argument('-l', '--limit', dest='limit', default=100, type=int,
+                        help='The largest number of articles to score. Default: 100')
+    return parser
+
+
+def measure(precision, manifest_filename, limit):
+    """Load the model at a precision and return its perplexity over the articles of the manifest, the peak memory of
+    the process in megabytes and the number of milliseconds taken to score each token."""
+    import itertools
+
+    import gpt2handler
+    from bulk import read_manifest
+    from gpt2handler import CONTENT_HEADER, TITLE_HEADER, Gpt2Handler
+
+    gpt2handler.MODEL_CONFIG['precision'] = precision
+    handler = Gpt2Handler.get_instance()
+
+    total_log_prob, num_tokens, seconds = 0.0, 0, 0.0
+    for title, content in itertools.islice(read_manifest(manifest_filename), limit):
+        context_tokens = handler.enc.encode(TITLE_HEADER + title + CONTENT_HEADER + content)[:handler.hparams.n_ctx]
+        start = time.perf_counter()
+        log_probs = handler.sampler.score([context_tokens])
+        seconds += time.perf_counter() - start
+        total_log_prob += float(log_probs.sum())
+        num_tokens += log_probs.size
+
+    peak_megabytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in kilobytes on Linux
+    return math.exp(-total_log_prob / num_tokens), peak_megabytes, seconds / num_tokens * 1000
+
+
+def main():
+    """Score the held-out articles with each precision in its own process and print the results side by side."""
+    args = create_parser().parse_args()
+    # Each precision is measured in a new process, so that the peak memory of one does not include the other
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for precision in PRECISIONS:
+        with context.Pool(1) as pool:
+            results[precision] = pool.apply(measure, (precision, args.manifest, args.limit))
+
+    baseline_perplexity = results['float32'][0]
+    print(f'{"precision":>9} {"perplexity":>10} {"change":>8} {"peak MB":>8} {"ms/token":>9}')
+    for precision, (perplexity, peak_megabytes, ms_per_token) in results.items():
+        change = (perplexity / baseline_perplexity - 1) * 100
+        print(f'{precision:>9} {perplexity:>10.3f} {change:>7.2f}% {peak_megabytes:>8.0f} {ms_per_token:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
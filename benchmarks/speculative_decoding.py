@@ -0,0 +1,86 @@
+"""Compare the decode speed of sampling with the model alone and with speculative decoding, and report how many of the
+tokens proposed by the draft model were accepted.
+
+Each configuration runs in a new process, since the number of tokens drafted at a time is fixed when the graph is built.
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/speculative_decoding.py --draft_layers 2 --draft_tokens 2 4 6
+Pass --tiny to use the tiny model with random weights from tiny_model.py instead, which only checks that it runs.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark speculative decoding.')
+    parser.add_argument('-l', '--draft_layers', dest='draft_layers', default=2, type=int,
+                        help='Number of layers of the model the draft model is made of. Default: 2')
+    parser.add_argument('-k', '--draft_tokens', dest='draft_tokens', default=[2, 4, 6], type=int, nargs='+',
+                        help='Numbers of tokens drafted at a time to compare. Default: 2 4 6')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=256, type=int,
+                        help='Number of words to generate per sample. Default: 256')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=1, type=int,
+                        help='Number of samples to generate at a time. Default: 1')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=3, type=int,
+                        help='Number of times each configuration is measured. Default: 3')
+    parser.add_argument('--tiny', dest='tiny', action='store_true',
+                        help='Use the tiny model with random weights instead of the fine-tuned model')
+    return parser
+
+
+def measure(draft_layers, draft_tokens, num_words, num_samples, repeats, tiny_directory):
+    """Load the model with a draft model of draft_layers layers, or none if it is 0, and return the median seconds per
+    decoded token and the fraction of drafted tokens accepted."""
+    import gpt2handler
+    from gpt2handler import Gpt2Handler
+    from metrics import Metrics
+
+    if tiny_directory:
+        from tiny_model import use_tiny_model
+        use_tiny_model(tiny_directory)
+    gpt2handler.MODEL_CONFIG['draft_layers'] = draft_layers
+    gpt2handler.MODEL_CONFIG['draft_tokens'] = draft_tokens
+    gpt2handler.DEFAULT_CONFIG['seed'] = '0'
+    Metrics.enable()
+
+    handler = Gpt2Handler.get_instance()
+    handler.generate('Example title', num_words=1)  # Warm up the session
+    seconds_per_token = []
+    for _ in range(repeats):
+        start_tokens = Metrics.get_instance().get_stats()['decode']['tokens']
+        start = time.perf_counter()
+        handler.generate('Example title', num_samples=num_samples, num_words=num_words)
+        seconds = time.perf_counter() - start
+        seconds_per_token.append(seconds / (Metrics.get_instance().get_stats()['decode']['tokens'] - start_tokens))
+    return statistics.median(seconds_per_token), handler.sampler.get_draft_acceptance_rate()
+
+
+def main():
+    """Print the milliseconds per token, acceptance rate and speedup of each number of tokens drafted at a time."""
+    args = create_parser().parse_args()
+    tiny_directory = tempfile.mkdtemp() if args.tiny else None
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for draft_layers, draft_tokens in [(0, 0)] + [(args.draft_layers, k) for k in args.draft_tokens]:
+        with context.Pool(1) as pool:
+            results.append((draft_layers, draft_tokens) + pool.apply(measure, (
+                draft_layers, draft_tokens, args.num_words, args.num_samples, args.repeats, tiny_directory)))
+
+    baseline = results[0][2]
+    print(f'{"draft layers":>12} {"drafted":>7} {"ms/token":>9} {"accepted":>9} {"speedup":>8}')
+    for draft_layers, draft_tokens, seconds_per_token, acceptance_rate in results:
+        accepted = f'{acceptance_rate:>9.1%}' if acceptance_rate is not None else f'{"n/a":>9}'
+        print(f'{draft_layers:>12} {draft_tokens:>7} {seconds_per_token * 1000:>9.2f} {accepted} '
+              f'{baseline / seconds_per_token:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Measure the startup time of the command line help, the GUI window, and the first generation.
+
+Each measurement runs in a new Python process so that nothing is already imported or loaded. Run from the root of the
+repository so the checkpoint folder can be found:
+    python benchmarks/startup_time.py
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run in a new process for each measurement. Each prints the number of seconds until it was ready, measured from
+# the start of the process, so that the time taken to start Python itself is included.
+GUI_CODE = """
+import time
+start = time.perf_counter()
+from gui import Gui
+gui = Gui.get_instance()
+gui.root.update()
+print(time.perf_counter() - start)
+gui.root.destroy()
+"""
+FIRST_GENERATION_CODE = """
+import time
+start = time.perf_counter()
+from generator import Generator
+Generator.get_instance().generate('Example title', num_words=1)
+print(time.perf_counter() - start)
+"""
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark startup time.')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=5, type=int,
+                        help='Number of times each startup is measured. Default: 5')
+    parser.add_argument('--no_gui', dest='no_gui', action='store_true',
+                        help='Skip measuring the GUI, for hosts without a display.')
+    return parser
+
+
+def time_help():
+    """Return the number of seconds 'ArticleGenerator.py -h' takes to run."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'ArticleGenerator.py', '-h'], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_code(code):
+    """Run the code in a new process and return the number of seconds it printed."""
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    """Print the median startup time of each entry point."""
+    args = create_parser().parse_args()
+    measurements = [('-h', time_help)]
+    if not args.no_gui:
+        measurements.append(('GUI window', lambda: time_code(GUI_CODE)))
+    measurements.append(('first generation', lambda: time_code(FIRST_GENERATION_CODE)))
+
+    print(f'{"startup":>18} {"median s":>10} {"min s":>8}')
+    for name, measure in measurements:
+        times = [measure() for _ in range(args.repeats)]
+        print(f'{name:>18} {statistics.median(times):>10.2f} {min(times):>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Measure the throughput, time to first text, peak memory and run-to-run variance of generation over a matrix of
+lengths, numbers of samples, prompt lengths and sampling settings, and save the results as JSON.
+
+Every configuration is generated with Gpt2Handler.generate and with Generator.generate, with a fixed seed so that each
+repeat generates the same tokens. By default the tiny model with random weights from tiny_model.py is used, which runs
+on a CPU in a few minutes without downloading anything, so the suite can run in continuous integration:
+    python benchmarks/suite.py -o results.json
+Pass --real to benchmark the fine-tuned model instead, from the root of the repository so the checkpoint folder can be
+found. Pass --baseline with an earlier results file to print the change in throughput of each configuration.
+The peak memory of a process only grows, so it is only meaningful per configuration with --isolate, which measures each
+configuration in a new process at the cost of loading the model for each.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ENTRY_POINTS = ['handler', 'generator']
+# The arguments each sampling setting overrides in DEFAULT_CONFIG
+SAMPLING_SETTINGS = {
+    'top_k': {'top_k': '40'},
+    'top_p': {'top_k': '0', 'top_p': '0.9'},
+    'temperature': {'top_k': '0', 'temperature': '1.0'}
+}
+TITLE = 'Council approves plan for new bridge'
+PREFIX_TEXT = ('The city council voted on Tuesday to approve the long debated plan for a new bridge across the river, '
+               'ending years of argument over its cost and location. ') * 20
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark generation over a matrix of configurations.')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=[32, 128], type=int, nargs='+',
+                        help='Numbers of words to generate per sample. Default: 32 128')
+    parser.add_argument('-n', '--num_samples', dest='num_samples', default=[1, 4], type=int, nargs='+',
+                        help='Numbers of samples to generate per call. Default: 1 4')
+    parser.add_argument('-p', '--prefix_words', dest='prefix_words', default=[0, 32, 128], type=int, nargs='+',
+                        help='Numbers of words of initial content in the prompt. Default: 0 32 128')
+    parser.add_argument('-s', '--sampling', dest='sampling', default=list(SAMPLING_SETTINGS), nargs='+',
+                        choices=list(SAMPLING_SETTINGS),
+                        help=f'Sampling settings to use. Default: {" ".join(SAMPLING_SETTINGS)}')
+    parser.add_argument('-e', '--entry_points', dest='entry_points', default=ENTRY_POINTS, nargs='+',
+                        choices=ENTRY_POINTS, help=f'Entry points to call. Default: {" ".join(ENTRY_POINTS)}')
+    parser.add_argument('-r', '--repeats', dest='repeats', default=3, type=int,
+                        help='Number of times each configuration is measured. Default: 3')
+    parser.add_argument('--seed', dest='seed', default=0, type=int,
+                        help='The seed every sample is generated with. Default: 0')
+    parser.add_argument('--real', dest='real', action='store_true',
+                        help='Benchmark the fine-tuned model in the checkpoint folder instead of the tiny model')
+    parser.add_argument('--tiny_directory', dest='tiny_directory', default=None,
+                        help='Where the tiny model is created. Default: a new temporary directory')
+    parser.add_argument('--isolate', dest='isolate', action='store_true',
+                        help='Measure each configuration in a new process')
+    parser.add_argument('-o', '--output', dest='output', default='benchmark_results.json',
+                        help='The JSON file the results are written to. Default: benchmark_results.json')
+    parser.add_argument('-b', '--baseline', dest='baseline', default=None,
+                        help='An earlier results file to compare the throughput of each configuration against')
+    return parser
+
+
+def get_configurations(args):
+    """Return a dictionary describing each configuration in the matrix given by the arguments."""
+    return [{'entry_point': entry_point, 'num_words': num_words, 'num_samples': num_samples,
+             'prefix_words': prefix_words, 'sampling': sampling}
+            for entry_point, num_words, num_samples, prefix_words, sampling in
+            itertools.product(args.entry_points, args.num_words, args.num_samples, args.prefix_words, args.sampling)]
+
+
+def get_configuration_key(configuration):
+    """Return a string identifying a configuration, used to match it to a configuration in a baseline."""
+    return ' '.join(f'{name}={configuration[name]}' for name in sorted(configuration))
+
+
+def set_up(real, tiny_directory):
+    """Make the model being benchmarked the one Gpt2Handler loads and start recording metrics."""
+    from metrics import Metrics
+
+    if not real:
+        from tiny_model import use_tiny_model
+        use_tiny_model(tiny_directory)
+    Metrics.enable()
+
+
+def configure_sampling(sampling, seed, default_config):
+    """Set DEFAULT_CONFIG to the defaults it had at the start with a sampling setting and a seed applied."""
+    import gpt2handler
+
+    gpt2handler.DEFAULT_CONFIG.clear()
+    gpt2handler.DEFAULT_CONFIG.update(default_config, seed=str(seed), **SAMPLING_SETTINGS[sampling])
+
+
+def get_generate_function(entry_point):
+    """Return the generate and generate_stream methods of the entry point."""
+    from generator import Generator
+    from gpt2handler import Gpt2Handler
+
+    if entry_point == 'handler':
+        return Gpt2Handler.get_instance().generate, Gpt2Handler.get_instance().generate_stream
+    return Generator.get_instance().generate, Generator.get_instance().generate_stream
+
+
+def get_decoded_tokens():
+    """Return the number of tokens decoded so far."""
+    from metrics import Metrics
+
+    return Metrics.get_instance().get_stats().get('decode', {}).get('tokens', 0)
+
+
+def measure_time_to_first_text(generate_stream, initial_content, num_samples, num_words):
+    """Return the number of seconds until a stream yields its first text, and stop it there."""
+    start = time.perf_counter()
+    stream = generate_stream(TITLE, initial_content, num_samples=num_samples, num_words=num_words)
+    try:
+        for index, text, finished in stream:
+            if text:
+                break
+        return time.perf_counter() - start
+    finally:
+        stream.close()
+
+
+def summarise(values):
+    """Return the mean, standard deviation, variance, minimum and maximum of a list of measurements."""
+    return {
+        'mean': statistics.mean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'variance': statistics.variance(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'max': max(values)
+    }
+
+
+def measure(configuration, repeats, seed, default_config):
+    """Generate with a configuration repeats times and return a summary of each measurement."""
+    generate, generate_stream = get_generate_function(configuration['entry_point'])
+    configure_sampling(configuration['sampling'], seed, default_config)
+    initial_content = ' '.join(PREFIX_TEXT.split()[:configuration['prefix_words']])
+    num_samples, num_words = configuration['num_samples'], configuration['num_words']
+
+    seconds, tokens_per_second, first_text_seconds = [], [], []
+    tokens = 0
+    for _ in range(repeats):
+        start_tokens = get_decoded_tokens()
+        start = time.perf_counter()
+        generate(TITLE, initial_content, num_samples=num_samples, num_words=num_words)
+        seconds.append(time.perf_counter() - start)
+        tokens = get_decoded_tokens() - start_tokens
+        tokens_per_second.append(tokens / seconds[-1])
+        first_text_seconds.append(measure_time_to_first_text(generate_stream, initial_content, num_samples,
+                                                             num_words))
+
+    return {
+        'tokens': tokens,  # The same on every repeat, since the seed is fixed
+        'seconds': summarise(seconds),
+        'tokens_per_second': summarise(tokens_per_second),
+        'time_to_first_text_seconds': summarise(first_text_seconds),
+        'peak_rss_megabytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # In kilobytes on Linux
+    }
+
+
+def measure_all(configurations, repeats, seed, real, tiny_directory):
+    """Load the model, warm it up and measure every configuration in this process. Return the measurements and a
+    description of the environment and the model."""
+    import gpt2handler
+    from gpt2handler import Gpt2Handler
+
+    set_up(real, tiny_directory)
+    default_config = dict(gpt2handler.DEFAULT_CONFIG)
+    handler = Gpt2Handler.get_instance()
+    handler.generate(TITLE, num_words=1)  # Warm up the session
+    results = [measure(configuration, repeats, seed, default_config) for configuration in configurations]
+    return results, get_environment(handler)
+
+
+def get_environment(handler):
+    """Return a description of the machine, the libraries and the model the benchmark ran with."""
+    import tensorflow as tf
+    import gpt2handler
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'tensorflow': tf.__version__,
+        'run_name': handler.run_name,
+        'hparams': vars(handler.hparams),
+        'precision': gpt2handler.MODEL_CONFIG['precision']
+    }
+
+
+def compare_to_baseline(results, baseline_filename):
+    """Print the change in mean throughput of each configuration that is also in a baseline results file."""
+    with open(baseline_filename) as f:
+        baseline = {get_configuration_key(result['configuration']): result for result in json.load(f)['results']}
+    print(f'\nChange in tokens per second compared to {baseline_filename}:')
+    for result in results:
+        previous = baseline.get(get_configuration_key(result['configuration']))
+        if previous is not None:
+            before = previous['tokens_per_second']['mean']
+            after = result['tokens_per_second']['mean']
+            print(f'{get_configuration_key(result["configuration"])}: {before:.1f} -> {after:.1f} '
+                  f'({(after / before - 1) * 100:+.1f}%)')
+
+
+def main():
+    """Measure every configuration, print a table of the results and write them to the output file."""
+    args = create_parser().parse_args()
+    tiny_directory = None if args.real else os.path.abspath(args.tiny_directory or tempfile.mkdtemp())
+    configurations = get_configurations(args)
+    # The tiny model is loaded from its own directory, which becomes the current directory
+    output_filename = os.path.abspath(args.output)
+    baseline_filename = args.baseline and os.path.abspath(args.baseline)
+
+    if args.isolate:
+        context = multiprocessing.get_context('spawn')
+        measurements = []
+        for configuration in configurations:
+            with context.Pool(1) as pool:
+                [measurement], environment = pool.apply(measure_all, ([configuration], args.repeats, args.seed,
+                                                                      args.real, tiny_directory))
+            measurements.append(measurement)
+    else:
+        measurements, environment = measure_all(configurations, args.repeats, args.seed, args.real, tiny_directory)
+
+    results = [dict(measurement, configuration=configuration)
+               for configuration, measurement in zip(configurations, measurements)]
+    print(f'{"entry":>9} {"words":>5} {"samples":>7} {"prefix":>6} {"sampling":>11} {"tokens/s":>9} {"+-":>7} '
+          f'{"first text s":>12} {"peak MB":>8}')
+    for result in results:
+        configuration = result['configuration']
+        print(f'{configuration["entry_point"]:>9} {configuration["num_words"]:>5} {configuration["num_samples"]:>7} '
+              f'{configuration["prefix_words"]:>6} {configuration["sampling"]:>11} '
+              f'{result["tokens_per_second"]["mean"]:>9.1f} {result["tokens_per_second"]["stdev"]:>7.1f} '
+              f'{result["time_to_first_text_seconds"]["mean"]:>12.3f} {result["peak_rss_megabytes"]:>8.0f}')
+
+    with open(output_filename, 'w') as f:
+        json.dump({'environment': environment, 'repeats': args.repeats, 'seed': args.seed, 'results': results}, f,
+                  indent=2)
+    print(f'\nWrote the results to {args.output}')
+    if baseline_filename:
+        compare_to_baseline(results, baseline_filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Compare the time until the first text of an article is visible when streaming and when generating all of it.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/time_to_first_text.py
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark time to first visible text.')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=256, type=int,
+                        help='Number of words to generate per article. Default: 256')
+    return parser
+
+
+def main():
+    """Print the time until the first text and the whole article are available with and without streaming."""
+    args = create_parser().parse_args()
+    from generator import Generator
+
+    gen = Generator.get_instance()
+    gen.generate('Example title', num_words=1)  # Warm up the session
+
+    start = time.perf_counter()
+    gen.generate('Example title', num_words=args.num_words)
+    blocking = time.perf_counter() - start
+
+    start = time.perf_counter()
+    first_text = None
+    for index, text, finished in gen.generate_stream('Example title', num_words=args.num_words):
+        if first_text is None and text:
+            first_text = time.perf_counter() - start
+    streaming = time.perf_counter() - start
+
+    print(f'{"mode":>10} {"first text s":>13} {"whole article s":>16}')
+    print(f'{"blocking":>10} {blocking:>13.2f} {blocking:>16.2f}')
+    print(f'{"streaming":>10} {first_text:>13.2f} {streaming:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Create a tiny GPT-2 model with random weights, so that the benchmarks can run on a CPU without downloading anything.
+
+The model has the architecture of GPT-2 with two narrow layers, a vocabulary of the 256 bytes and <|endoftext|>, and no
+BPE merges, so every byte of text is a token of its own. What it generates is meaningless, but every stage of
+generation runs the same code as with the real model. It is created in the models and checkpoint folders of a working
+directory, which is used as the current directory while it is loaded:
+    python benchmarks/tiny_model.py -d /tmp/tiny
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TINY_NAME = 'tiny'  # Used as both the model name and the run name
+TINY_HPARAMS = {
+    'n_vocab': 257,
+    'n_ctx': 1024,
+    'n_embd': 64,
+    'n_head': 4,
+    'n_layer': 2
+}
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this script."""
+    parser = argparse.ArgumentParser(description='Create a tiny GPT-2 model with random weights.')
+    parser.add_argument('-d', '--directory', dest='directory', default='.',
+                        help='The working directory the model is created in. Default: the current directory')
+    return parser
+
+
+def create_tiny_model(directory, seed=0):
+    """Create the encoder, hyperparameters and randomly initialised checkpoint of the tiny model in the models and
+    checkpoint folders of a directory, unless they already exist."""
+    from gpt_2_simple.src.encoder import bytes_to_unicode
+
+    model_path = os.path.join(directory, 'models', TINY_NAME)
+    checkpoint_path = os.path.join(directory, 'checkpoint', TINY_NAME)
+    if os.path.isfile(os.path.join(checkpoint_path, 'checkpoint')):
+        return
+
+    byte_characters = bytes_to_unicode()
+    encoder = {byte_characters[byte]: byte for byte in range(256)}
+    encoder['<|endoftext|>'] = len(encoder)
+    for path in (model_path, checkpoint_path):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'hparams.json'), 'w') as f:
+            json.dump(TINY_HPARAMS, f, indent=2)
+    with open(os.path.join(model_path, 'encoder.json'), 'w') as f:
+        json.dump(encoder, f)
+    with open(os.path.join(model_path, 'vocab.bpe'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')  # No merges
+
+    save_random_checkpoint(checkpoint_path, seed)
+
+
+def save_random_checkpoint(checkpoint_path, seed):
+    """Initialise the variables of a model with the tiny hyperparameters randomly and save them as a checkpoint."""
+    import tensorflow as tf
+    from gpt_2_simple.src import model
+
+    hparams = model.default_hparams()
+    hparams.override_from_dict(TINY_HPARAMS)
+    graph = tf.Graph()
+    with graph.as_default(), tf.compat.v1.Session(graph=graph) as sess:
+        tf.compat.v1.set_random_seed(seed)
+        model.model(hparams=hparams, X=tf.compat.v1.placeholder(tf.int32, [1, None]))
+        sess.run(tf.compat.v1.global_variables_initializer())
+        tf.compat.v1.train.Saver().save(sess, os.path.join(checkpoint_path, 'model'))
+
+
+def use_tiny_model(directory):
+    """Create the tiny model in a directory if needed, make it the current directory and make the tiny model the one
+    Gpt2Handler loads. Call this before the instance of Gpt2Handler is created."""
+    import gpt2handler
+
+    create_tiny_model(directory)
+    os.chdir(directory)
+    gpt2handler.DEFAULT_CONFIG['model_name'] = TINY_NAME
+    gpt2handler.DEFAULT_CONFIG['run_name'] = TINY_NAME
+
+
+def main():
+    """Create the tiny model in the directory given."""
+    args = create_parser().parse_args()
+    create_tiny_model(args.directory)
+    print(f'Created the tiny model in {os.path.abspath(args.directory)}')
+
+
+if __name__ == '__main__':
+    main()
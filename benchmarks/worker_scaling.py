@@ -0,0 +1,59 @@
+"""Measure how the throughput of a WorkerPool scales from 1 to N worker processes.
+
+Run from the root of the repository so the checkpoint folder can be found:
+    python benchmarks/worker_scaling.py -N 8
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def create_parser():
+    """Create and return a parser for the arguments of this benchmark."""
+    parser = argparse.ArgumentParser(description='Benchmark worker pool throughput scaling.')
+    parser.add_argument('-N', '--max_workers', dest='max_workers', default=os.cpu_count() or 1, type=int,
+                        help='The largest number of workers to measure. Default: the number of cores')
+    parser.add_argument('-p', '--num_prompts', dest='num_prompts', default=32, type=int,
+                        help='Number of prompts to generate a sample for with each pool. Default: 32')
+    parser.add_argument('-w', '--num_words', dest='num_words', default=128, type=int,
+                        help='Number of words to generate per sample. Default: 128')
+    return parser
+
+
+def get_worker_counts(max_workers):
+    """Return the powers of two up to max_workers, followed by max_workers if it is not one of them."""
+    counts = []
+    count = 1
+    while count < max_workers:
+        counts.append(count)
+        count *= 2
+    return counts + [max_workers]
+
+
+def main():
+    """Generate the same prompts with pools of an increasing number of workers and print the throughput."""
+    args = create_parser().parse_args()
+    from worker_pool import WorkerPool
+
+    prompts = [(f'Example title {i}', '', 1, args.num_words) for i in range(args.num_prompts)]
+    print(f'{"workers":>8} {"seconds":>10} {"articles/sec":>13} {"speedup":>8}')
+    baseline = None
+    for num_workers in get_worker_counts(args.max_workers):
+        pool = WorkerPool(num_workers)
+        pool.generate_many([('Warm up', '', num_workers, 1)])  # Load the model in every worker before timing
+
+        start = time.perf_counter()
+        pool.generate_many(prompts)
+        elapsed = time.perf_counter() - start
+        pool.close()
+
+        throughput = args.num_prompts / elapsed
+        baseline = baseline or throughput
+        print(f'{num_workers:>8} {elapsed:>10.2f} {throughput:>13.2f} {throughput / baseline:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import csv
+import itertools
+import json
+import os
+import time
+
+from metrics import Metrics
+
+ROWS_PER_BATCH = 8  # The number of manifest rows whose samples are generated together
+PROGRESS_EXTENSION = '.progress'  # Appended to the output filename to get the filename of its progress file
+
+
+def read_manifest(filename):
+    """Yield the (title, initial content) of each row of a manifest one at a time.
+    A manifest ending in '.csv' must have a header row with a 'title' column and optionally an 'initial_content'
+    column. Any other manifest is read as JSONL, with an object with a 'title' and optionally an 'initial_content' on
+    each line."""
+    with open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='') as f:
+        if filename.lower().endswith('.csv'):
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+
+        for row_number, row in enumerate(rows, 1):
+            title = (row.get('title') or '').strip()
+            if not title:
+                raise Exception(f'Row {row_number} of \'{filename}\' does not have a title.')
+            yield title, (row.get('initial_content') or '').strip()
+
+
+def encode_row(title, initial_content, samples):
+    """Return the (sample, metadata) pairs generated for a row of a manifest as a line of JSON encoded as bytes."""
+    return json.dumps({
+        'title': title,
+        'initial_content': initial_content,
+        'samples': [sample for sample, metadata in samples],
+        'metadata': [metadata for sample, metadata in samples]
+    }).encode('utf-8', errors='surrogateescape') + b'\n'
+
+
+def load_progress(output_filename):
+    """Return the progress saved for an output file as a dictionary with the number of manifest rows that have been
+    written and the size of the output file after writing them, or None if there is no progress saved."""
+    try:
+        with open(output_filename + PROGRESS_EXTENSION, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_progress(output_filename, rows, offset):
+    """Save the number of manifest rows written to an output file and its size, replacing the progress atomically."""
+    progress_filename = output_filename + PROGRESS_EXTENSION
+    with open(progress_filename + '.tmp', 'w') as f:
+        json.dump({'rows': rows, 'offset': offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(progress_filename + '.tmp', progress_filename)
+
+
+def generate_from_manifest(model, manifest_filename, output_filename, num_samples=1, num_words=1023, best_of=None,
+                           rows_per_batch=ROWS_PER_BATCH):
+    """Generate samples for every row of a manifest with a model that stays loaded, and append one JSON object per row
+    to the output file as soon as its samples are generated. The model must have the generate_many method of
+    Gpt2Handler. If best_of is given, best_of samples are generated for each row and the num_samples with the highest
+    mean log probability are written, best first, with their log probabilities in their metadata.
+    Progress is saved after every batch of rows. If the output file already has progress saved, rows that have been
+    written are skipped and anything written after the saved progress is discarded, so that a run that crashed
+    resumes where it stopped. If the output file is missing or shorter than its saved progress, an exception is raised
+    instead."""
+    progress = load_progress(output_filename)
+    if progress is None:
+        if os.path.isfile(output_filename) and os.path.getsize(output_filename) > 0:
+            raise Exception(f'\'{output_filename}\' already exists and has no progress saved to resume from.')
+        progress = {'rows': 0, 'offset': 0}
+    elif not os.path.isfile(output_filename) or os.path.getsize(output_filename) < progress['offset']:
+        # Resuming would pad the output with zero bytes in place of the rows that were lost
+        raise Exception(f'\'{output_filename}\' is missing or shorter than its saved progress, so it cannot be '
+                        f'resumed. Delete \'{output_filename + PROGRESS_EXTENSION}\' to start again.')
+
+    rows = itertools.islice(read_manifest(manifest_filename), progress['rows'], None)
+    rows_written = progress['rows']
+    articles_generated = 0
+    start = time.monotonic()
+    with open(output_filename, 'ab') as output:
+        output.truncate(progress['offset'])  # Discard anything written after the progress was last saved
+        while True:
+            batch = list(itertools.islice(rows, rows_per_batch))
+            if not batch:
+                break
+
+            results = model.generate_many([(title, initial_content, best_of or num_samples, num_words)
+                                           for title, initial_content in batch], as_tuple=True,
+                                          num_best=num_samples if best_of else None)
+            with Metrics.get_instance().time('file_write'):
+                for (title, initial_content), samples in zip(batch, results):
+                    output.write(encode_row(title, initial_content, samples))
+                output.flush()
+                os.fsync(output.fileno())
+
+            rows_written += len(batch)
+            articles_generated += len(batch) * num_samples
+            save_progress(output_filename, rows_written, output.tell())
+
+            articles_per_hour = articles_generated / (time.monotonic() - start) * 3600
+            print(f'{rows_written} rows written to \'{output_filename}\' ({articles_per_hour:.0f} articles/hour)',
+                  flush=True)
+
+    return rows_written
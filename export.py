@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from quantization import quantized_getter, read_weights
+from sampler import Sampler
+
+GRAPH_FILENAME = 'graph.pb'  # The pruned sampling graph, with a placeholder in place of each variable
+INFO_FILENAME = 'export.json'  # The precision of the export and the file each weight is stored in
+WEIGHTS_FOLDER = 'weights'
+
+
+class WeightPlaceholders:
+    """This class is a custom getter for tf.compat.v1.variable_scope that creates a placeholder named after each
+    variable instead of the variable, so that the weights can be fed to the graph rather than stored in it."""
+
+    def __init__(self):
+        """Initialise the getter with no placeholders created."""
+        self.placeholders = {}
+
+    def __call__(self, getter, name, shape=None, dtype=tf.float32, **kwargs):
+        """Return the placeholder for the variable, creating it the first time the variable is requested."""
+        if name not in self.placeholders:
+            with tf.compat.v1.get_default_graph().name_scope(None):  # Name it after the variable, outside any scope
+                self.placeholders[name] = tf.compat.v1.placeholder(dtype.base_dtype, shape, name=name)
+        return self.placeholders[name]
+
+
+def export_model(hparams, checkpoint_path, export_path, precision='float32'):
+    """Export the sampling graph of the model in a checkpoint to the export folder, so that it can be loaded with
+    load_exported_model without building the model or restoring the checkpoint.
+    The graph is pruned to the operations the sampler uses and each weight is saved to its own .npy file in the
+    precision given, so that it can be memory-mapped when it is loaded."""
+    graph = tf.Graph()
+    weight_placeholders = WeightPlaceholders()
+    with graph.as_default(), tf.compat.v1.Session(graph=graph) as sess:
+        with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), custom_getter=weight_placeholders):
+            sampler = Sampler(sess, hparams, custom_getter=quantized_getter if precision == 'int8' else None)
+        graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph.as_graph_def(), sampler.get_output_names())
+
+    os.makedirs(os.path.join(export_path, WEIGHTS_FOLDER), exist_ok=True)
+    with open(os.path.join(export_path, GRAPH_FILENAME), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    weight_filenames = {}
+    for name, value in read_weights(checkpoint_path, list(weight_placeholders.placeholders)):
+        weight_filenames[name] = os.path.join(WEIGHTS_FOLDER, name.replace('/', '.') + '.npy')
+        np.save(os.path.join(export_path, weight_filenames[name]), value)
+
+    # The info file is written last, so that an export that did not finish is never loaded
+    with open(os.path.join(export_path, INFO_FILENAME), 'w') as f:
+        json.dump({'precision': precision, 'weights': weight_filenames}, f, indent=2)
+
+
+def is_exported(export_path):
+    """Return whether the export folder contains a finished export."""
+    return os.path.isfile(os.path.join(export_path, INFO_FILENAME))
+
+
+def load_exported_model(sess, hparams, export_path):
+    """Import the sampling graph of an export into the graph of the session and return a sampler for it.
+    The weights are memory-mapped rather than read into memory. Their files are aligned so TensorFlow can use them
+    without copying when they are fed, which lets every process using the same export share a single copy."""
+    with open(os.path.join(export_path, INFO_FILENAME), 'r') as f:
+        info = json.load(f)
+    graph_def = tf.compat.v1.GraphDef()
+    with open(os.path.join(export_path, GRAPH_FILENAME), 'rb') as f:
+        graph_def.ParseFromString(f.read())
+
+    weights = {name + ':0': np.load(os.path.join(export_path, filename), mmap_mode='r')
+               for name, filename in info['weights'].items()}
+    return Sampler(sess, hparams, graph_def=graph_def, weights=weights)
@@ -1,6 +1,13 @@
-import os
+import threading
 
+import bulk
+import work_queue
 from gpt2handler import Gpt2Handler
+from metrics import Metrics
+from model_thread import ModelThread
+from output_sinks import create_sink
+from tuning import load_profile
+from worker_pool import WorkerPool
 
 
 class Generator:
@@ -21,7 +28,35 @@ class Generator:
         else:
             raise Exception("Attempted initialisation of singleton class Gui.")
 
-        Gpt2Handler.get_instance()  # Create instance of Gpt2Handler
+        self.profile = load_profile()  # The settings tuned for this host, or none if it has not been tuned
+        self.worker_pool = None
+        self.model_thread = None  # Generates for coroutines, started the first time one generates
+        self.model_thread_lock = threading.Lock()
+
+    def warm_up(self):
+        """Create the instance of Gpt2Handler, which imports TensorFlow and loads the model, if it does not exist.
+        Otherwise this is done by the first generation that needs it. Nothing is loaded if a worker pool has been
+        started, since the workers load their own copies of the model."""
+        if self.worker_pool is None:
+            Gpt2Handler.get_instance()
+
+    def start_worker_pool(self, num_workers, intra_op_threads=None, inter_op_threads=1):
+        """Generate with a pool of num_workers processes, each with its own gpt2 session, from now on. If the threads
+        are not given and the host was tuned for that number of workers, the tuned threads are used."""
+        if intra_op_threads is None and self.profile.get('num_workers') == num_workers:
+            intra_op_threads = self.profile['intra_op_threads']
+            inter_op_threads = self.profile['inter_op_threads']
+        if self.worker_pool:
+            self.worker_pool.close()
+        self.worker_pool = WorkerPool(num_workers, intra_op_threads, inter_op_threads)
+
+    def get_tuned_num_workers(self):
+        """Return the number of workers tuned for this host, or 1 if it has not been tuned."""
+        return self.profile.get('num_workers', 1)
+
+    def get_model(self):
+        """Return the worker pool if one has been started, or the instance of Gpt2Handler otherwise."""
+        return self.worker_pool or Gpt2Handler.get_instance()
 
     @staticmethod
     def launch_gui():
@@ -39,7 +74,8 @@ class Generator:
                                   num_samples=1,
                                   print_output=False,
                                   output_file=None,
-                                  num_words=1023):
+                                  num_words=1023,
+                                  best_of=None):
         """Read the title and initial content from a single file then use gpt2 to generate an article
         and return it as a single string."""
         with open(input_filename, 'r', errors='surrogateescape') as f:
@@ -48,7 +84,7 @@ class Generator:
         title = file_contents[0].rstrip()
         initial_content = '' if len(file_contents) < 2 else file_contents[1].rstrip()
 
-        return self.generate(title, initial_content, num_samples, print_output, output_file, num_words)
+        return self.generate(title, initial_content, num_samples, print_output, output_file, num_words, best_of)
 
     def generate_from_files(self,
                             title_filename,
@@ -56,7 +92,8 @@ class Generator:
                             num_samples=1,
                             print_output=False,
                             output_file=None,
-                            num_words=1023):
+                            num_words=1023,
+                            best_of=None):
         """Read the title from a file and initial content from another file then use gpt2 to generate an article
         and return it as a single string."""
         with open(title_filename, 'r', errors='surrogateescape') as title_file:
@@ -68,7 +105,20 @@ class Generator:
         else:
             initial_content = ''
 
-        return self.generate(title, initial_content, num_samples, print_output, output_file, num_words)
+        return self.generate(title, initial_content, num_samples, print_output, output_file, num_words, best_of)
+
+    def generate_from_manifest(self, manifest_filename, output_filename, num_samples=1, num_words=1023, best_of=None):
+        """Use gpt2 to generate articles for every row of a manifest, appending them to a JSONL output file as they
+        are generated. Resume from the progress saved for the output file if there is any. If best_of is given, only
+        the best num_samples of best_of articles generated for each row are written."""
+        return bulk.generate_from_manifest(self.get_model(), manifest_filename, output_filename, num_samples,
+                                           num_words, best_of)
+
+    def generate_from_queue(self, queue_directory, lease_seconds=work_queue.LEASE_SECONDS, model=None):
+        """Use gpt2 to generate the batches of a work queue in a shared directory alongside workers on other hosts,
+        until every batch is done. Return the number of batches generated here. Model replaces the model of the
+        generator if it is given."""
+        return work_queue.QueueWorker(queue_directory, model or self.get_model(), lease_seconds=lease_seconds).run()
 
     def generate(self,
                  title,
@@ -76,32 +126,135 @@ class Generator:
                  num_samples=1,
                  print_output=False,
                  output_file=None,
-                 num_words=1023):
-        """Use gpt2 to generate an article based on a given title and initial content."""
+                 num_words=1023,
+                 best_of=None):
+        """Use gpt2 to generate an article based on a given title and initial content.
+        If an output filename is specified, each article is written to it in the format of OUTPUT_CONFIG in the
+        background as soon as it is finished.
+        If best_of is given, best_of articles are generated and only the num_samples of them the model gives the
+        highest mean log probability are returned, best first. They are only printed once all of them are ranked."""
         if not initial_content:
             initial_content = ''
-        samples = Gpt2Handler.get_instance().generate_as_tuple(title, initial_content, num_samples, num_words)
-        samples_str = [sample[0] + '\n' + sample[1] for sample in samples]
 
-        if print_output:  # Print each article to the console is specified to
-            for sample in samples_str:
-                print(sample)
-        if output_file:  # Write each of the samples to their own file if a base filename is specified
-            self.write_samples_to_file(output_file, samples_str)
+        sink = create_sink(output_file, num_samples) if output_file else None
+        try:
+            if print_output and not best_of:  # Print each article to the console as it is generated if specified to
+                stream = self.generate_stream(title, initial_content, num_samples, num_words)
+                if sink:
+                    stream = self.write_finished(stream, sink, num_samples)
+                samples_str = self.print_stream(stream, num_samples)
+            else:
+                def write_sample(prompt_index, sample_index, sample, metadata):
+                    sink.write(sample_index, sample[0] + '\n' + sample[1])
+
+                results = self.get_model().generate_many([(title, initial_content, best_of or num_samples, num_words)],
+                                                         as_tuple=True, on_sample=write_sample if sink else None,
+                                                         num_best=num_samples if best_of else None)
+                samples_str = [sample[0] + '\n' + sample[1] for sample, metadata in results[0]]
+                if print_output:
+                    for article in samples_str:
+                        print(article)
+        finally:
+            if sink:
+                with Metrics.get_instance().time('file_write'):  # Only the time spent waiting for the writes
+                    sink.close()
 
         return samples_str
 
+    def generate_with_scores(self, title, initial_content=None, num_samples=1, num_words=1023, best_of=None):
+        """Use gpt2 to generate articles based on a given title and initial content, and return each as a tuple in
+        the form [title, content] with its metadata, which has the log probability the model gave each of its tokens
+        as it was sampled, their sum and their mean. If best_of is given, only the num_samples of best_of articles with
+        the highest mean are returned, best first."""
+        return self.get_model().generate_many([(title, initial_content or '', best_of or num_samples, num_words)],
+                                              as_tuple=True, score=True,
+                                              num_best=num_samples if best_of else None)[0]
+
+    def generate_stream(self, title, initial_content=None, num_samples=1, num_words=1023):
+        """Use gpt2 to generate articles like generate, but yield (sample index, text, finished) as the text of each
+        article is decoded. Joining the text yielded for an article gives the article generate would return."""
+        if not initial_content:
+            initial_content = ''
+
+        if self.worker_pool:  # The worker processes cannot stream, so yield each article once it is finished
+            samples = self.worker_pool.generate_many_as_tuple([(title, initial_content, num_samples, num_words)])[0]
+            for index, sample in enumerate(samples):
+                yield index, sample[0] + '\n' + sample[1], True
+            return
+
+        samples = [''] * num_samples  # The text of each sample decoded so far
+        emitted = [''] * num_samples  # The text that has been yielded for each article
+        for index, text, finished in Gpt2Handler.get_instance().generate_stream(title, initial_content, num_samples,
+                                                                                 num_words):
+            samples[index] += text
+            article = self.sample_to_article(samples[index], finished)
+            new_text = article[len(emitted[index]):] if article.startswith(emitted[index]) else ''
+            if new_text or finished:
+                yield index, new_text, finished
+                emitted[index] += new_text
+
+    def get_model_thread(self):
+        """Return the thread that generates articles for coroutines. If it has not been started start it first."""
+        with self.model_thread_lock:
+            if self.model_thread is None:
+                self.model_thread = ModelThread(self)
+            return self.model_thread
+
+    async def agenerate(self, title, initial_content=None, num_samples=1, num_words=1023):
+        """Use gpt2 to generate articles like generate, without blocking the event loop it is awaited on. Articles
+        requested by concurrent callers are generated together on a single thread that owns the model."""
+        return await self.get_model_thread().generate(title, initial_content or '', num_samples, num_words)
+
+    def agenerate_stream(self, title, initial_content=None, num_samples=1, num_words=1023):
+        """Return an async iterator that yields (sample index, text, finished) like generate_stream, without blocking
+        the event loop it is iterated on. Closing it or cancelling the task iterating it stops the decoding."""
+        return self.get_model_thread().generate_stream(title, initial_content or '', num_samples, num_words)
+
+    @staticmethod
+    def sample_to_article(sample, finished=True):
+        """Convert a sample into an article made of its title and content separated by a newline. If the sample is not
+        finished, leave out the end of it that could still change when more text is decoded."""
+        if not finished:
+            # A token or run of spaces at the end of the sample may only be partially decoded
+            start_of_token = max(sample.rfind('<|'), sample.rfind('<', len(sample) - 1))
+            if start_of_token > sample.rfind('|>'):
+                sample = sample[:start_of_token]
+            sample = sample.rstrip(' ')
+        return '\n'.join(Gpt2Handler.sample_to_tuple(sample))
+
+    @staticmethod
+    def print_stream(stream, num_samples):
+        """Print the articles yielded by a stream one after another as soon as their text is decoded, then return them.
+        Text of an article that arrives while an earlier article is being printed is printed once it is finished."""
+        articles = [''] * num_samples
+        finished_articles = [False] * num_samples
+        printing = 0  # The index of the article currently being printed
+        for index, text, finished in stream:
+            articles[index] += text
+            finished_articles[index] = finished
+            if index == printing:
+                print(text, end='', flush=True)
+            while printing < num_samples and finished_articles[printing]:
+                print()  # End each article with a newline
+                printing += 1
+                if printing < num_samples:
+                    print(articles[printing], end='', flush=True)
+
+        return articles
+
+    @staticmethod
+    def write_finished(stream, sink, num_samples):
+        """Yield the events of a stream from generate_stream, writing each article to the sink once it is finished."""
+        articles = [''] * num_samples
+        for index, text, finished in stream:
+            articles[index] += text
+            if finished:
+                sink.write(index, articles[index])
+            yield index, text, finished
+
     def write_samples_to_file(self, filename, samples):
-        """Write the given samples to a file. If there is more than one, write each to its own file."""
-        if len(samples) == 1:
-            self.write_sample_to_file(filename, samples[0])
-        else:
-            base, extension = os.path.splitext(filename)
-            for i in range(len(samples)):
-                new_filename = base + str(i) + extension
-                self.write_sample_to_file(new_filename, samples[i])
-
-    def write_sample_to_file(self, filename, sample):
-        """Write a given sample to a file specified by te filename."""
-        with open(filename, 'w+', errors='surrogateescape', encoding='utf-8') as f:
-            f.write(sample)
+        """Write the given samples to a file in the format of OUTPUT_CONFIG. By default, if there is more than one,
+        write each to its own file."""
+        with Metrics.get_instance().time('file_write'), create_sink(filename, len(samples)) as sink:
+            for i, sample in enumerate(samples):
+                sink.write(i, sample)
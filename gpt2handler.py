@@ -6,8 +6,16 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Used to disable TensorFlow printing
 # Source: https://github.com/tensorflow/tensorflow/issues/8340#issuecomment-332212742
 logging.getLogger('tensorflow').disabled = True  # Used to disable TensorFlow printing warning messages
 
-import gpt_2_simple as gpt2
+import functools
+import importlib.util
+import itertools
+import json
+import random
 import re
+import threading
+import types
+
+from metrics import Metrics
 
 DEFAULT_CONFIG = {
     'model_name': '124M',
@@ -17,6 +25,67 @@ DEFAULT_CONFIG = {
     'return_as_list': 'True',
     'truncate': '<|endoftext|><|startoftext|>'  # Truncate the sample where it contains this substring
 }
+# The number of threads TensorFlow uses to run each operation and to run independent operations. 0 uses the numbers in
+# the profile written by 'python ArticleGenerator.py --tune' if there is one, and otherwise lets TensorFlow choose,
+# which is one thread per core. Set these before the instance is created when running several per host, along with the
+# number of processes generating on the host, so that only the settings tuned for that number of workers are used.
+SESSION_CONFIG = {
+    'intra_op_threads': 0,
+    'inter_op_threads': 0,
+    'num_workers': 1
+}
+# The precision the weights of the model are held in. 'float32' loads the checkpoint as it is. 'int8' stores the weights
+# of every matrix multiplication as int8 with a float32 scale per channel, so that they take about a quarter of the
+# memory, and dequantizes them as they are used. Set this before the instance is created.
+# If the export folder holds an export of the model at that precision, made with Gpt2Handler.export_model, it is loaded
+# from there instead of the checkpoint, which is faster and lets processes share the memory of the weights.
+# If draft_layers is not 0, samples are decoded speculatively: a draft model made of the first draft_layers layers of
+# the model proposes draft_tokens tokens at a time and the model checks them all in one step, which gives the same
+# distribution of samples in fewer sequential steps of the whole model. The export has no draft model, so the
+# checkpoint is loaded instead while it is enabled.
+# If sliding_window is true, samples can be longer than the context of the model. Once the cache of a batch is full, the
+# window_shift oldest tokens after the prompt are dropped from it and decoding continues from the rest of the cache
+# without computing it again. This is an approximation: the tokens kept were encoded at their original positions and
+# the model never sees the dropped tokens again, so text far beyond the context drifts from the prompt. Prompts longer
+# than half of the context are not extended beyond it.
+# The backend runs the model. 'tensorflow' runs it with gpt2 in a TensorFlow session. 'numpy' runs it with NumPy alone
+# from the export at the precision above, so TensorFlow is never imported, which starts faster and uses less memory.
+# The export must be made with the tensorflow backend first, and the numpy backend does not decode speculatively.
+MODEL_CONFIG = {
+    'backend': 'tensorflow',
+    'precision': 'float32',
+    'export_directory': 'export',
+    'draft_layers': 0,
+    'draft_tokens': 4,
+    'sliding_window': False,
+    'window_shift': 256
+}
+BACKENDS = ['tensorflow', 'numpy']
+# The hyperparameters of gpt2 that the hparams.json of the model overrides, as in gpt2.model.default_hparams
+DEFAULT_HPARAMS = {
+    'n_vocab': 0,
+    'n_ctx': 1024,
+    'n_embd': 768,
+    'n_head': 12,
+    'n_layer': 12
+}
+# In best-of mode, more samples are generated than are returned and they are ranked by the mean log probability the
+# model gave their tokens, accumulated while they are sampled. Once a sample has prune_after tokens, it is pruned after
+# any chunk in which its mean is more than prune_margin below that of the sample ranked last of those returned among the
+# samples of its prompt so far, so that no more decode steps are spent on it. A prune_margin of None disables pruning.
+BEST_OF_CONFIG = {
+    'prune_after': 64,
+    'prune_margin': 1.0
+}
+# Where generated samples are cached on disk and the most space they may take up. Samples are only cached when the
+# 'seed' argument is set, since otherwise the same prompt is meant to give different samples. None disables the cache.
+CACHE_CONFIG = {
+    'directory': None,
+    'max_megabytes': 256
+}
+# The fields of MODEL_CONFIG that change the samples generated for a seed, which are part of the key of each sample in
+# the result cache so that samples generated with other settings are never returned
+CACHE_KEY_MODEL_CONFIG = ['backend', 'precision', 'draft_layers', 'draft_tokens', 'sliding_window', 'window_shift']
 # A dictionary from argument names to a lambda that determines how to parse the string representing its value
 GENERATE_ARGUMENT_PARSER = {
     'model_name': lambda s: s,
@@ -24,78 +93,652 @@ GENERATE_ARGUMENT_PARSER = {
     'temperature': lambda f: float(f),
     'top_k': lambda i: int(i),
     'top_p': lambda f: float(f),
+    'seed': lambda i: int(i),
     'include_prefix': lambda b: b == 'True',
     'return_as_list': lambda b: b == 'True',
     'truncate': lambda s: s
 }
+# The headers the model expects before the title and before the initial content of an article
+TITLE_HEADER = '<|startoftext|>\n' + ('=' * 5) + 'TITLE' + ('=' * 5) + '\n'
+CONTENT_HEADER = '\n' + ('=' * 5) + 'CONTENT' + ('=' * 5) + '\n'
+MAX_BATCH_SIZE = 32  # The largest number of samples that are decoded together in a single batch
+BATCH_MEMORY_FRACTION = 0.5  # The fraction of the available memory that a batch of samples is allowed to use
+# The number of tokens decoded between checks for the truncate substring. Shorter chunks stop sooner after the end of a
+# sample, but copy the cache of the batch out of and back into the session more often.
+DECODE_CHUNK_SIZE = 32
+STREAM_CHUNK_SIZE = 8  # The largest number of tokens decoded between each piece of text yielded while streaming
+ENCODING_CACHE_SIZE = 4096  # The number of titles and initial contents whose tokens are remembered
+SPECIAL_TOKEN_PATTERN = re.compile('<\\|[^|>]*\\|>')  # Matches substrings that start with '<|' and end with '|>'
+REPEATED_SPACES_PATTERN = re.compile('  +')
 
 
 class Gpt2Handler:
     """This class respects the singleton design pattern and handles interacting with gpt2 to generate text."""
     __instance = None
+    __instance_lock = threading.Lock()
 
     @classmethod
     def get_instance(cls):
-        """Return the instance of this class. If it doesn't exist construct it first."""
-        if cls.__instance is None:
-            cls()
-        return cls.__instance
-
-    def __init__(self):
-        """Initialise a Gpt2Handler instance if there is none. For internal use only."""
-        if Gpt2Handler.__instance is None:
+        """Return the instance of this class. If it doesn't exist construct it first.
+        TensorFlow is only imported and the model only loaded when the instance is first constructed. Other threads
+        calling this in the meantime wait until the model is loaded."""
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                try:
+                    cls()
+                except Exception:
+                    cls.__instance = None  # Allow constructing it again, for example once the model is in place
+                    raise
+            return cls.__instance
+
+    def __init__(self, run_name=None):
+        """Initialise a Gpt2Handler instance if there is none. For internal use only.
+        ModelRegistry passes a run_name to load another model alongside the instance. Each instance has its own graph
+        and session."""
+        if run_name is not None:
+            pass  # Not the instance, so it does not count towards the singleton
+        elif Gpt2Handler.__instance is None:
             Gpt2Handler.__instance = self
         else:
             raise Exception("Attempted initialisation of singleton class Generator.")
 
-        # Start the TensorFlow session and load the model into it.
-        self.sess = gpt2.start_tf_sess()
-        self.run_name = DEFAULT_CONFIG['run_name']
-        self.download_model()
-        self.load_model()
+        from result_cache import ResultCache
+        from tuning import load_profile
+
+        # Use the threads and the largest batch size tuned for this host by tuning.tune for the number of processes
+        # generating on it, unless the threads are set
+        profile = load_profile(num_workers=SESSION_CONFIG['num_workers'])
+        for key in ('intra_op_threads', 'inter_op_threads'):
+            if not SESSION_CONFIG[key]:
+                SESSION_CONFIG[key] = profile.get(key, 0)
+        self.max_batch_size = profile.get('batch_size', MAX_BATCH_SIZE)
+
+        # Start the TensorFlow session, unless the numpy backend is used, and load the model
+        metrics = Metrics.get_instance()
+        self.sess = None
+        if MODEL_CONFIG['backend'] == 'tensorflow':
+            with metrics.time('session_start'):
+                self.sess = self.start_session()
+        self.run_name = run_name or DEFAULT_CONFIG['run_name']
+        with metrics.time('model_load'):
+            self.download_model()
+            self.hparams = self.load_hparams(self.run_name)
+            self.enc = self.load_encoder()
+            self.sampler = self.load_sampler()
+            # Every prompt starts with the title header, so its cache is computed once and every sample resumes from it
+            self.header_tokens = self.enc.encode(TITLE_HEADER)
+            self.header_past = self.sampler.compute_past([self.header_tokens])
+
+        # Titles and initial contents repeat across samples and requests, so the tokens of each are remembered. The
+        # cache holds the encoder rather than a bound method, so that it does not keep the instance alive in a cycle.
+        self.encode_cached = functools.lru_cache(maxsize=ENCODING_CACHE_SIZE)(
+            functools.partial(self.encode_text, self.enc))
+        self.special_token_ids = {self.enc.encoder['<|endoftext|>']}
+        self.cache = None
+        if CACHE_CONFIG['directory']:
+            self.cache = ResultCache(CACHE_CONFIG['directory'], CACHE_CONFIG['max_megabytes'] * 1024 * 1024)
+
+    def close(self):
+        """Close the TensorFlow session of the model, if it has one, and drop the sampler, so that the graph and the
+        weights are released. The model cannot generate once it is closed."""
+        if self.sess is not None:
+            self.sess.close()
+            self.sess = None
+        self.sampler = None
+        self.header_past = None
+
+    @staticmethod
+    def start_session():
+        """Start and return a TensorFlow session configured like gpt2.start_tf_sess, using SESSION_CONFIG, with a graph
+        of its own so that several models can be loaded side by side."""
+        import tensorflow as tf
+        from tensorflow.core.protobuf import rewriter_config_pb2
+
+        config = tf.compat.v1.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+        config.intra_op_parallelism_threads = SESSION_CONFIG['intra_op_threads']
+        config.inter_op_parallelism_threads = SESSION_CONFIG['inter_op_threads']
+        return tf.compat.v1.Session(graph=tf.Graph(), config=config)
 
     def download_model(self):
-        """Download the 124M gpt2 model if it is not downloaded"""
-        if not gpt2.is_gpt2_downloaded():
-            gpt2.download_gpt2()
+        """Download the gpt2 model named in DEFAULT_CONFIG if the encoder and hyperparameters read from it are not
+        downloaded. Its weights are not used, so a model folder with only those files in it is not downloaded again."""
+        model_path = self.get_model_path(self.run_name)
+        if DEFAULT_CONFIG.get('model_name') and not all(os.path.isfile(os.path.join(model_path, filename))
+                                                        for filename in ('encoder.json', 'hparams.json', 'vocab.bpe')):
+            import gpt_2_simple as gpt2
+
+            gpt2.download_gpt2(model_name=DEFAULT_CONFIG['model_name'])
+
+    def load_sampler(self):
+        """Load the model with the backend in MODEL_CONFIG and return the sampler that generates with it. A backend is
+        any sampler with the compute_past, score, sample and get_draft_acceptance_rate methods and the lookahead of
+        Sampler, whose caches have the same layout."""
+        if not 0 <= MODEL_CONFIG['draft_layers'] < self.hparams.n_layer:
+            raise ValueError(f'draft_layers is {MODEL_CONFIG["draft_layers"]}, but the draft model must have at least '
+                             f'0 and fewer than the {self.hparams.n_layer} layers of the model.')
+        if MODEL_CONFIG['draft_layers'] and MODEL_CONFIG['draft_tokens'] < 1:
+            raise ValueError(f'draft_tokens is {MODEL_CONFIG["draft_tokens"]}, but the draft model must propose at '
+                             f'least 1 token at a time.')
+        if MODEL_CONFIG['backend'] == 'numpy':
+            return self.load_numpy_model()
+        if MODEL_CONFIG['backend'] != 'tensorflow':
+            raise Exception(f'Unknown backend \'{MODEL_CONFIG["backend"]}\'. Use one of: {", ".join(BACKENDS)}.')
+
+        from export import is_exported, load_exported_model
+        from sampler import Sampler
+
+        # Build the sampling graph once, then finalise the graph so that nothing can be added to it per call
+        with self.sess.graph.as_default():
+            if is_exported(self.get_export_path()) and not MODEL_CONFIG['draft_layers']:
+                sampler = load_exported_model(self.sess, self.hparams, self.get_export_path())
+            elif MODEL_CONFIG['precision'] == 'int8':
+                sampler = self.load_quantized_model()
+            else:
+                self.load_model()
+                sampler = Sampler(self.sess, self.hparams, draft_layers=MODEL_CONFIG['draft_layers'],
+                                  draft_tokens=MODEL_CONFIG['draft_tokens'])
+        self.sess.graph.finalize()
+        return sampler
+
+    def load_numpy_model(self):
+        """Load the export of the model at MODEL_CONFIG['precision'] into a NumPy sampler and return it."""
+        from numpy_sampler import NumpySampler
+
+        if MODEL_CONFIG['draft_layers']:
+            raise Exception('The numpy backend does not decode speculatively. Set draft_layers to 0 or use the '
+                            'tensorflow backend.')
+        return NumpySampler.load(self.hparams, self.get_export_path())
 
     def load_model(self):
         """Load the gpt2 model. If it has already been loaded, reset it first."""
+        import gpt_2_simple as gpt2
+
         try:
             gpt2.load_gpt2(self.sess, run_name=self.run_name)
         except FileNotFoundError:
             raise Exception(f'Model is missing. Place \'{self.run_name}\' in the checkpoint folder and try again.')
 
-    def generate(self, title, initial_content='', num_samples=1, num_words=1023):
-        """Generate a sample with the specified title and initial content."""
-        initial_content = initial_content.replace('\n', ' ')  # Remove newlines
-        # Convert the input into the correct format for the model
-        prefix = '<|startoftext|>\n' \
-                 + ('=' * 5) + 'TITLE' + ('=' * 5) + '\n' + title + '\n' \
-                 + ('=' * 5) + 'CONTENT' + ('=' * 5) + '\n' + initial_content
+    def load_quantized_model(self):
+        """Build the sampling graph with int8 weights, load the checkpoint into them and return the sampler."""
+        from quantization import load_quantized_checkpoint, quantized_getter
+        from sampler import Sampler
+
+        sampler = Sampler(self.sess, self.hparams, custom_getter=quantized_getter,
+                          draft_layers=MODEL_CONFIG['draft_layers'], draft_tokens=MODEL_CONFIG['draft_tokens'])
+        load_quantized_checkpoint(self.sess, self.get_checkpoint_path())
+        return sampler
+
+    def export_model(self, precision=None):
+        """Export the sampling graph and the weights of the model at a precision, MODEL_CONFIG['precision'] by
+        default, to the export folder so that later instances load it from there. Return the path of the export."""
+        from export import export_model
+
+        precision = precision or MODEL_CONFIG['precision']
+        export_path = self.get_export_path(precision)
+        export_model(self.hparams, self.get_checkpoint_path(), export_path, precision)
+        return export_path
+
+    def get_checkpoint_path(self):
+        """Return the path of the latest checkpoint of the model."""
+        import tensorflow as tf
+
+        checkpoint_path = tf.train.latest_checkpoint(os.path.join('checkpoint', self.run_name))
+        if checkpoint_path is None:
+            raise Exception(f'Model is missing. Place \'{self.run_name}\' in the checkpoint folder and try again.')
+        return checkpoint_path
+
+    def get_export_path(self, precision=None):
+        """Return the path of the folder the model is exported to at a precision, MODEL_CONFIG['precision'] by
+        default."""
+        precision = precision or MODEL_CONFIG['precision']
+        return os.path.join(MODEL_CONFIG['export_directory'], f'{self.run_name}-{precision}')
+
+    @staticmethod
+    def load_hparams(run_name):
+        """Load and return the hyperparameters of the model run_name. They are read without gpt2, which would import
+        TensorFlow, and have the defaults of gpt2.model.default_hparams."""
+        hparams = dict(DEFAULT_HPARAMS)
+        with open(os.path.join(Gpt2Handler.get_model_path(run_name), 'hparams.json')) as f:
+            hparams.update(json.load(f))
+        return types.SimpleNamespace(**hparams)
+
+    def load_encoder(self):
+        """Load and return the encoder of the model. The encoder module of gpt2 is loaded on its own, since importing
+        gpt2 imports TensorFlow."""
+        spec = importlib.util.find_spec('gpt_2_simple')
+        encoder_spec = importlib.util.spec_from_file_location(
+            'gpt_2_simple.src.encoder', os.path.join(os.path.dirname(spec.origin), 'src', 'encoder.py'))
+        encoder = importlib.util.module_from_spec(encoder_spec)
+        encoder_spec.loader.exec_module(encoder)
+        return encoder.get_encoder(self.get_model_path(self.run_name))
+
+    @staticmethod
+    def get_model_path(run_name):
+        """Return the path of the folder gpt2 reads the encoder and hyperparameters of the model run_name from when
+        generating."""
+        if DEFAULT_CONFIG.get('model_name'):
+            return os.path.join('models', DEFAULT_CONFIG['model_name'])
+        return os.path.join('checkpoint', run_name)
+
+    def estimate_batch_size(self, num_tokens):
+        """Return the largest batch size whose samples fit in the available memory, capped at the batch size tuned for
+        this host or MAX_BATCH_SIZE."""
+        available_memory = self.get_available_memory()
+        if available_memory is None:
+            return self.max_batch_size
+
+        # Each sample keeps a float32 key and value vector per layer for every token in its context. The cache is
+        # concatenated on every step, so twice its final size is needed at the peak.
+        bytes_per_sample = 2 * 2 * self.hparams.n_layer * self.hparams.n_embd * num_tokens * 4
+        batch_size = int(available_memory * BATCH_MEMORY_FRACTION) // bytes_per_sample
+        return max(1, min(self.max_batch_size, batch_size))
+
+    @staticmethod
+    def get_available_memory():
+        """Return the number of bytes of physical memory currently available, or None if it cannot be determined."""
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):  # os.sysconf is not available on every platform
+            return None
 
+    def generate(self, title, initial_content='', num_samples=1, num_words=1023, batch_size=None):
+        """Generate a sample with the specified title and initial content.
+        Samples are decoded in batches of batch_size. If it is not specified, it is estimated from the available
+        memory."""
+        return [sample for sample, metadata in
+                self.generate_with_metadata(title, initial_content, num_samples, num_words, batch_size)]
+
+    def generate_with_metadata(self, title, initial_content='', num_samples=1, num_words=1023, batch_size=None):
+        """Generate samples like generate, but return a list of (sample, metadata) pairs. The metadata of a sample is a
+        dictionary with the number of tokens generated for it, the number of those tokens kept in the sample, and
+        whether it was truncated."""
+        return self.generate_many([(title, initial_content, num_samples, num_words)], batch_size)[0]
+
+    def generate_many(self, prompts, batch_size=None, seed_stream=0, as_tuple=False, stop=None, on_sample=None,
+                      score=False, num_best=None):
+        """Generate samples for several prompts together so that samples of different prompts can share batches.
+        Each prompt is a tuple of (title, initial content, number of samples, number of words). Return a list with the
+        (sample, metadata) pairs of each prompt, as generate_with_metadata would return them. If as_tuple is true, each
+        sample is instead a tuple in the form [title, content], built from its tokens with tokens_to_tuple.
+        If the 'seed' argument is set, each sample only depends on its prompt, its index within the prompt and the seed
+        stream, so that calls with a different seed_stream draw different random numbers. Such samples are read from
+        and written to the result cache if it is enabled.
+        If the threading.Event stop is set while the samples are generated, decoding stops after the current chunk and
+        None is returned. If on_sample is given, it is called with the prompt index, sample index, sample and metadata
+        of each sample as soon as it is finished.
+        If score is true, the metadata of each sample also has the log probability the model gave each token kept in
+        it, their sum and their mean, accumulated while it is sampled. If num_best is given, samples are scored and
+        only the num_best samples of each prompt with the highest mean are returned, best first, with the others pruned
+        while they are generated as described by BEST_OF_CONFIG. on_sample is then called with the rank of each sample
+        returned once every sample is finished."""
+        generate_args = self.parse_generate_arguments(DEFAULT_CONFIG)
+        use_cache = self.cache is not None and 'seed' in generate_args
+        metrics = Metrics.get_instance()
+        score = score or num_best is not None
+        notify = on_sample if num_best is None else None  # Samples are only known to be returned once all are ranked
+        results = []
+        prefixes, contexts, lengths, sample_ids, pending = [], [], [], [], []  # pending is where each sample goes
+        for prompt_index, (title, initial_content, num_samples, num_words) in enumerate(prompts):
+            prefix, context_tokens, length = self.create_prompt(title, initial_content, num_words)
+            results.append([None] * num_samples)
+            for sample_index in range(num_samples):
+                sample_id = (seed_stream << 24) + sample_index
+                key = None
+                if use_cache:
+                    key = self.get_cache_key(title, initial_content, num_words, sample_id, generate_args)
+                    cached = self.cache.get(key, required_metadata=['log_prob'] if score else [])
+                    if cached is not None:
+                        sample, metadata = cached
+                        results[prompt_index][sample_index] = (self.sample_to_tuple(sample) if as_tuple else sample,
+                                                               metadata)
+                        if notify is not None:
+                            notify(prompt_index, sample_index, *results[prompt_index][sample_index])
+                        continue
+
+                prefixes.append(prefix)
+                contexts.append(context_tokens)
+                lengths.append(length)
+                sample_ids.append(sample_id)
+                pending.append((prompt_index, sample_index, key))
+
+        log_probs = {} if score else None  # The log probability of each token sampled so far for each sample
+        prune = None
+        finished_scores = {}  # The mean log probability of each sample of each prompt that has finished
+        if num_best is not None and BEST_OF_CONFIG['prune_margin'] is not None:
+            prune = functools.partial(self.select_pruned, log_probs=log_probs, pending=pending,
+                                      finished_scores=finished_scores, num_best=num_best)
+            for prompt_index, samples in enumerate(results):
+                finished_scores[prompt_index] = [metadata['mean_log_prob'] for sample, metadata in filter(None, samples)
+                                                 if metadata['mean_log_prob'] is not None]
+
+        for index, tokens, finished in self.sample_batches(contexts, lengths, sample_ids, batch_size, generate_args,
+                                                           chunk_size=DECODE_CHUNK_SIZE, log_probs=log_probs,
+                                                           prune=prune):
+            if stop is not None and stop.is_set():
+                return None
+            if finished:
+                with metrics.time('post_processing'):
+                    sample, truncated = self.decode_sample(prefixes[index], tokens, generate_args)
+                    tokens_kept = self.count_kept_tokens(prefixes[index], tokens, generate_args.get('truncate'))
+                    metadata = {
+                        'tokens_generated': len(tokens),
+                        'tokens_kept': tokens_kept,
+                        'truncated': truncated
+                    }
+                    prompt_index, sample_index, key = pending[index]
+                    if score:
+                        metadata.update(self.get_scores(log_probs.pop(index)[:tokens_kept]))
+                        if metadata['mean_log_prob'] is not None:
+                            finished_scores.setdefault(prompt_index, []).append(metadata['mean_log_prob'])
+                    if use_cache:
+                        self.cache.put(key, sample, metadata)
+                    if as_tuple:
+                        title, initial_content = prompts[prompt_index][:2]
+                        sample = self.tokens_to_tuple(title, initial_content, tokens[:tokens_kept])
+                results[prompt_index][sample_index] = (sample, metadata)
+                if notify is not None:
+                    notify(prompt_index, sample_index, sample, metadata)
+
+        if num_best is not None:
+            results = [self.rank_samples(filter(None, samples))[:num_best] for samples in results]
+            if on_sample is not None:
+                for prompt_index, samples in enumerate(results):
+                    for rank, (sample, metadata) in enumerate(samples):
+                        on_sample(prompt_index, rank, sample, metadata)
+        return results
+
+    @staticmethod
+    def get_scores(token_log_probs):
+        """Return the metadata of a sample with the log probabilities of the tokens kept in it: each of them, their sum
+        and their mean, which is None if no tokens were kept."""
+        token_log_probs = [float(log_prob) for log_prob in token_log_probs]
+        log_prob = sum(token_log_probs)
+        return {
+            'log_prob': log_prob,
+            'mean_log_prob': log_prob / len(token_log_probs) if token_log_probs else None,
+            'token_log_probs': token_log_probs
+        }
+
+    @staticmethod
+    def rank_samples(samples):
+        """Return the (sample, metadata) pairs of scored samples from the highest mean log probability to the lowest.
+        Samples with no tokens kept come last."""
+        return sorted(samples, key=lambda pair: (pair[1]['mean_log_prob'] is not None, pair[1]['mean_log_prob'] or 0),
+                      reverse=True)
+
+    @staticmethod
+    def select_pruned(indices, log_probs, pending, finished_scores, num_best):
+        """Return the samples in indices to prune in best-of mode. A sample with at least BEST_OF_CONFIG['prune_after']
+        tokens is pruned if the mean log probability of its tokens so far is more than BEST_OF_CONFIG['prune_margin']
+        below the num_best-th highest mean among the samples of its prompt that have finished or are in the batch.
+        Pending holds the prompt index of each sample first, and finished_scores the means of the finished samples
+        of each prompt."""
+        scores = {index: sum(log_probs[index]) / len(log_probs[index]) for index in indices
+                  if len(log_probs[index]) >= BEST_OF_CONFIG['prune_after']}
+        prompt_scores = {}
+        for index, mean_log_prob in scores.items():
+            prompt_index = pending[index][0]
+            prompt_scores.setdefault(prompt_index, list(finished_scores.get(prompt_index, []))).append(mean_log_prob)
+
+        thresholds = {prompt_index: sorted(means, reverse=True)[num_best - 1] - BEST_OF_CONFIG['prune_margin']
+                      for prompt_index, means in prompt_scores.items() if len(means) > num_best}
+        return {index for index, mean_log_prob in scores.items()
+                if mean_log_prob < thresholds.get(pending[index][0], mean_log_prob)}
+
+    def get_cache_key(self, title, initial_content, num_words, sample_id, generate_args):
+        """Return the key a sample is stored under in the result cache, made from everything that determines it."""
+        return self.cache.get_key(run_name=self.run_name, title=title, initial_content=initial_content,
+                                  num_words=num_words, sample_id=sample_id, generate_args=generate_args,
+                                  model_config={key: MODEL_CONFIG[key] for key in CACHE_KEY_MODEL_CONFIG})
+
+    def get_cache_stats(self):
+        """Return the hit rate and other stats of the result cache as a dictionary, or None if it is disabled."""
+        return None if self.cache is None else self.cache.get_stats()
+
+    def generate_many_as_tuple(self, prompts, batch_size=None, stop=None):
+        """Generate samples for several prompts together like generate_many, and return a list with the samples of each
+        prompt as tuples in the form [title, content], or None if they were stopped."""
+        results = self.generate_many(prompts, batch_size, as_tuple=True, stop=stop)
+        if results is None:
+            return None
+        return [[sample for sample, metadata in samples] for samples in results]
+
+    def generate_stream(self, title, initial_content='', num_samples=1, num_words=1023, batch_size=None):
+        """Generate samples like generate, but yield (sample index, text, finished) as the text of each sample is
+        decoded instead of returning them at the end. Joining the text yielded for a sample gives the sample generate
+        would return. Finished is true for the last text yielded for a sample."""
+        prefix, context_tokens, length = self.create_prompt(title, initial_content, num_words)
         generate_args = self.parse_generate_arguments(DEFAULT_CONFIG)
-        samples = gpt2.generate(self.sess, prefix=prefix, nsamples=num_samples, length=num_words, **generate_args)
 
-        return samples
+        emitted = [''] * num_samples  # The text that has been yielded for each sample
+        for index, tokens, finished in self.sample_batches([context_tokens] * num_samples, [length] * num_samples,
+                                                           range(num_samples), batch_size, generate_args,
+                                                           chunk_size=STREAM_CHUNK_SIZE, ramp_up=True):
+            with Metrics.get_instance().time('post_processing'):
+                text, _ = self.decode_sample(prefix, tokens, generate_args, finished)
+            if len(text) > len(emitted[index]) or finished:
+                yield index, text[len(emitted[index]):], finished
+                emitted[index] = text
+
+    def create_prompt(self, title, initial_content, num_words):
+        """Return the prefix for the title and initial content, its tokens, and the number of tokens to sample."""
+        initial_content = initial_content.replace('\n', ' ')  # Remove newlines
+        prefix = TITLE_HEADER + title + CONTENT_HEADER + initial_content  # Convert the input into the model's format
+        with Metrics.get_instance().time('prompt_encoding'):
+            context_tokens = self.encode_prompt(title, initial_content)
+        if MODEL_CONFIG['sliding_window'] and len(context_tokens) <= self.hparams.n_ctx // 2:
+            return prefix, context_tokens, num_words
+        length = max(0, min(num_words, self.hparams.n_ctx - 1 - len(context_tokens) - self.sampler.lookahead))
+        return prefix, context_tokens, length
 
-    def generate_as_tuple(self, title, initial_content='', num_samples=1, num_words=1023):
+    def encode_prompt(self, title, initial_content):
+        """Return the tokens of the prefix for the title and initial content, using the remembered tokens of each.
+        The content header ends with a newline, which is always a token of its own unless it is followed by
+        whitespace, so the tokens of the title with its headers and of the initial content can be encoded apart."""
+        title_tokens = list(self.encode_cached(TITLE_HEADER + title + CONTENT_HEADER))
+        if not initial_content:
+            return title_tokens
+        if initial_content[0].isspace():
+            return self.enc.encode(TITLE_HEADER + title + CONTENT_HEADER + initial_content)
+        return title_tokens + list(self.encode_cached(initial_content))
+
+    @staticmethod
+    def encode_text(enc, text):
+        """Encode text into tokens with an encoder and return them as a tuple, so that they cannot be changed once
+        remembered."""
+        return tuple(enc.encode(text))
+
+    def sample_batches(self, contexts, lengths, sample_ids, batch_size, generate_args, chunk_size, ramp_up=False,
+                       log_probs=None, prune=None):
+        """Sample up to lengths[i] tokens after the tokens in contexts[i] for every sample i in batches of batch_size.
+        The random numbers sample i draws are selected by the seed and sample_ids[i] alone, so the same sample is
+        generated however the samples are batched.
+        Only samples whose contexts have the same number of tokens outside of the cached title header can share a
+        batch, so the samples are grouped by it first.
+        Each batch is decoded in chunks of up to chunk_size tokens, resuming from the cache of the previous chunk. If
+        ramp_up is true, the chunks start at a single token and double in length so the first tokens arrive sooner.
+        After each chunk, yield (sample index, tokens sampled so far, finished) for every sample still in the batch. A
+        sample is finished when it has its number of tokens or it reaches the truncate substring, at which point it
+        is removed from the batch so that no more decode steps are spent on it.
+        Once the cache of a batch is full, the oldest tokens after the prompt are dropped from it with slide_window. The
+        chunks are shortened to end where the cache is full, so this happens at the same tokens for any chunk sizes.
+        If log_probs is a dictionary, the log probability the model gave each token sampled for sample i is appended to
+        log_probs[i] along with it. If prune is given, it is called after each chunk with the indices of the samples
+        still in the batch, and the samples it returns are removed from the batch without being finished."""
+        max_context = self.hparams.n_ctx - 1 - self.sampler.lookahead  # The most tokens the model may be run on
+        if batch_size is None:
+            batch_size = self.estimate_batch_size(max((min(len(c) + n, max_context) for c, n in zip(contexts, lengths)),
+                                                      default=1))
+        seed = generate_args.get('seed', random.randrange(2 ** 31))
+        truncate = generate_args.get('truncate')
+        metrics = Metrics.get_instance()
+
+        groups = {}
+        for index, context_tokens in enumerate(contexts):
+            past, uncached_tokens = self.split_cached_prefix(context_tokens)
+            groups.setdefault((past is None, len(uncached_tokens)), []).append(index)
+        batches = [group[i:i + batch_size] for group in groups.values() for i in range(0, len(group), batch_size)]
+
+        for indices in batches:  # indices is the sample index of each row still in the batch
+            batch_past = self.split_cached_prefix(contexts[indices[0]])[0]
+            batch_context = [self.split_cached_prefix(contexts[index])[1] for index in indices]
+            tokens = {index: [] for index in indices}
+            offset = 0
+            for chunk_index in itertools.count():
+                remaining = max(lengths[index] for index in indices) - offset
+                chunk_length = min(chunk_size, 2 ** chunk_index if ramp_up else chunk_size, remaining)
+                if offset:  # Only samples that started within the context reach its end
+                    cache_length = batch_past.shape[-2] + 1  # The last sampled token is not in the cache yet
+                    if cache_length >= max_context:
+                        batch_past = self.slide_window(batch_past, len(contexts[indices[0]]),
+                                                       cache_length + 1 - max_context)
+                        cache_length = batch_past.shape[-2] + 1
+                    # Each chunk ends by the time the cache is full, so the window slides after the same tokens however
+                    # the chunks are sized, and streamed samples match those generated at once
+                    chunk_length = min(chunk_length, max_context - cache_length)
+                # Each sample draws its own random numbers, selected by the high bits of the second value of its seed
+                fetch_past = chunk_length < remaining
+                with metrics.time('decode', tokens=chunk_length * len(indices), steps=chunk_length):
+                    outputs = self.sampler.sample(batch_context, chunk_length, past=batch_past,
+                                                  temperature=generate_args.get('temperature', 0.7),
+                                                  top_k=generate_args.get('top_k', 0),
+                                                  top_p=generate_args.get('top_p', 0.0),
+                                                  seeds=[(seed, (sample_ids[index] << 32) + offset)
+                                                         for index in indices],
+                                                  fetch_past=fetch_past, fetch_log_probs=log_probs is not None)
+                chunk, *outputs = outputs if fetch_past or log_probs is not None else [outputs]
+                if fetch_past:
+                    batch_past = outputs.pop(0)
+                if log_probs is not None:
+                    chunk_log_probs = outputs.pop(0)
+                offset += chunk_length
+
+                active_rows = []
+                for row, index in enumerate(indices):
+                    row_tokens = tokens[index]
+                    num_new_tokens = lengths[index] - len(row_tokens)
+                    row_tokens.extend(chunk[row][:num_new_tokens])
+                    if log_probs is not None:
+                        log_probs.setdefault(index, []).extend(chunk_log_probs[row][:num_new_tokens])
+                    finished = len(row_tokens) == lengths[index] or self.reached_truncate(contexts[index], row_tokens,
+                                                                                          chunk_length, truncate)
+                    if not finished:
+                        active_rows.append(row)
+                    yield index, row_tokens, finished
+
+                if prune is not None and active_rows:
+                    pruned = prune([indices[row] for row in active_rows])
+                    active_rows = [row for row in active_rows if indices[row] not in pruned]
+                if not active_rows:
+                    break
+                # Resume the remaining rows from their last sampled token, which is not in the cache yet
+                indices = [indices[row] for row in active_rows]
+                batch_context = chunk[active_rows, -1:]
+                if len(active_rows) < len(chunk):
+                    batch_past = batch_past[active_rows]
+
+    def slide_window(self, past, prompt_length, num_tokens):
+        """Return a cache with at least num_tokens tokens dropped from it to make room for new ones. The prompt is kept,
+        and the oldest tokens after it are dropped MODEL_CONFIG['window_shift'] at a time, so that the cache is only
+        copied every so many tokens."""
+        import numpy as np
+
+        keep = min(prompt_length, self.hparams.n_ctx // 2)
+        num_tokens = max(num_tokens, min(MODEL_CONFIG['window_shift'], past.shape[-2] - keep))
+        return np.concatenate([past[..., :keep, :], past[..., keep + num_tokens:, :]], axis=-2)
+
+    def reached_truncate(self, context_tokens, tokens, num_new_tokens, truncate):
+        """Return whether the newest tokens of a sample have reached the truncate substring."""
+        if not truncate:
+            return False
+        # Every token is at least one byte long, so the substring starts at most len(truncate) tokens before them
+        num_tail_tokens = num_new_tokens + len(truncate)
+        tail = list(tokens[-num_tail_tokens:])
+        if len(tail) < num_tail_tokens:
+            tail = list(context_tokens[len(tail) - num_tail_tokens:]) + tail
+        return truncate in self.enc.decode(tail)
+
+    def count_kept_tokens(self, prefix, tokens, truncate):
+        """Return the number of tokens of a sample that are decoded before the truncate substring."""
+        text = prefix + self.enc.decode(tokens)
+        if not truncate or truncate not in text:
+            return len(tokens)
+
+        # Binary search for the largest number of tokens whose text ends before the truncate substring starts
+        end = text.index(truncate)
+        low, high = 0, len(tokens)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(prefix) + len(self.enc.decode(tokens[:middle])) <= end:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def split_cached_prefix(self, context_tokens):
+        """Return the cache of the title header and the context tokens following it if the context starts with it.
+        Otherwise return None and all of the context tokens, so that sampling starts from an empty cache."""
+        num_header_tokens = len(self.header_tokens)
+        if len(context_tokens) > num_header_tokens and context_tokens[:num_header_tokens] == self.header_tokens:
+            return self.header_past, context_tokens[num_header_tokens:]
+        return None, context_tokens
+
+    def decode_sample(self, prefix, tokens, generate_args, finished=True):
+        """Decode the tokens sampled after the prefix into text the same way gpt2.generate does, and return it with
+        whether the truncate substring was reached. If the sample is not finished, leave out the end of the text that
+        could still change when more tokens are decoded.
+        The prefix is the text of the context tokens, so only the sampled tokens need to be decoded."""
+        text = prefix + self.enc.decode(tokens)
+        truncate = generate_args.get('truncate')
+        truncated = bool(truncate) and truncate in text
+        if truncated:
+            text = text[:text.index(truncate)]
+        elif not finished:
+            text = text.rstrip('\ufffd')  # The bytes of a partially decoded character are decoded as '\ufffd'
+            if truncate:  # Leave out the start of the truncate substring if the text ends with it
+                for i in range(len(truncate) - 1, 0, -1):
+                    if text.endswith(truncate[:i]):
+                        text = text[:-i]
+                        break
+
+        if not generate_args.get('include_prefix', True):
+            text = text[len(prefix):]
+        return text.lstrip('\n'), truncated
+
+    def generate_as_tuple(self, title, initial_content='', num_samples=1, num_words=1023, batch_size=None):
         """Generate a sample as a tuple in the form [title, content] with the specified title and initial content."""
         return [self.sample_to_tuple(sample) for sample in
-                self.generate(title, initial_content, num_samples, num_words)]
+                self.generate(title, initial_content, num_samples, num_words, batch_size)]
+
+    def tokens_to_tuple(self, title, initial_content, tokens):
+        """Return a sample as sample_to_tuple would, but built from its prompt and the tokens kept in it instead of
+        from its text. The prompt does not need to be decoded, and special tokens are removed before the tokens are
+        decoded so the text rarely needs to be searched for them."""
+        generated_text = self.enc.decode([token for token in tokens if token not in self.special_token_ids])
+        return self.article_to_tuple(title + CONTENT_HEADER + initial_content.replace('\n', ' ') + generated_text)
 
     @staticmethod
     def sample_to_tuple(sample):
         """Take a sample and return a list where the first value is the title and the second value is the content."""
         # Remove the startoftext token and the title header
-        no_title_header = sample.split('<|startoftext|>\n' + ('=' * 5) + 'TITLE' + ('=' * 5) + '\n')[1]
+        return Gpt2Handler.article_to_tuple(sample.split(TITLE_HEADER, 1)[1])
+
+    @staticmethod
+    def article_to_tuple(article):
+        """Take the text of a sample after its title header and return a list where the first value is the title and
+        the second value is the content. Each regex is only run if the text contains what it matches."""
+        # Remove the start of any following article
+        article = article.split(TITLE_HEADER, 1)[0]
         # Remove any remaining tokens using a regex that matches substrings that start with '<|' and end with '|>'
-        no_tokens = re.sub('<\\|[^|>]*\\|>', '', no_title_header)
+        if '<|' in article:
+            article = SPECIAL_TOKEN_PATTERN.sub('', article)
         # Replace multiple adjacent spaces with a single space
-        no_repeating_spaces = re.sub(' +', ' ', no_tokens)
+        if '  ' in article:
+            article = REPEATED_SPACES_PATTERN.sub(' ', article)
         # Convert the sample into a list consisting of the title and sample without the sample header
-        split_sample = no_repeating_spaces.split('\n' + ('=' * 5) + 'CONTENT' + ('=' * 5) + '\n')[:2]
-        return split_sample
+        return article.split(CONTENT_HEADER, 2)[:2]
 
     @staticmethod
     def parse_generate_arguments(arguments):
@@ -1,3 +1,5 @@
+import queue
+import threading
 import tkinter as tk
 from tkinter import filedialog
 from tkinter import messagebox
@@ -16,6 +18,8 @@ class Gui:
     ROOT_PAD_Y = 2
     HOME_PAD_X = 2
     HOME_PAD_Y = 2
+    WARM_UP_POLL_MS = 100  # How often the GUI checks whether the model has finished loading in the background
+    JOB_POLL_MS = 50  # How often the GUI checks for text generated in the background
 
     @classmethod
     def get_instance(cls):
@@ -42,13 +46,106 @@ class Gui:
         self.initial_content_text = None
         self.number_of_samples = None
         self.words_per_sample = None
+        self.cancel_button = None
+        self.status_label = None
+
+        # Model warm up
+        self.warm_up_thread = None
+        self.warm_up_error = None
+
+        # Generation jobs. The worker thread takes jobs off the queue in order, and active_jobs holds every job that has
+        # been submitted and not finished, in the same order.
+        self.jobs = queue.Queue()
+        self.active_jobs = []
+        self.worker_thread = None
 
         self.create_gui()
 
     def start(self):
-        """Launch the gui window."""
+        """Launch the gui window and load the model in the background while it is open."""
+        self.warm_up_thread = threading.Thread(target=self.warm_up, daemon=True)
+        self.warm_up_thread.start()
+        self.worker_thread = threading.Thread(target=self.process_jobs, daemon=True)
+        self.worker_thread.start()
+        self.root.after(self.WARM_UP_POLL_MS, self.check_warm_up)
+        self.root.after(self.JOB_POLL_MS, self.check_jobs)
         self.root.mainloop()
 
+    def warm_up(self):
+        """Load the model. This runs on a background thread so it must not touch any widgets."""
+        try:
+            Generator.get_instance().warm_up()
+        except Exception as e:
+            self.warm_up_error = e
+
+    def check_warm_up(self):
+        """Update the status label once the model has finished loading, or check again later if it has not."""
+        if self.warm_up_thread.is_alive():
+            self.root.after(self.WARM_UP_POLL_MS, self.check_warm_up)
+        elif self.warm_up_error:
+            self.status_label.config(text='The model could not be loaded.')
+            messagebox.showerror('Error', str(self.warm_up_error))
+        elif not self.active_jobs:
+            self.status_label.config(text='Model loaded.')
+
+    def process_jobs(self):
+        """Generate the samples of each job on the queue in turn and put the text generated on the events queue of the
+        job, followed by None once it is finished. This runs on a background thread so it must not touch any widgets."""
+        while True:
+            job = self.jobs.get()
+            try:
+                if not job.cancelled.is_set():
+                    stream = Generator.get_instance().generate_stream(job.title, job.initial_content, job.num_samples,
+                                                                      job.num_words)
+                    for event in stream:
+                        job.events.put(event)
+                        if job.cancelled.is_set():
+                            stream.close()  # Stop decoding the remaining samples
+                            break
+            except Exception as e:
+                job.events.put(e)
+            job.events.put(None)
+
+    def check_jobs(self):
+        """Show the text generated in the background since the last check, then check again later."""
+        for job in list(self.active_jobs):
+            while True:
+                try:
+                    event = job.events.get_nowait()
+                except queue.Empty:
+                    break
+
+                if event is None:
+                    self.active_jobs.remove(job)
+                    if not self.active_jobs:
+                        self.status_label.config(text='Cancelled.' if job.cancelled.is_set() else 'Finished.')
+                    break
+                elif isinstance(event, Exception):
+                    messagebox.showerror('Error', str(event))
+                else:
+                    self.update_job(job, *event)
+
+        if self.active_jobs:
+            self.status_label.config(text=self.active_jobs[0].get_progress(len(self.active_jobs) - 1))
+        self.cancel_button.config(state='normal' if self.active_jobs else 'disabled')
+        self.root.after(self.JOB_POLL_MS, self.check_jobs)
+
+    def update_job(self, job, index, text, finished):
+        """Add text generated for a sample of a job, and show it in the sample viewer of the job. The sample viewer is
+        opened once the first sample is finished."""
+        previous_content = job.get_content(index)
+        job.articles[index] += text
+        job.finished[index] = job.finished[index] or finished
+        if job.sample_viewer is None:
+            if finished and not job.cancelled.is_set():
+                job.sample_viewer = Gui.SampleViewer([[job.title, job.get_content(i)] for i in range(job.num_samples)])
+            return
+
+        try:
+            job.sample_viewer.append_to_sample(index, job.get_content(index)[len(previous_content):])
+        except tk.TclError:  # The sample viewer was closed, so the rest of the samples are not needed
+            job.cancelled.set()
+
     def create_gui(self):
         """Create the gui window and populate it with the relevant components."""
         # Window
@@ -113,12 +210,24 @@ class Gui:
         words_per_sample_spinbox.grid(row=3, column=1, columnspan=2, padx=self.HOME_PAD_X, pady=self.HOME_PAD_Y,
                                       sticky=tk.W)
 
+        # Buttons
+        buttons_frame = tk.Frame(self.home)
+        buttons_frame.grid(row=4, column=1, columnspan=2, padx=self.HOME_PAD_X, pady=self.HOME_PAD_Y)
         # Generate Button
-        generate_button = tk.Button(self.home, text='Generate', command=self.submit)
-        generate_button.grid(row=4, column=1, columnspan=2, padx=self.HOME_PAD_X, pady=self.HOME_PAD_Y)
+        generate_button = tk.Button(buttons_frame, text='Generate', command=self.submit)
+        generate_button.pack(side=tk.LEFT, padx=self.HOME_PAD_X)
+        # Cancel Button
+        self.cancel_button = tk.Button(buttons_frame, text='Cancel', command=self.cancel, state='disabled')
+        self.cancel_button.pack(side=tk.LEFT, padx=self.HOME_PAD_X)
+
+        # Status
+        self.status_label = tk.Label(self.home, text='Loading the model...', justify=tk.LEFT,
+                                     wraplength=self.MIN_WINDOW_WIDTH)
+        self.status_label.grid(row=5, column=0, columnspan=3, padx=self.HOME_PAD_X, pady=self.HOME_PAD_Y, sticky=tk.W)
 
     def submit(self):
-        """Submit the text in the fields to gpt2 and launch a window displaying the generated articles."""
+        """Queue the text in the fields to be submitted to gpt2. A window displaying the generated articles is launched
+        once the first one is finished."""
         try:
             number_of_samples = int(self.number_of_samples.get())  # Ensure the number of samples is an int
             assert number_of_samples > 0  # Ensure the number of samples is greater than 0
@@ -142,13 +251,16 @@ class Gui:
         # Retrieve the text from the initial content field
         initial_content = self.initial_content_text.get('1.0', tk.END).rstrip()
 
-        # Generate samples based on the user input
-        samples = Generator.get_instance().generate_as_tuple(title, initial_content, number_of_samples,
-                                                             words_per_sample)
+        # Generate the samples on the worker thread so that the window stays responsive
+        job = Gui.GenerationJob(title, initial_content, number_of_samples, words_per_sample)
+        self.active_jobs.append(job)
+        self.jobs.put(job)
 
-        # Display the generated samples
-        sample_viewer = Gui.SampleViewer(samples)
-        sample_viewer.start()
+    def cancel(self):
+        """Stop generating the samples of the job currently being generated."""
+        if self.active_jobs:
+            self.active_jobs[0].cancelled.set()
+            self.status_label.config(text='Cancelling...')
 
     def on_title_option_menu_update(self, value):
         """Update the contents of the title text based on the respective option menu value."""
@@ -186,6 +298,33 @@ class Gui:
                 option_menu.set('Text')
                 text_field.config(state='normal')
 
+    class GenerationJob:
+        """This inner class holds the samples of a submission while they are generated on the worker thread."""
+
+        def __init__(self, title, initial_content, num_samples, num_words):
+            """Initialise the job with the text in the fields when it was submitted."""
+            self.title = title
+            self.initial_content = initial_content
+            self.num_samples = num_samples
+            self.num_words = num_words
+
+            self.events = queue.Queue()  # (sample index, text, finished) for each piece of text generated
+            self.cancelled = threading.Event()
+            self.articles = [''] * num_samples  # Each article is made of its title and content separated by a newline
+            self.finished = [False] * num_samples
+            self.sample_viewer = None
+
+        def get_content(self, index):
+            """Return the content generated so far for a sample."""
+            return self.articles[index].partition('\n')[2]
+
+        def get_progress(self, num_queued):
+            """Return a description of the progress of each sample and the number of jobs queued behind this one."""
+            progress = ', '.join(f'{i + 1}: done' if self.finished[i] else
+                                 f'{i + 1}: {len(self.get_content(i).split())} words' for i in range(self.num_samples))
+            queued = f' ({num_queued} more queued)' if num_queued else ''
+            return f'Generating \'{self.title}\'{queued}. Samples {progress}'
+
     class SampleViewer:
         """This inner class is responsible for displaying articles to the user."""
         # Constants
@@ -216,7 +355,6 @@ class Gui:
             self.window = tk.Toplevel()
             self.window.title(self.title)
             self.window.resizable(False, False)
-            self.window.grab_set()
 
             self.create_buttons()
             self.update_buttons()
@@ -272,6 +410,14 @@ class Gui:
             self.sample_text.insert(tk.END, self.samples[self.current_sample_index])
             self.sample_text.configure(state='disabled')
 
+        def append_to_sample(self, index, text):
+            """Append text to the content of a sample, and to the displayed text if it is the current sample."""
+            self.samples[index] += text
+            if text and index == self.current_sample_index:
+                self.sample_text.configure(state='normal')
+                self.sample_text.insert(tk.END, text)
+                self.sample_text.configure(state='disabled')
+
         def update_buttons(self):
             """Disable/enable the buttons depending on the relative position of the currently selected sample."""
             if self.current_sample_index == 0:
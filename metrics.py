@@ -0,0 +1,152 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+# Whether timings are recorded. When disabled, timing a stage costs a dictionary lookup and an empty context manager.
+METRICS_CONFIG = {
+    'enabled': False
+}
+# The upper bounds in seconds of the buckets of the per-step decode latency histogram
+DECODE_STEP_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+METRIC_PREFIX = 'article_generator'
+# Every recorded stage is logged to this logger as a JSON object, for example to a file added with log_to_file
+logger = logging.getLogger('article_generator.metrics')
+NULL_TIMER = contextlib.nullcontext()
+
+
+class StageTimer:
+    """This class is a context manager that records how long the code inside it took as a stage of Metrics."""
+
+    def __init__(self, metrics, stage, tokens, steps):
+        """Initialise the timer for a stage that generates a number of tokens over a number of decode steps."""
+        self.metrics = metrics
+        self.stage = stage
+        self.tokens = tokens
+        self.steps = steps
+        self.start = None
+
+    def __enter__(self):
+        """Start timing the stage."""
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop timing the stage and record it, unless it raised an exception."""
+        if exc_type is None:
+            self.metrics.record(self.stage, time.perf_counter() - self.start, self.tokens, self.steps)
+
+
+class Metrics:
+    """This class respects the singleton design pattern and collects the time spent in each stage of generation, the
+    tokens generated per second and the latency of each decode step, while METRICS_CONFIG['enabled'] is true."""
+    __instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """Return the instance of this class. If it doesn't exist construct it first."""
+        if cls.__instance is None:
+            cls()
+        return cls.__instance
+
+    def __init__(self):
+        """Initialise a Metrics instance if there is none. For internal use only."""
+        if Metrics.__instance is None:
+            Metrics.__instance = self
+        else:
+            raise Exception("Attempted initialisation of singleton class Metrics.")
+
+        self.lock = threading.Lock()
+        self.stages = {}  # The count, total seconds, largest seconds and tokens of each stage
+        self.decode_step_counts = [0] * (len(DECODE_STEP_BUCKETS) + 1)  # The last bucket is for anything larger
+        self.decode_step_seconds = 0.0
+
+    @staticmethod
+    def enable():
+        """Start recording timings."""
+        METRICS_CONFIG['enabled'] = True
+
+    @staticmethod
+    def log_to_file(filename):
+        """Start recording timings and append each one to a file as a JSON object per line."""
+        Metrics.enable()
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    def time(self, stage, tokens=0, steps=0):
+        """Return a context manager that records the time spent inside it as the stage, if timings are being recorded.
+        Tokens is the number of tokens generated in the stage and steps the number of decode steps taken."""
+        if not METRICS_CONFIG['enabled']:
+            return NULL_TIMER
+        return StageTimer(self, stage, tokens, steps)
+
+    def record(self, stage, seconds, tokens=0, steps=0):
+        """Record that a stage took a number of seconds, and log it."""
+        with self.lock:
+            count, total, largest, total_tokens = self.stages.get(stage, (0, 0.0, 0.0, 0))
+            self.stages[stage] = (count + 1, total + seconds, max(largest, seconds), total_tokens + tokens)
+            if steps:
+                # Every step of a chunk of decode steps is counted as taking the average time of the chunk
+                step_seconds = seconds / steps
+                bucket = next((i for i, bound in enumerate(DECODE_STEP_BUCKETS) if step_seconds <= bound),
+                              len(DECODE_STEP_BUCKETS))
+                self.decode_step_counts[bucket] += steps
+                self.decode_step_seconds += seconds
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'time': time.time(), 'pid': os.getpid(), 'stage': stage, 'seconds': seconds,
+                                    'tokens': tokens, 'steps': steps}))
+
+    def get_stats(self):
+        """Return a dictionary from each stage to its count, total, mean and largest seconds, and the number of tokens
+        generated in it and per second."""
+        with self.lock:
+            stages = dict(self.stages)
+        return {stage: {
+            'count': count,
+            'seconds': total,
+            'mean_seconds': total / count,
+            'max_seconds': largest,
+            'tokens': total_tokens,
+            'tokens_per_second': total_tokens / total if total_tokens and total else None
+        } for stage, (count, total, largest, total_tokens) in stages.items()}
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            stages = sorted(self.stages.items())
+            decode_step_counts = list(self.decode_step_counts)
+            decode_step_seconds = self.decode_step_seconds
+
+        lines = [f'# HELP {METRIC_PREFIX}_stage_seconds Time spent in each stage of generation.',
+                 f'# TYPE {METRIC_PREFIX}_stage_seconds summary']
+        for stage, (count, total, largest, total_tokens) in stages:
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{METRIC_PREFIX}_stage_seconds_count{{stage="{stage}"}} {count}')
+        lines += [f'# HELP {METRIC_PREFIX}_tokens_total Tokens generated in each stage of generation.',
+                  f'# TYPE {METRIC_PREFIX}_tokens_total counter']
+        lines += [f'{METRIC_PREFIX}_tokens_total{{stage="{stage}"}} {total_tokens}'
+                  for stage, (count, total, largest, total_tokens) in stages if total_tokens]
+        lines += [f'# HELP {METRIC_PREFIX}_tokens_per_second Tokens generated per second spent in each stage.',
+                  f'# TYPE {METRIC_PREFIX}_tokens_per_second gauge']
+        lines += [f'{METRIC_PREFIX}_tokens_per_second{{stage="{stage}"}} {total_tokens / total}'
+                  for stage, (count, total, largest, total_tokens) in stages if total_tokens and total]
+
+        lines += [f'# HELP {METRIC_PREFIX}_decode_step_seconds Latency of each decode step.',
+                  f'# TYPE {METRIC_PREFIX}_decode_step_seconds histogram']
+        cumulative_count = 0
+        for bound, count in zip(DECODE_STEP_BUCKETS + ['+Inf'], decode_step_counts):
+            cumulative_count += count
+            lines.append(f'{METRIC_PREFIX}_decode_step_seconds_bucket{{le="{bound}"}} {cumulative_count}')
+        lines.append(f'{METRIC_PREFIX}_decode_step_seconds_sum {decode_step_seconds}')
+        lines.append(f'{METRIC_PREFIX}_decode_step_seconds_count {cumulative_count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """Write the metrics to a file in the Prometheus text exposition format."""
+        with open(filename, 'w') as f:
+            f.write(self.to_prometheus())
@@ -0,0 +1,223 @@
+import contextlib
+import queue
+import threading
+from collections import Counter, OrderedDict
+
+from gpt2handler import DEFAULT_CONFIG, MODEL_CONFIG, Gpt2Handler
+
+# The most memory the weights of the loaded models may take up together, and the number of most requested models that
+# are loaded in the background before they are requested again, as long as they fit without unloading another model.
+# Preload lists run names loaded in the background when the registry is created. Set these before it is created.
+REGISTRY_CONFIG = {
+    'memory_budget_megabytes': 4096,
+    'preload_count': 2,
+    'preload': []
+}
+
+
+def estimate_model_bytes(hparams, precision):
+    """Return an estimate of the bytes of memory the weights of a model with hparams take up at a precision. The
+    matrices are one byte per weight at 'int8' and everything else is four."""
+    n_embd = hparams.n_embd
+    matrix_weights = hparams.n_vocab * n_embd + hparams.n_layer * 12 * n_embd * n_embd
+    other_weights = hparams.n_ctx * n_embd + hparams.n_layer * 13 * n_embd + 2 * n_embd  # Biases, norms and positions
+    return matrix_weights * (1 if precision == 'int8' else 4) + other_weights * 4
+
+
+class ModelRegistry:
+    """This class respects the singleton design pattern and keeps several models loaded at once, each in a Gpt2Handler
+    with its own graph and session, so that requests can name the run_name of the model they generate with.
+    The loaded models are kept in order of use. Before a model is loaded, the least recently used models are unloaded
+    until the estimated memory of the weights fits in the memory budget. Requests generate with a model inside
+    use_model, which counts them, and an unloaded model has its session closed as soon as no request is still
+    generating with it. The most requested models that are not loaded are loaded on a background thread if they fit
+    without unloading another."""
+    __instance = None
+    __instance_lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """Return the instance of this class. If it doesn't exist construct it first."""
+        with cls.__instance_lock:
+            if cls.__instance is None:
+                cls()
+            return cls.__instance
+
+    def __init__(self):
+        """Initialise a ModelRegistry instance if there is none and start preloading REGISTRY_CONFIG['preload'].
+        For internal use only."""
+        if ModelRegistry.__instance is None:
+            ModelRegistry.__instance = self
+        else:
+            raise Exception("Attempted initialisation of singleton class ModelRegistry.")
+
+        self.memory_budget = REGISTRY_CONFIG['memory_budget_megabytes'] * 1024 * 1024
+        self.lock = threading.Lock()
+        self.models = OrderedDict()  # The loaded handler of each run name, from the least to the most recently used
+        self.model_bytes = {}  # The estimated memory of each model loaded or being loaded
+        self.loading = {}  # An event set once each model being loaded is loaded or has failed to load
+        self.users = {}  # The number of requests generating with each handler in use
+        self.unloaded = set()  # The handlers that were unloaded while in use, closed once they are no longer used
+        self.request_counts = Counter()
+        self.loads = 0
+        self.evictions = 0
+
+        self.preload_queue = queue.Queue()
+        self.preloading = set()  # The run names queued to be preloaded
+        self.preload_thread = threading.Thread(target=self.preload_models, daemon=True)
+        self.preload_thread.start()
+        for run_name in REGISTRY_CONFIG['preload']:
+            self.queue_preload(run_name)
+
+    @contextlib.contextmanager
+    def use_model(self, run_name=None):
+        """Return a context manager that gives the handler of the model run_name like get_model, and keeps its session
+        open until the context exits even if the model is unloaded in the meantime."""
+        handler = self.get_model(run_name, acquire=True)
+        try:
+            yield handler
+        finally:
+            self.release(handler)
+
+    def get_model(self, run_name=None, acquire=False):
+        """Return the handler of the model run_name, loading it if it is not loaded. Other threads asking for a model
+        while it is loaded wait for it rather than loading it again. The model in DEFAULT_CONFIG['run_name'], which is
+        also the default, is the instance of Gpt2Handler, which stays loaded outside the memory budget.
+        If acquire is true, the handler counts as in use until it is passed to release."""
+        if not run_name or run_name == DEFAULT_CONFIG['run_name']:
+            return Gpt2Handler.get_instance()
+        with self.lock:
+            self.request_counts[run_name] += 1
+            most_requested = [name for name, _ in self.request_counts.most_common(REGISTRY_CONFIG['preload_count'])]
+        handler = self.load(run_name, acquire=acquire)
+        for name in most_requested:
+            self.queue_preload(name)
+        return handler
+
+    def release(self, handler):
+        """Stop counting a handler acquired with get_model as in use, and close it if it was unloaded and this was its
+        last use."""
+        with self.lock:
+            if handler not in self.users:  # The instance of Gpt2Handler, which is never unloaded
+                return
+            self.users[handler] -= 1
+            if self.users[handler]:
+                return
+            del self.users[handler]
+            if handler not in self.unloaded:
+                return
+            self.unloaded.remove(handler)
+        handler.close()
+
+    def load(self, run_name, preload=False, acquire=False):
+        """Return the handler of the model run_name, loading it first if it is not loaded. If preload is true, only load
+        it if it fits in the memory budget without unloading another model, and return None otherwise. If acquire is
+        true, the handler counts as in use until it is passed to release."""
+        while True:
+            with self.lock:
+                if run_name in self.models:
+                    self.models.move_to_end(run_name)
+                    handler = self.models[run_name]
+                    if acquire:
+                        self.users[handler] = self.users.get(handler, 0) + 1
+                    return handler
+                loading = self.loading.get(run_name)
+                if loading is None:
+                    model_bytes = self.estimate_bytes(run_name)
+                    if preload and self.get_used_bytes() + model_bytes > self.memory_budget:
+                        return None
+                    unloaded = self.evict(model_bytes)
+                    self.loading[run_name] = loading = threading.Event()
+                    self.model_bytes[run_name] = model_bytes  # Counted while it loads, so others leave room for it
+                    break
+            loading.wait()  # Another thread is loading it. If that failed, try loading it here instead.
+
+        for old_handler in unloaded:  # Closed outside the lock, since closing a session can take a while
+            old_handler.close()
+        handler = None
+        try:
+            handler = Gpt2Handler(run_name)
+        finally:
+            with self.lock:
+                del self.loading[run_name]
+                if handler is None:
+                    del self.model_bytes[run_name]
+                else:
+                    self.models[run_name] = handler
+                    self.model_bytes[run_name] = estimate_model_bytes(handler.hparams, MODEL_CONFIG['precision'])
+                    self.loads += 1
+                    if acquire:
+                        self.users[handler] = self.users.get(handler, 0) + 1
+                    if preload:  # It has not been requested yet, so unload it before the models that have been
+                        self.models.move_to_end(run_name, last=False)
+            loading.set()
+        return handler
+
+    @staticmethod
+    def estimate_bytes(run_name):
+        """Return the estimated memory of the weights of the model run_name at MODEL_CONFIG['precision'], or 0 if its
+        hyperparameters have not been downloaded yet."""
+        try:
+            return estimate_model_bytes(Gpt2Handler.load_hparams(run_name), MODEL_CONFIG['precision'])
+        except FileNotFoundError:
+            return 0
+
+    def evict(self, model_bytes):
+        """Unload the least recently used models until a model taking up model_bytes fits in the memory budget along
+        with the other models, and return the handlers that are not in use so the caller can close them. Handlers in
+        use are closed by release once their last request finishes. Call this with the lock held."""
+        unused = []
+        while self.models and self.get_used_bytes() + model_bytes > self.memory_budget:
+            run_name, handler = self.models.popitem(last=False)
+            del self.model_bytes[run_name]
+            self.evictions += 1
+            if handler in self.users:
+                self.unloaded.add(handler)
+            else:
+                unused.append(handler)
+        return unused
+
+    def get_used_bytes(self):
+        """Return the estimated memory of the models loaded and being loaded. Call this with the lock held."""
+        return sum(self.model_bytes.values())
+
+    def queue_preload(self, run_name):
+        """Queue a model to be loaded on the preload thread, unless it is loaded or already queued."""
+        with self.lock:
+            if run_name in self.models or run_name in self.loading or run_name in self.preloading or \
+                    run_name == DEFAULT_CONFIG['run_name']:
+                return
+            self.preloading.add(run_name)
+        self.preload_queue.put(run_name)
+
+    def preload_models(self):
+        """Load the models queued to be preloaded, one at a time, until a None run name is queued."""
+        while True:
+            run_name = self.preload_queue.get()
+            if run_name is None:
+                return
+            try:
+                self.load(run_name, preload=True)
+            except Exception:  # The model will be loaded again when it is requested, which reports the error
+                pass
+            with self.lock:
+                self.preloading.discard(run_name)
+
+    def get_stats(self):
+        """Return a dictionary with the loaded models from the least to the most recently used, their estimated memory
+        in bytes, the memory budget, the number of models loaded and unloaded, and the number of unloaded models still
+        in use."""
+        with self.lock:
+            return {
+                'models': list(self.models),
+                'bytes': self.get_used_bytes(),
+                'memory_budget': self.memory_budget,
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'closing': len(self.unloaded)
+            }
+
+    def close(self):
+        """Stop the preload thread once the models already queued have been preloaded."""
+        self.preload_queue.put(None)
+        self.preload_thread.join()
@@ -0,0 +1,176 @@
+import asyncio
+import queue
+import threading
+import weakref
+
+MAX_PENDING_REQUESTS = 64  # The most requests of an event loop that may be waiting or generating at once
+MAX_BATCH_SAMPLES = 32  # The most samples of waiting requests that are generated together in one batch
+
+
+def set_future(future, result=None, error=None):
+    """Set the result or the exception of an asyncio future, unless its caller has cancelled it. Call this on the event
+    loop of the future."""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class ModelRequest:
+    """This class holds a request from a coroutine while the model thread generates its samples."""
+
+    def __init__(self, loop, prompt, stream=False):
+        """Initialise a request made on an event loop for a (title, initial content, number of samples, number of words)
+        prompt. A streamed request receives its text as events rather than all at once."""
+        self.loop = loop
+        self.prompt = prompt
+        self.stream = stream
+        self.future = loop.create_future()  # The articles of a request that is not streamed
+        self.events = asyncio.Queue()  # (sample index, text, finished) for each piece of text streamed, then None
+        self.cancelled = threading.Event()
+        self.batch = None  # The requests generated together with this one, once they have started
+        self.stop = None  # Set to stop generating the batch
+
+    def call_soon(self, function, *args):
+        """Call a function on the event loop of the request from another thread, unless the loop has been closed."""
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:  # Nobody is waiting for the request any more
+            pass
+
+
+class ModelThread:
+    """This class owns the model on a single background thread and generates the articles requested by coroutines on
+    it, so that generating never blocks an event loop.
+    The requests waiting when the thread becomes free are generated together in one batch, so that concurrent callers
+    share decode steps rather than queueing for the model one at a time. Each event loop may have up to
+    max_pending_requests requests waiting or generating, and further callers wait until one of them finishes.
+    A cancelled request is dropped if it has not started. A batch stops after its current chunk of tokens once every
+    request in it is cancelled, and a stream stops after its current piece of text."""
+
+    def __init__(self, generator, max_pending_requests=MAX_PENDING_REQUESTS, max_batch_samples=MAX_BATCH_SAMPLES):
+        """Start the thread that generates the requests with the model of a Generator."""
+        self.generator = generator
+        self.max_pending_requests = max_pending_requests
+        self.max_batch_samples = max_batch_samples
+
+        self.requests = queue.Queue()
+        self.next_request = None  # A request taken off the queue that could not join the last batch
+        self.lock = threading.Lock()  # Held while the batch of a request is started or cancelled
+        self.slots = weakref.WeakKeyDictionary()  # The semaphore limiting the pending requests of each event loop
+        self.thread = threading.Thread(target=self.process_requests, daemon=True)
+        self.thread.start()
+
+    def get_slots(self):
+        """Return the semaphore limiting the pending requests of the running event loop, creating it on first use."""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if loop not in self.slots:
+                self.slots[loop] = asyncio.Semaphore(self.max_pending_requests)
+            return self.slots[loop]
+
+    async def generate(self, title, initial_content, num_samples, num_words):
+        """Generate articles like Generator.generate on the model thread and return them once they are finished."""
+        async with self.get_slots():
+            request = ModelRequest(asyncio.get_running_loop(), (title, initial_content, num_samples, num_words))
+            self.requests.put(request)
+            try:
+                return await request.future
+            except asyncio.CancelledError:
+                self.cancel(request)
+                raise
+
+    async def generate_stream(self, title, initial_content, num_samples, num_words):
+        """Generate articles like Generator.generate_stream on the model thread, and yield (sample index, text,
+        finished) as the text of each article is decoded."""
+        async with self.get_slots():
+            request = ModelRequest(asyncio.get_running_loop(), (title, initial_content, num_samples, num_words),
+                                   stream=True)
+            self.requests.put(request)
+            try:
+                while True:
+                    event = await request.events.get()
+                    if event is None:
+                        return
+                    if isinstance(event, Exception):
+                        raise event
+                    yield event
+            finally:
+                self.cancel(request)  # Stop decoding if the caller stopped iterating before the end
+
+    def cancel(self, request):
+        """Cancel a request, and stop the batch it is in if every request in the batch is cancelled."""
+        with self.lock:
+            request.cancelled.set()
+            if request.batch is not None and all(other.cancelled.is_set() for other in request.batch):
+                request.stop.set()
+
+    def process_requests(self):
+        """Take requests off the queue and generate them, batching the requests that are waiting, until a None request
+        is received."""
+        while True:
+            request = self.next_request if self.next_request is not None else self.requests.get()
+            self.next_request = None
+            if request is None:
+                return
+            if request.cancelled.is_set():
+                continue
+            if request.stream:
+                self.process_stream(request)
+                continue
+
+            batch = [request]
+            num_samples = request.prompt[2]
+            while num_samples < self.max_batch_samples:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None or request.stream:  # Generate it once the batch is finished
+                    self.next_request = request
+                    break
+                if not request.cancelled.is_set():
+                    batch.append(request)
+                    num_samples += request.prompt[2]
+
+            self.process_batch(batch)
+
+    def process_batch(self, batch):
+        """Generate the articles of a batch of requests with a single call to the model and return them to each."""
+        stop = threading.Event()
+        with self.lock:
+            for request in batch:
+                request.batch, request.stop = batch, stop
+
+        try:
+            results = self.generator.get_model().generate_many_as_tuple([request.prompt for request in batch],
+                                                                        stop=stop)
+        except Exception as e:
+            for request in batch:
+                request.call_soon(set_future, request.future, None, e)
+            return
+
+        if results is None:  # Every request in the batch was cancelled
+            return
+        for request, samples in zip(batch, results):
+            request.call_soon(set_future, request.future, [sample[0] + '\n' + sample[1] for sample in samples])
+
+    def process_stream(self, request):
+        """Stream the text of a request as it is generated, stopping early if it is cancelled."""
+        try:
+            stream = self.generator.generate_stream(*request.prompt)
+            for event in stream:
+                request.call_soon(request.events.put_nowait, event)
+                if request.cancelled.is_set():
+                    stream.close()  # Stop decoding the remaining samples
+                    break
+        except Exception as e:
+            request.call_soon(request.events.put_nowait, e)
+        request.call_soon(request.events.put_nowait, None)
+
+    def close(self):
+        """Stop the thread once the requests already submitted have been generated."""
+        self.requests.put(None)
+        self.thread.join()
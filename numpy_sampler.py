@@ -0,0 +1,205 @@
+import json
+import os
+
+import numpy as np
+
+# The names used by export.py and quantization.py, which cannot be imported without TensorFlow
+INFO_FILENAME = 'export.json'
+QUANTIZED_SUFFIX = '_int8'
+SCALE_SUFFIX = '_scale'
+SEED_MASK = 0xffffffff  # Seeds are split into 32-bit words for np.random.RandomState
+
+
+def load_exported_weights(export_path):
+    """Return a dictionary from the name of each weight in an export to its values, memory-mapped rather than read into
+    memory."""
+    try:
+        with open(os.path.join(export_path, INFO_FILENAME), 'r') as f:
+            info = json.load(f)
+    except FileNotFoundError:
+        raise Exception(f'Export is missing. Export the model with \'python ArticleGenerator.py --export\' to '
+                        f'\'{export_path}\' before using the numpy backend.')
+    return {name: np.load(os.path.join(export_path, filename), mmap_mode='r')
+            for name, filename in info['weights'].items()}
+
+
+def softmax(x):
+    """Return the softmax of x over its last axis."""
+    x = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return x / np.sum(x, axis=-1, keepdims=True)
+
+
+def log_softmax(x):
+    """Return the log of the softmax of x over its last axis."""
+    x = x - np.max(x, axis=-1, keepdims=True)
+    return x - np.log(np.sum(np.exp(x), axis=-1, keepdims=True))
+
+
+def gelu(x):
+    """Return the gelu activation of x, approximated with tanh as gpt2 does."""
+    return 0.5 * x * (1 + np.tanh(np.float32(np.sqrt(2 / np.pi)) * (x + 0.044715 * x ** 3)))
+
+
+def top_k_logits(logits, k):
+    """Return the logits of each row with every logit below its k largest masked out."""
+    if k == 0:
+        return logits
+    min_values = np.partition(logits, -k, axis=-1)[:, -k:].min(axis=-1, keepdims=True)
+    return np.where(logits < min_values, np.float32(-1e10), logits)
+
+
+def top_p_logits(logits, p):
+    """Return the logits of each row with every logit outside the smallest set whose probabilities add up to p masked
+    out."""
+    sorted_logits = -np.sort(-logits, axis=-1)
+    probs = softmax(sorted_logits)
+    cumulative_probs = np.cumsum(probs, axis=-1) - probs  # The probability of the logits larger than each logit
+    min_logits = np.min(np.where(cumulative_probs < p, sorted_logits, np.float32(1e3)), axis=-1, keepdims=True)
+    return np.where(logits < min_logits, np.float32(-1e10), logits)
+
+
+def sample_rows(logits, seeds, i):
+    """Sample a token from the logits of each row, drawing the random number of a row for step i from its seed."""
+    uniforms = np.array([np.random.RandomState([int(seed) & SEED_MASK, int(seed) >> 32 & SEED_MASK,
+                                                (int(key) + i) & SEED_MASK, (int(key) + i) >> 32 & SEED_MASK])
+                         .random_sample() for seed, key in seeds])
+    cumulative_probs = np.cumsum(softmax(logits.astype(np.float64)), axis=-1)
+    samples = np.sum(cumulative_probs < uniforms[:, np.newaxis] * cumulative_probs[:, -1:], axis=-1)
+    return np.minimum(samples, logits.shape[-1] - 1).astype(np.int32)
+
+
+class NumpySampler:
+    """This class samples from gpt2 with NumPy alone, so that the model runs without TensorFlow. It has the methods of
+    Sampler that Gpt2Handler uses and caches in the same layout, so either can be used as the backend of Gpt2Handler.
+    The weights are read from an export of the model and memory-mapped, so processes using the same export share them.
+    The forward pass is the same as that of gpt2, so the logits match those of Sampler up to float32 rounding, but the
+    random numbers are drawn differently, so the tokens sampled for a seed differ from those Sampler samples. Each row
+    still only depends on its own seed. Speculative decoding is not supported."""
+    lookahead = 0  # The cache is never run beyond the tokens sampled
+
+    def __init__(self, hparams, weights):
+        """Initialise a sampler for a model with hparams from a dictionary from the name of each weight to its values.
+        The weights of an int8 export are kept in int8 and their products scaled per channel."""
+        self.hparams = hparams
+        self.weights = weights
+        self.head_size = hparams.n_embd // hparams.n_head
+        self.empty_past = np.zeros([1, hparams.n_layer, 2, hparams.n_head, 0, self.head_size], dtype=np.float32)
+
+    @classmethod
+    def load(cls, hparams, export_path):
+        """Return a sampler for the model with hparams exported to export_path."""
+        return cls(hparams, load_exported_weights(export_path))
+
+    def compute_past(self, context_tokens, past=None):
+        """Run the model over each row of context_tokens and return the cache of the past followed by the tokens."""
+        context_tokens = np.asarray(context_tokens, dtype=np.int32)
+        cache, start = self.create_cache(context_tokens.shape[0], past, context_tokens.shape[1])
+        self.forward(context_tokens, cache, start)
+        return cache
+
+    def score(self, context_tokens, past=None):
+        """Return the log probability of each token of each row of context_tokens after the first, given the tokens
+        before it."""
+        context_tokens = np.asarray(context_tokens, dtype=np.int32)
+        cache, start = self.create_cache(context_tokens.shape[0], past, context_tokens.shape[1])
+        log_probs = log_softmax(self.forward(context_tokens, cache, start)[:, :-1])
+        return np.take_along_axis(log_probs, context_tokens[:, 1:, np.newaxis], axis=-1)[:, :, 0]
+
+    def sample(self, context_tokens, length, seeds, temperature=0.7, top_k=0, top_p=0.0, past=None, fetch_past=False,
+               speculative=True, fetch_log_probs=False):
+        """Sample length tokens after each row of context_tokens and return them as an array. Seeds has a pair of
+        integers for each row that determines the random numbers it draws.
+        If fetch_past is true, also return the cache of every token except the last sampled one. If fetch_log_probs is
+        true, also return the log probability the model gave each sampled token, after the cache if it is returned.
+        Speculative is ignored."""
+        context_tokens = np.asarray(context_tokens, dtype=np.int32)
+        batch_size = context_tokens.shape[0]
+        # The cache is allocated once for every token it will hold, rather than concatenated on every step
+        cache, start = self.create_cache(batch_size, past, context_tokens.shape[1] - 1 + length)
+        if context_tokens.shape[1] > 1:
+            self.forward(context_tokens[:, :-1], cache, start)
+            start += context_tokens.shape[1] - 1
+
+        prev = context_tokens[:, -1]
+        tokens = np.zeros([batch_size, length], dtype=np.int32)
+        log_probs = np.zeros([batch_size, length], dtype=np.float32)
+        for i in range(length):
+            model_logits = self.forward(prev[:, np.newaxis], cache, start)[:, -1]
+            start += 1
+            logits = model_logits / np.float32(temperature)
+            logits = top_p_logits(logits, top_p) if top_p > 0.0 else top_k_logits(logits, top_k)
+            prev = tokens[:, i] = sample_rows(logits, seeds, i)
+            if fetch_log_probs:
+                log_probs[:, i] = np.take_along_axis(log_softmax(model_logits), prev[:, np.newaxis], axis=-1)[:, 0]
+        outputs = (tokens,) + ((cache,) if fetch_past else ()) + ((log_probs,) if fetch_log_probs else ())
+        return outputs if len(outputs) > 1 else tokens
+
+    def get_draft_acceptance_rate(self):
+        """Return None, since there is no draft model."""
+        return None
+
+    def create_cache(self, batch_size, past, num_tokens):
+        """Return a cache for batch_size rows with room for num_tokens tokens after the past, with the past copied into
+        it, and the number of tokens in the past. A past with a batch size of 1 is shared between every row."""
+        past = self.empty_past if past is None else past
+        past_length = past.shape[-2]
+        cache_shape = (batch_size,) + past.shape[1:-2] + (past_length + num_tokens, self.head_size)
+        cache = np.empty(cache_shape, dtype=np.float32)
+        cache[..., :past_length, :] = past
+        return cache, past_length
+
+    def forward(self, tokens, cache, start):
+        """Run the model on tokens that follow the first start tokens in the cache, write their keys and values into the
+        cache after those and return the logits of the tokens."""
+        h = self.embed(tokens) + self.weights['model/wpe'][start:start + tokens.shape[1]]
+        for layer in range(self.hparams.n_layer):
+            scope = f'model/h{layer}'
+            h = h + self.attention(self.norm(h, f'{scope}/ln_1'), f'{scope}/attn', cache[:, layer], start)
+            h = h + self.linear(gelu(self.linear(self.norm(h, f'{scope}/ln_2'), f'{scope}/mlp/c_fc')),
+                                f'{scope}/mlp/c_proj')
+        return self.unembed(self.norm(h, 'model/ln_f'))
+
+    def attention(self, x, scope, cache, start):
+        """Return the output of the attention layer in scope for x, writing the keys and values of x into the cache of
+        the layer after the first start tokens."""
+        batch_size, num_tokens, _ = x.shape
+        # [batch, tokens, 3 * embedding] to three [batch, heads, tokens, head size]
+        q, k, v = self.linear(x, f'{scope}/c_attn').reshape(
+            batch_size, num_tokens, 3, self.hparams.n_head, self.head_size).transpose(2, 0, 3, 1, 4)
+        end = start + num_tokens
+        cache[:, 0, :, start:end] = k
+        cache[:, 1, :, start:end] = v
+
+        w = q @ cache[:, 0, :, :end].transpose(0, 1, 3, 2) / np.float32(np.sqrt(self.head_size))
+        if num_tokens > 1:  # Each token attends to the tokens before it and itself
+            w = np.where(np.arange(end) <= np.arange(num_tokens)[:, np.newaxis] + start, w, np.float32(-1e10))
+        a = softmax(w) @ cache[:, 1, :, :end]
+        return self.linear(a.transpose(0, 2, 1, 3).reshape(batch_size, num_tokens, self.hparams.n_embd),
+                           f'{scope}/c_proj')
+
+    def norm(self, x, scope, epsilon=1e-5):
+        """Normalise x to a mean of 0 and a variance of 1 over its last axis, then scale and shift it with the weights
+        in scope."""
+        u = np.mean(x, axis=-1, keepdims=True)
+        s = np.mean(np.square(x - u), axis=-1, keepdims=True)
+        return (x - u) / np.sqrt(s + np.float32(epsilon)) * self.weights[f'{scope}/g'] + self.weights[f'{scope}/b']
+
+    def linear(self, x, scope):
+        """Multiply x by the weights of the 1x1 convolution in scope and add its bias."""
+        if f'{scope}/w' in self.weights:
+            y = x @ self.weights[f'{scope}/w'][0]
+        else:
+            y = (x @ self.weights[f'{scope}/w{QUANTIZED_SUFFIX}'][0]) * self.weights[f'{scope}/w{SCALE_SUFFIX}'][0]
+        return y + self.weights[f'{scope}/b']
+
+    def embed(self, tokens):
+        """Return the token embeddings of tokens."""
+        if 'model/wte' in self.weights:
+            return self.weights['model/wte'][tokens]
+        return self.weights['model/wte' + QUANTIZED_SUFFIX][tokens] * self.weights['model/wte' + SCALE_SUFFIX][tokens]
+
+    def unembed(self, h):
+        """Return the logits of the hidden states h, using the token embeddings as the output weights."""
+        if 'model/wte' in self.weights:
+            return h @ self.weights['model/wte'].T
+        return (h @ self.weights['model/wte' + QUANTIZED_SUFFIX].T) * self.weights['model/wte' + SCALE_SUFFIX][:, 0]
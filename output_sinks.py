@@ -0,0 +1,217 @@
+import gzip
+import json
+import os
+import queue
+import threading
+
+# How generated samples are written when an output filename is given. 'files' writes each sample to its own file,
+# 'jsonl' appends every sample to a single JSONL file, and 'gzip' and 'zstd' write compressed JSONL shards of up to
+# samples_per_shard samples each. 'zstd' needs the zstandard package.
+OUTPUT_CONFIG = {
+    'format': 'files',
+    'samples_per_shard': 10000
+}
+OUTPUT_FORMATS = ['files', 'jsonl', 'gzip', 'zstd']
+WRITE_QUEUE_SIZE = 256  # The most samples waiting to be written before writing a sample blocks until there is room
+TEMPORARY_EXTENSION = '.tmp'  # Appended to the filename of a file while it is written, until it is complete
+
+
+def create_sink(filename, num_samples, output_format=None):
+    """Create and return the sink that writes samples to a filename in a format, OUTPUT_CONFIG['format'] by default.
+    Num_samples is the number of samples that will be written, which decides how files of single samples are named."""
+    output_format = output_format or OUTPUT_CONFIG['format']
+    if output_format == 'files':
+        return FileSink(filename, num_samples)
+    if output_format == 'jsonl':
+        return JsonlSink(filename)
+    if output_format in ('gzip', 'zstd'):
+        return ShardSink(filename, output_format, OUTPUT_CONFIG['samples_per_shard'])
+    raise Exception(f'Unknown output format \'{output_format}\'. Use one of: {", ".join(OUTPUT_FORMATS)}.')
+
+
+def replace_atomically(filename, write):
+    """Create a file by calling write with a binary file object and moving the file into place once it is complete,
+    so that the file is either missing or complete if the process stops while it is written."""
+    temporary_filename = filename + TEMPORARY_EXTENSION
+    with open(temporary_filename, 'wb') as f:
+        write(f)
+    os.replace(temporary_filename, filename)
+
+
+def encode_sample(index, sample):
+    """Return a sample as a line of JSON with its index, encoded as bytes."""
+    return json.dumps({'index': index, 'sample': sample}).encode('utf-8', errors='surrogateescape') + b'\n'
+
+
+class OutputSink:
+    """This class writes samples on a background thread as they are generated, so that generating does not wait for
+    the disk. Subclasses implement write_now and optionally flush and finish. Samples are queued by write, which only
+    blocks when WRITE_QUEUE_SIZE samples are already waiting. An error while writing is raised by the next call to
+    write or close."""
+
+    def __init__(self):
+        """Start the thread that writes the samples."""
+        self.samples = queue.Queue(WRITE_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_samples, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        """Return the sink."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Write the remaining samples and close the sink."""
+        self.close()
+
+    def write(self, index, sample):
+        """Queue the sample with an index to be written."""
+        self.raise_error()
+        self.samples.put((index, sample))
+
+    def close(self):
+        """Wait until every queued sample is written, then finish writing the output."""
+        self.samples.put(None)
+        self.thread.join()
+        self.raise_error()
+
+    def raise_error(self):
+        """Raise the error the thread stopped writing with, if there was one."""
+        if self.error is not None:
+            raise self.error
+
+    def write_samples(self):
+        """Write the queued samples until a None sample is queued, flushing whenever no more are waiting."""
+        while True:
+            item = self.samples.get()
+            if item is None:
+                break
+            if self.error is None:  # Keep taking samples after an error so that write never blocks forever
+                try:
+                    self.write_now(*item)
+                    if self.samples.empty():
+                        self.flush()
+                except Exception as e:
+                    self.error = e
+
+        if self.error is None:
+            try:
+                self.finish()
+            except Exception as e:
+                self.error = e
+
+    def write_now(self, index, sample):
+        """Write a sample with an index. Called on the writing thread."""
+        raise NotImplementedError
+
+    def flush(self):
+        """Flush anything buffered while no samples are waiting. Called on the writing thread."""
+
+    def finish(self):
+        """Finish writing after the last sample. Called on the writing thread."""
+
+
+class FileSink(OutputSink):
+    """This class writes each sample to its own file. If there is more than one sample, the index of the sample is
+    appended to the filename before the extension. Each file is written under a temporary name and renamed once it is
+    complete, so no partially written sample is ever left under its filename."""
+
+    def __init__(self, filename, num_samples):
+        """Write the samples to files named after filename."""
+        self.filename = filename
+        self.num_samples = num_samples
+        super().__init__()
+
+    def get_filename(self, index):
+        """Return the name of the file the sample with an index is written to."""
+        if self.num_samples == 1:
+            return self.filename
+        base, extension = os.path.splitext(self.filename)
+        return base + str(index) + extension
+
+    def write_now(self, index, sample):
+        """Write the sample to its file."""
+        replace_atomically(self.get_filename(index),
+                           lambda f: f.write(sample.encode('utf-8', errors='surrogateescape')))
+
+
+class JsonlSink(OutputSink):
+    """This class appends each sample to a single JSONL file as an object with its index and the sample, which keeps
+    the number of files constant however many samples are written."""
+
+    def __init__(self, filename):
+        """Append the samples to the file with a filename, creating it if it does not exist."""
+        self.file = open(filename, 'ab')
+        super().__init__()
+
+    def write_now(self, index, sample):
+        """Append the sample to the file."""
+        self.file.write(encode_sample(index, sample))
+
+    def flush(self):
+        """Flush the samples written so far to the file."""
+        self.file.flush()
+
+    def finish(self):
+        """Close the file."""
+        self.file.close()
+
+
+class ShardSink(OutputSink):
+    """This class writes the samples to compressed JSONL shards with up to samples_per_shard samples each. The shards
+    are named after the filename with the number of the shard inserted before the extension, for example
+    'articles-00000.jsonl.gz'. Each shard is written under a temporary name and renamed once it is complete."""
+    EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, filename, compression, samples_per_shard):
+        """Write the samples to shards named after filename, compressed with 'gzip' or 'zstd'."""
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('Writing zstd shards needs the zstandard package. Install it with '
+                                '\'pip install zstandard\' or use the gzip format.')
+            self.compressor = zstandard.ZstdCompressor()
+        self.filename = filename
+        self.compression = compression
+        self.samples_per_shard = samples_per_shard
+        self.shard_index = 0
+        self.shard_samples = 0
+        self.raw_file = None  # The temporary file of the current shard, and the compressed stream writing to it
+        self.file = None
+        super().__init__()
+
+    def get_filename(self, shard_index):
+        """Return the name of the shard with an index."""
+        base, extension = os.path.splitext(self.filename)
+        if base.endswith('.jsonl'):
+            base, extension = base[:-len('.jsonl')], '.jsonl' + extension
+        if not extension.endswith(self.EXTENSIONS[self.compression]):
+            extension += self.EXTENSIONS[self.compression]
+        return f'{base}-{shard_index:05d}{extension}'
+
+    def write_now(self, index, sample):
+        """Write the sample to the current shard, starting a new shard if it is full."""
+        if self.file is None:
+            self.raw_file = open(self.get_filename(self.shard_index) + TEMPORARY_EXTENSION, 'wb')
+            if self.compression == 'zstd':
+                self.file = self.compressor.stream_writer(self.raw_file)
+            else:
+                self.file = gzip.GzipFile(fileobj=self.raw_file, mode='wb')
+        self.file.write(encode_sample(index, sample))
+        self.shard_samples += 1
+        if self.shard_samples == self.samples_per_shard:
+            self.finish()
+
+    def finish(self):
+        """Finish the current shard, if one was started, and move it into place."""
+        if self.file is None:
+            return
+        self.file.close()
+        if not self.raw_file.closed:  # gzip does not close a file object it was given
+            self.raw_file.close()
+        filename = self.get_filename(self.shard_index)
+        os.replace(filename + TEMPORARY_EXTENSION, filename)
+        self.shard_index += 1
+        self.shard_samples = 0
+        self.file = self.raw_file = None
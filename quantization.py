@@ -0,0 +1,70 @@
+import re
+
+import numpy as np
+import tensorflow as tf
+
+# The variables stored as int8. These are the weights of every matrix multiplication, which hold almost all of the
+# parameters. The biases, layer norms and position embeddings are small and kept in float32.
+QUANTIZED_VARIABLE_PATTERN = re.compile(r'(^|/)(w|wte)$')
+QUANTIZED_SUFFIX = '_int8'
+SCALE_SUFFIX = '_scale'
+
+
+def get_scale_axis(name):
+    """Return the axis of a quantized variable that has its own scale for each index. The token embeddings are scaled
+    per token and the other weights per output channel."""
+    return 0 if name.endswith('wte') else -1
+
+
+def get_scale_shape(name, shape):
+    """Return the shape of the scales of a quantized variable with the given shape."""
+    axis = get_scale_axis(name) % len(shape)
+    return [dimension if i == axis else 1 for i, dimension in enumerate(shape)]
+
+
+def quantize(name, values):
+    """Return the int8 values and float32 scales of a variable, quantized symmetrically so that values is
+    approximately the int8 values multiplied by the scales."""
+    axis = get_scale_axis(name) % values.ndim
+    reduce_axes = tuple(i for i in range(values.ndim) if i != axis)
+    scales = np.max(np.abs(values), axis=reduce_axes, keepdims=True) / 127
+    scales[scales == 0] = 1  # Avoid dividing by zero for channels that are all zeros
+    quantized = np.clip(np.round(values / scales), -127, 127).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def quantized_getter(getter, name, shape=None, **kwargs):
+    """A custom getter for tf.compat.v1.variable_scope that stores the weights of matrix multiplications as int8
+    variables with a float32 scale per channel, and returns them dequantized to float32 in their place."""
+    if not QUANTIZED_VARIABLE_PATTERN.search(name):
+        return getter(name, shape=shape, **kwargs)
+
+    kwargs.update(trainable=False, initializer=tf.compat.v1.zeros_initializer())
+    values = getter(name + QUANTIZED_SUFFIX, shape=shape, **dict(kwargs, dtype=tf.int8))
+    scales = getter(name + SCALE_SUFFIX, shape=get_scale_shape(name, shape), **dict(kwargs, dtype=tf.float32))
+    return tf.cast(values, tf.float32) * scales
+
+
+def read_weights(checkpoint_path, names):
+    """Yield the name and value of each named variable from a float32 checkpoint, one variable at a time. Variables
+    created by quantized_getter are quantized as they are read, and the scales of each are yielded after its values."""
+    reader = tf.compat.v1.train.NewCheckpointReader(checkpoint_path)
+    for name in names:
+        if name.endswith(SCALE_SUFFIX):
+            continue  # Yielded with its quantized values
+        if name.endswith(QUANTIZED_SUFFIX):
+            checkpoint_name = name[:-len(QUANTIZED_SUFFIX)]
+            quantized, scales = quantize(checkpoint_name, reader.get_tensor(checkpoint_name))
+            yield name, quantized
+            yield checkpoint_name + SCALE_SUFFIX, scales
+        else:
+            yield name, reader.get_tensor(name)
+
+
+def load_quantized_checkpoint(sess, checkpoint_path):
+    """Load every variable in the graph of the session from a float32 checkpoint, quantizing the variables created by
+    quantized_getter as they are read. Only one float32 variable is held in memory at a time."""
+    with sess.graph.as_default():
+        variables = {variable.op.name: variable for variable in tf.compat.v1.global_variables()}
+    for name, value in read_weights(checkpoint_path, list(variables)):
+        variables[name].load(value, sess)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+CACHE_EXTENSION = '.json'
+TEMPORARY_EXTENSION = '.tmp'
+
+
+class ResultCache:
+    """This class stores generated samples on disk, one file per sample, keyed on everything that determines the sample.
+    Once the files take up more than max_bytes, the least recently used samples are removed until they fit again. The
+    order of use is kept in the modification times of the files, so it carries over between runs."""
+
+    def __init__(self, directory, max_bytes):
+        """Initialise the cache in directory, creating it if it does not exist."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # The size of each file in the cache, from the least to the most recently used
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and entry.name.endswith(CACHE_EXTENSION):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name[:-len(CACHE_EXTENSION)], stat.st_size))
+        self.sizes = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.sizes.values())
+
+    @staticmethod
+    def get_key(**values):
+        """Return the key of a sample from the values that determine it. The values must be encodable as JSON."""
+        return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        """Return the path of the file a sample is stored in."""
+        return os.path.join(self.directory, key + CACHE_EXTENSION)
+
+    def get(self, key, required_metadata=()):
+        """Return the (sample, metadata) pair stored for the key, or None if there is none or its metadata is missing
+        any of the fields in required_metadata, which then counts as a miss."""
+        with self.lock:
+            path = self.get_path(key)
+            try:
+                with open(path, 'r', encoding='utf-8', errors='surrogateescape') as f:
+                    sample, metadata = json.load(f)
+            except (OSError, ValueError):  # The sample is not in the cache or its file is damaged
+                self.misses += 1
+                return None
+            if any(field not in metadata for field in required_metadata):  # It will be generated again with them
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            os.utime(path)  # Mark the sample as the most recently used
+            if key in self.sizes:
+                self.sizes.move_to_end(key)
+            return sample, metadata
+
+    def put(self, key, sample, metadata):
+        """Store a (sample, metadata) pair for the key, then remove the least recently used samples if needed."""
+        data = json.dumps([sample, metadata]).encode('utf-8', errors='surrogateescape')
+        with self.lock:
+            path = self.get_path(key)
+            # Write to a temporary file first so that a crash never leaves a partially written sample behind. Its name
+            # is unique, so that processes sharing the cache directory never write into each other's file.
+            try:
+                descriptor, temporary_path = tempfile.mkstemp(suffix=TEMPORARY_EXTENSION, prefix=key + '.',
+                                                              dir=self.directory)
+                with os.fdopen(descriptor, 'wb') as f:
+                    f.write(data)
+                os.replace(temporary_path, path)
+            except FileNotFoundError:  # The temporary file or the directory was removed, so the sample is not stored
+                return
+
+            self.total_bytes += len(data) - self.sizes.pop(key, 0)
+            self.sizes[key] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+                old_key, size = self.sizes.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.get_path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def get_stats(self):
+        """Return a dictionary with the number of hits and misses, the hit rate, and the number and size of samples."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': len(self.sizes),
+                'bytes': self.total_bytes
+            }
@@ -0,0 +1,335 @@
+import copy
+
+import numpy as np
+import tensorflow as tf
+from gpt_2_simple.src import model
+
+
+def top_k_logits(logits, k):
+    """Mask all but the k largest logits in each row. A k of 0 leaves the logits unchanged."""
+    def mask():
+        values, _ = tf.nn.top_k(logits, k=k)
+        min_values = values[:, -1, tf.newaxis]
+        return tf.where(logits < min_values, tf.ones_like(logits) * -1e10, logits)
+
+    return tf.cond(tf.equal(k, 0), lambda: logits, mask)
+
+
+def top_p_logits(logits, p):
+    """Mask the logits in each row outside of the smallest set whose cumulative probability is at least p."""
+    logits_sort = tf.sort(logits, direction='DESCENDING')
+    probs_sort = tf.nn.softmax(logits_sort)
+    probs_sums = tf.cumsum(probs_sort, axis=1, exclusive=True)
+    logits_masked = tf.where(probs_sums < p, logits_sort, tf.ones_like(logits_sort) * 1000)
+    min_logits = tf.reduce_min(logits_masked, axis=1, keepdims=True)
+    return tf.where(logits < min_logits, tf.ones_like(logits) * -1e10, logits)
+
+
+def token_log_probs(logits, tokens):
+    """Return the log probability of each token under the logits of its position, before the temperature and the top_k
+    or top_p filtering are applied, as the model gives it."""
+    return tf.negative(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tokens, logits=logits))
+
+
+def sample_rows(logits, seeds):
+    """Sample a token from the logits of each row, drawing the random numbers of each row from its own seed."""
+    samples = tf.map_fn(
+        lambda row: tf.random.stateless_categorical(row[0][tf.newaxis], 1, seed=row[1], dtype=tf.int32)[0],
+        (logits, seeds), dtype=tf.int32, back_prop=False)
+    return tf.squeeze(samples, axis=[1])
+
+
+class Sampler:
+    """This class builds a single sampling graph for a loaded gpt2 model and feeds it on every call.
+    Unlike gpt2.generate, which adds a new subgraph to the session every time it is called, the graph is built once with
+    placeholders for everything that varies between calls, so the size of the graph stays constant."""
+    SCOPE = 'sampler'
+    # The inputs and outputs of the sampling graph, which are named after the attributes holding them so that they can
+    # be found again in an exported copy of the graph
+    TENSOR_NAMES = ['context', 'past', 'length', 'temperature', 'top_k', 'top_p', 'seed', 'context_past',
+                    'context_log_probs', 'tokens', 'presents', 'log_probs']
+    SPECULATIVE_TENSOR_NAMES = ['speculative_tokens', 'speculative_presents', 'speculative_log_probs', 'draft_counts']
+    # The outputs that exports made before they were added do not have. They are None when such an export is imported.
+    OPTIONAL_TENSOR_NAMES = ['log_probs']
+    # Added to the first value of the seed of a row to draw the random numbers that accept or reject a drafted token,
+    # and to sample the token in place of a rejected one, so that they are independent of the drafted tokens
+    ACCEPT_SEED_OFFSET = 1 << 32
+    RESIDUAL_SEED_OFFSET = 2 << 32
+
+    def __init__(self, sess, hparams, custom_getter=None, graph_def=None, weights=None, draft_layers=0,
+                 draft_tokens=4):
+        """Build the sampling graph in the graph of the session. The model variables must already be loaded, unless a
+        custom getter that creates them is given, in which case they must be loaded after.
+        If graph_def is given, import the sampling graph from it instead of building it. Weights is a dictionary from
+        the names of any placeholders the model weights are fed to, to their values.
+        If draft_layers is not 0, also build a graph that samples with speculative decoding, using the first
+        draft_layers layers of the model as the draft model to propose draft_tokens tokens at a time."""
+        self.sess = sess
+        self.hparams = hparams
+        self.weights = weights or {}
+        self.draft_layers = draft_layers
+        self.draft_tokens = draft_tokens
+        self.draft_hparams = copy.copy(hparams)
+        self.draft_hparams.n_layer = draft_layers
+        self.draft_accepted = 0  # The number of drafted tokens accepted and proposed so far
+        self.draft_proposed = 0
+        # How many positions beyond the last token sampled the model may be run on. A speculative round drafts and
+        # checks a whole round of tokens even when fewer of them are needed.
+        self.lookahead = draft_tokens - 1 if draft_layers else 0
+        # A cache with no tokens in it, used when sampling does not resume from a previously computed cache
+        self.empty_past = np.zeros(model.past_shape(hparams=hparams, batch_size=1, sequence=0), dtype=np.float32)
+
+        with sess.graph.as_default():
+            if graph_def is not None:
+                self.import_graph(graph_def)
+            else:
+                with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), custom_getter=custom_getter):
+                    self.build_graph()
+
+    def import_graph(self, graph_def):
+        """Import a sampling graph that was built by build_graph and find its inputs and outputs."""
+        tf.import_graph_def(graph_def, name='')
+        for name in self.get_tensor_names():
+            try:
+                tensor = self.sess.graph.get_tensor_by_name(f'{self.SCOPE}/{name}:0')
+            except KeyError:
+                if name not in self.OPTIONAL_TENSOR_NAMES:
+                    raise
+                tensor = None
+            setattr(self, name, tensor)
+
+    def get_tensor_names(self):
+        """Return the names of the inputs and outputs of the sampling graph."""
+        return self.TENSOR_NAMES + (self.SPECULATIVE_TENSOR_NAMES if self.draft_layers else [])
+
+    def get_output_names(self):
+        """Return the names of the operations producing the outputs of the sampling graph."""
+        return [getattr(self, name).op.name for name in self.get_tensor_names() if getattr(self, name) is not None]
+
+    def build_graph(self):
+        """Create the placeholders of the sampling graph and the operations that sample from them."""
+        hparams = self.hparams
+        with tf.compat.v1.name_scope(self.SCOPE):
+            # Tokens that are not in the cache yet. Every row must contain at least one token.
+            self.context = tf.compat.v1.placeholder(tf.int32, [None, None], name='context')
+            # The cache of the tokens preceding the context. A batch size of 1 shares it between every row.
+            self.past = tf.compat.v1.placeholder(tf.float32, model.past_shape(hparams=hparams), name='past')
+            self.length = tf.compat.v1.placeholder(tf.int32, [], name='length')
+            self.temperature = tf.compat.v1.placeholder(tf.float32, [], name='temperature')
+            self.top_k = tf.compat.v1.placeholder(tf.int32, [], name='top_k')
+            self.top_p = tf.compat.v1.placeholder(tf.float32, [], name='top_p')
+            # The key of the stateless random number generator of each row. The step number is added to the second
+            # value. Each row has its own key so that the tokens of a row do not depend on the other rows in the batch.
+            self.seed = tf.compat.v1.placeholder(tf.int64, [None, 2], name='seed')
+
+            batch_size = tf.shape(self.context)[0]
+            past = tf.tile(self.past, [batch_size // tf.shape(self.past)[0], 1, 1, 1, 1, 1])
+            # The cache of the past followed by every context token, used to precompute the cache of a fixed prompt
+            full_context_output = self.step(self.context, past)
+            self.context_past = tf.concat([past, full_context_output['presents']], axis=-2, name='context_past')
+            # The log probability of each context token after the first given the tokens before it
+            self.context_log_probs = tf.negative(tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=self.context[:, 1:], logits=full_context_output['logits'][:, :-1]), name='context_log_probs')
+
+            context_output = self.step(self.context[:, :-1], past)
+            past = tf.concat([past, context_output['presents']], axis=-2)
+
+            def body(i, past, prev, output, log_probs):
+                next_outputs = self.step(prev[:, tf.newaxis], past)
+                logits = next_outputs['logits'][:, -1, :]
+                samples = sample_rows(self.filter_logits(logits), self.get_seeds(i))
+                return [
+                    i + 1,
+                    tf.concat([past, next_outputs['presents']], axis=-2),
+                    samples,
+                    tf.concat([output, samples[:, tf.newaxis]], axis=1),
+                    tf.concat([log_probs, token_log_probs(logits, samples)[:, tf.newaxis]], axis=1)
+                ]
+
+            _, presents, _, tokens, log_probs = tf.while_loop(
+                cond=lambda *args: True, body=body, maximum_iterations=self.length,
+                loop_vars=[tf.constant(0), past, self.context[:, -1], tf.zeros([batch_size, 0], dtype=tf.int32),
+                           tf.zeros([batch_size, 0], dtype=tf.float32)],
+                shape_invariants=[
+                    tf.TensorShape([]),
+                    tf.TensorShape(model.past_shape(hparams=hparams)),
+                    tf.TensorShape([None]),
+                    tf.TensorShape([None, None]),
+                    tf.TensorShape([None, None])
+                ],
+                back_prop=False)
+
+            # The sampled tokens, the cache of every token except the last sampled one, and the log probability the
+            # model gave each sampled token, accumulated as they are sampled so that samples need not be scored again
+            self.tokens = tf.identity(tokens, name='tokens')
+            self.presents = tf.identity(presents, name='presents')
+            self.log_probs = tf.identity(log_probs, name='log_probs')
+
+            if self.draft_layers:
+                self.build_speculative_graph(past, self.context[:, -1])
+
+    def build_speculative_graph(self, past, prev):
+        """Create the operations that sample the same tokens as the sampling graph with speculative decoding, starting
+        from the cache of the context and its last token.
+        In each round the draft model proposes draft_tokens tokens one at a time, then the model computes the
+        probabilities of all of them in a single step. Each drafted token is accepted with probability
+        min(1, p / q), where p and q are its probabilities under the model and the draft model, and the first rejected
+        one is replaced with a token sampled from the normalised max(0, p - q). This gives exactly the distribution of
+        sampling from the model alone. The random numbers of each of these draws are selected by the position of the
+        token in the sample, so the tokens sampled do not depend on how they are split into rounds, and every row
+        moves forward by the tokens accepted by all rows plus one."""
+        hparams, draft_tokens = self.hparams, self.draft_tokens
+        batch_size = tf.shape(prev)[0]
+
+        def body(i, past, prev, output, log_probs, counts):
+            # The draft model has the first layers of the model, so its cache is the first layers of the cache
+            draft_past = past[:, :self.draft_layers]
+            drafted, draft_probs = [], []
+            token = prev
+            for j in range(draft_tokens):
+                draft_outputs = self.step(token[:, tf.newaxis], draft_past, self.draft_hparams)
+                logits = self.filter_logits(draft_outputs['logits'][:, -1, :])
+                token = sample_rows(logits, self.get_seeds(i + j))
+                drafted.append(token)
+                draft_probs.append(tf.nn.softmax(logits))
+                draft_past = tf.concat([draft_past, draft_outputs['presents']], axis=-2)
+            drafted = tf.stack(drafted, axis=1)
+            draft_probs = tf.stack(draft_probs, axis=1)
+
+            # The model computes the probabilities of every drafted token at once
+            outputs = self.step(tf.concat([prev[:, tf.newaxis], drafted[:, :-1]], axis=1), past)
+            logits = tf.reshape(self.filter_logits(tf.reshape(outputs['logits'], [-1, hparams.n_vocab])),
+                                [batch_size, draft_tokens, hparams.n_vocab])
+            probs = tf.nn.softmax(logits)
+
+            accepted, residual_samples = [], []
+            for j in range(draft_tokens):
+                one_hot = tf.one_hot(drafted[:, j], hparams.n_vocab)
+                ratio = (tf.reduce_sum(probs[:, j] * one_hot, axis=1) /
+                         tf.reduce_sum(draft_probs[:, j] * one_hot, axis=1))
+                uniform = tf.map_fn(lambda seed: tf.random.stateless_uniform([], seed=seed),
+                                    self.get_seeds(i + j, self.ACCEPT_SEED_OFFSET), dtype=tf.float32, back_prop=False)
+                accepted.append(uniform < ratio)
+                residual = tf.maximum(probs[:, j] - draft_probs[:, j], 0.0)
+                residual_logits = tf.where(residual > 0.0, tf.math.log(residual), tf.ones_like(residual) * -1e10)
+                # The residual is only empty when both distributions are the same, in which case nothing is rejected
+                has_residual = tf.broadcast_to(tf.reduce_sum(residual, axis=1, keepdims=True) > 0.0, tf.shape(residual))
+                residual_samples.append(sample_rows(tf.where(has_residual, residual_logits, logits[:, j]),
+                                                    self.get_seeds(i + j, self.RESIDUAL_SEED_OFFSET)))
+
+            # The number of leading drafted tokens each row accepted
+            num_accepted = tf.reduce_sum(tf.math.cumprod(tf.cast(tf.stack(accepted, axis=1), tf.int32), axis=1), axis=1)
+            tokens = tf.where(tf.range(draft_tokens)[tf.newaxis, :] < num_accepted[:, tf.newaxis],
+                              drafted, tf.stack(residual_samples, axis=1))
+            # Every row keeps the tokens accepted by all rows and the one after them. A row that accepted that one too
+            # keeps its drafted token, and a row that rejected it keeps the residual sample in its place.
+            num_kept = tf.minimum(tf.minimum(tf.reduce_min(num_accepted) + 1, draft_tokens), self.length - i)
+            new_counts = counts + tf.stack([tf.reduce_sum(num_accepted), batch_size * draft_tokens])
+            # Every token kept follows tokens the model checked, so its log probability is in the logits of the model
+            new_log_probs = token_log_probs(outputs['logits'], tokens)
+            return [
+                i + num_kept,
+                tf.concat([past, outputs['presents'][:, :, :, :, :num_kept]], axis=-2),
+                tokens[:, num_kept - 1],
+                tf.concat([output, tokens[:, :num_kept]], axis=1),
+                tf.concat([log_probs, new_log_probs[:, :num_kept]], axis=1),
+                new_counts
+            ]
+
+        _, presents, _, tokens, log_probs, counts = tf.while_loop(
+            cond=lambda i, *args: i < self.length, body=body,
+            loop_vars=[tf.constant(0), past, prev, tf.zeros([batch_size, 0], dtype=tf.int32),
+                       tf.zeros([batch_size, 0], dtype=tf.float32), tf.zeros([2], tf.int32)],
+            shape_invariants=[
+                tf.TensorShape([]),
+                tf.TensorShape(model.past_shape(hparams=hparams)),
+                tf.TensorShape([None]),
+                tf.TensorShape([None, None]),
+                tf.TensorShape([None, None]),
+                tf.TensorShape([2])
+            ],
+            back_prop=False)
+
+        self.speculative_tokens = tf.identity(tokens, name='speculative_tokens')
+        self.speculative_presents = tf.identity(presents, name='speculative_presents')
+        self.speculative_log_probs = tf.identity(log_probs, name='speculative_log_probs')
+        # The number of drafted tokens accepted and the number proposed
+        self.draft_counts = tf.identity(counts, name='draft_counts')
+
+    def filter_logits(self, logits):
+        """Apply the temperature and the top_k or top_p filtering to the logits of each row."""
+        logits = logits / self.temperature
+        return tf.cond(self.top_p > 0.0,
+                       lambda: top_p_logits(logits, self.top_p),
+                       lambda: top_k_logits(logits, self.top_k))
+
+    def get_seeds(self, i, offset=0):
+        """Return the seed of each row for the random numbers drawn for the token i tokens after the first sampled."""
+        return self.seed + tf.stack([tf.constant(offset, tf.int64), tf.cast(i, tf.int64)])
+
+    def step(self, tokens, past, hparams=None):
+        """Run the model on the tokens following the cache and return the logits and the cache of the tokens. If
+        hparams is given, run only as many layers of the model as it has."""
+        hparams = hparams or self.hparams
+        lm_output = model.model(hparams=hparams, X=tokens, past=past, reuse=tf.compat.v1.AUTO_REUSE)
+        logits = lm_output['logits'][:, :, :hparams.n_vocab]
+        presents = lm_output['present']
+        presents.set_shape(model.past_shape(hparams=hparams))
+        return {'logits': logits, 'presents': presents}
+
+    def compute_past(self, context_tokens, past=None):
+        """Run the model over each row of context_tokens and return the cache of the past followed by the tokens."""
+        return self.run(self.context_past, feed_dict={
+            self.context: context_tokens,
+            self.past: self.empty_past if past is None else past
+        })
+
+    def score(self, context_tokens, past=None):
+        """Return the log probability of each token of each row of context_tokens after the first, given the tokens
+        before it."""
+        return self.run(self.context_log_probs, feed_dict={
+            self.context: context_tokens,
+            self.past: self.empty_past if past is None else past
+        })
+
+    def sample(self, context_tokens, length, seeds, temperature=0.7, top_k=0, top_p=0.0, past=None, fetch_past=False,
+               speculative=True, fetch_log_probs=False):
+        """Sample length tokens after each row of context_tokens and return them as an array. Seeds has a pair of
+        integers for each row that determines the random numbers it draws.
+        If fetch_past is true, also return the cache of every token except the last sampled one. If fetch_log_probs is
+        true, also return the log probability the model gave each sampled token, after the cache if it is returned.
+        If the graph has a draft model and speculative is true, sample with speculative decoding."""
+        if fetch_log_probs and self.log_probs is None:
+            raise Exception('The export has no log probabilities. Export the model again with '
+                            '\'python ArticleGenerator.py --export\' to score samples.')
+        feed_dict = {
+            self.context: context_tokens,
+            self.past: self.empty_past if past is None else past,
+            self.length: length,
+            self.temperature: temperature,
+            self.top_k: top_k,
+            self.top_p: top_p,
+            self.seed: seeds
+        }
+        if self.draft_layers and speculative:
+            fetches = [self.speculative_tokens, self.speculative_presents, self.speculative_log_probs]
+        else:
+            fetches = [self.tokens, self.presents, self.log_probs]
+        fetches = [fetches[0]] + ([fetches[1]] if fetch_past else []) + ([fetches[2]] if fetch_log_probs else [])
+        if self.draft_layers and speculative:
+            *outputs, (accepted, proposed) = self.run(fetches + [self.draft_counts], feed_dict=feed_dict)
+            self.draft_accepted += int(accepted)
+            self.draft_proposed += int(proposed)
+        else:
+            outputs = self.run(fetches, feed_dict=feed_dict)
+        return tuple(outputs) if len(outputs) > 1 else outputs[0]
+
+    def get_draft_acceptance_rate(self):
+        """Return the fraction of the tokens proposed by the draft model that were accepted, or None if there were
+        none."""
+        return self.draft_accepted / self.draft_proposed if self.draft_proposed else None
+
+    def run(self, fetches, feed_dict):
+        """Run the sampling graph, feeding the weights along with feed_dict."""
+        feed_dict.update(self.weights)
+        return self.sess.run(fetches, feed_dict=feed_dict)
@@ -0,0 +1,288 @@
+import http.server
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from metrics import Metrics
+
+LATENCY_HISTORY = 1000  # The number of most recent request latencies the percentiles are calculated from
+MAX_NUM_WORDS = 1023  # The largest number of words a sample can have, as in ArticleGenerator.py
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list of values, or None if it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))  # Ceiling division
+    return sorted_values[int(rank) - 1]
+
+
+class GenerationRequest:
+    """This class holds a request waiting on the queue of a GenerationServer until its samples are generated."""
+
+    def __init__(self, title, initial_content, num_samples, num_words, run_name=None):
+        """Initialise the request with the prompt it generates samples for and the model it generates them with, the
+        model of the server if run_name is None."""
+        self.prompt = (title, initial_content, num_samples, num_words)
+        self.run_name = run_name
+        self.received = time.monotonic()
+        self.done = threading.Event()
+        self.samples = None
+        self.error = None
+
+
+class StubModel:
+    """This class stands in for Gpt2Handler so the server and work queue workers can be run and tested locally without
+    TensorFlow or the checkpoint. It returns placeholder articles after a fixed delay per call, like a batched forward
+    pass would."""
+
+    def __init__(self, delay=0.1):
+        """Initialise the stub with the number of seconds each call takes."""
+        self.delay = delay
+
+    def generate_many(self, prompts, batch_size=None, as_tuple=False, stop=None, num_best=None):
+        """Return placeholder (sample, metadata) pairs for each prompt, like Gpt2Handler would, or None if stop is
+        set. Only num_best samples of each prompt are returned if it is given."""
+        time.sleep(self.delay)
+        if stop is not None and stop.is_set():
+            return None
+        results = []
+        for title, initial_content, num_samples, num_words in prompts:
+            sample = [title, (initial_content + ' ' + ' '.join(['word'] * num_words)).strip()]
+            metadata = {'tokens_generated': num_words, 'tokens_kept': num_words, 'truncated': False}
+            results.append([(sample if as_tuple else '\n'.join(sample), metadata)
+                            for _ in range(min(num_samples, num_best or num_samples))])
+        return results
+
+    def generate_many_as_tuple(self, prompts, batch_size=None):
+        """Return placeholder samples in the form [title, content] for each prompt, like Gpt2Handler would."""
+        return [[sample for sample, metadata in samples]
+                for samples in self.generate_many(prompts, batch_size, as_tuple=True)]
+
+    @staticmethod
+    def get_cache_stats():
+        """Return None, like Gpt2Handler does when the result cache is disabled."""
+        return None
+
+
+class GenerationServer:
+    """This class serves generation requests over HTTP from a model that stays loaded for the life of the server.
+    Requests are put on a queue and a single worker thread takes the requests that arrive within a latency window of
+    each other and passes them to the model together, so that their samples can share batched forward passes.
+
+    POST /generate takes a JSON object with a title and optionally initial_content, num_samples, num_words and the
+    run_name of the model to generate with, and returns a JSON object with the samples in the form [title, content].
+    Requests for different models in the same batch are generated with one call to each model.
+    GET /stats returns a JSON object with the queue depth, request and batch counts, p50/p99 latency in seconds, the
+    stats of the result cache of the model and the models loaded by the registry.
+    GET /metrics returns the timings of each stage of generation in the Prometheus text format, if they are recorded."""
+
+    def __init__(self, model, host='127.0.0.1', port=8000, batch_window=0.05, max_batch_samples=32, registry=None):
+        """Initialise the server. The model must have a generate_many_as_tuple method like Gpt2Handler. Requests that
+        name a run_name are generated with the model the registry returns for it, like ModelRegistry, and are rejected
+        if there is no registry."""
+        self.model = model
+        self.registry = registry
+        self.batch_window = batch_window
+        self.max_batch_samples = max_batch_samples
+
+        self.requests = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_HISTORY)
+        self.num_requests = 0
+        self.num_batches = 0
+
+        self.http_server = http.server.ThreadingHTTPServer((host, port), self.create_request_handler())
+        self.worker = threading.Thread(target=self.process_requests, daemon=True)
+
+    def serve_forever(self):
+        """Start the worker thread and serve requests until interrupted."""
+        self.worker.start()
+        host, port = self.http_server.server_address[:2]
+        print(f'Serving on http://{host}:{port}')
+        try:
+            self.http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        """Stop accepting requests and stop the worker thread once the queued requests are processed."""
+        self.http_server.server_close()
+        self.requests.put(None)
+
+    def submit(self, title, initial_content='', num_samples=1, num_words=MAX_NUM_WORDS, run_name=None):
+        """Put a request on the queue, wait for its samples to be generated and return them."""
+        request = GenerationRequest(title, initial_content, num_samples, num_words, run_name)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.samples
+
+    def process_requests(self):
+        """Take requests off the queue and generate their samples in batches until a None request is received."""
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            # Wait for other requests up to the end of the window of the first one, or until the batch is full
+            batch = [request]
+            num_samples = request.prompt[2]
+            deadline = request.received + self.batch_window
+            while num_samples < self.max_batch_samples:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:  # Process the batch before stopping
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                num_samples += request.prompt[2]
+
+            self.process_batch(batch)
+
+    def process_batch(self, batch):
+        """Generate the samples of a batch of requests with a single call to each model and notify the requests."""
+        requests_by_model = {}
+        for request in batch:
+            requests_by_model.setdefault(request.run_name, []).append(request)
+        for run_name, requests in requests_by_model.items():
+            try:
+                if run_name is None:
+                    results = self.model.generate_many_as_tuple([request.prompt for request in requests])
+                else:
+                    with self.registry.use_model(run_name) as model:
+                        results = model.generate_many_as_tuple([request.prompt for request in requests])
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+            else:
+                for request, samples in zip(requests, results):
+                    request.samples = samples
+
+        finished = time.monotonic()
+        with self.stats_lock:
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            self.latencies.extend(finished - request.received for request in batch)
+        for request in batch:
+            request.done.set()
+
+    def get_stats(self):
+        """Return a dictionary with the queue depth, request and batch counts, p50/p99 latency in seconds, the stats of
+        the result cache of the model, which are None if it is disabled, and the stats of the registry if there is
+        one."""
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+            num_requests = self.num_requests
+            num_batches = self.num_batches
+        stats = {
+            'queue_depth': self.requests.qsize(),
+            'requests': num_requests,
+            'batches': num_batches,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'cache': self.model.get_cache_stats()
+        }
+        if self.registry is not None:
+            stats['registry'] = self.registry.get_stats()
+        return stats
+
+    def parse_request(self, body):
+        """Parse and validate the JSON body of a generate request and return the arguments of submit.
+        Raise a ValueError with a message for the client if it is invalid."""
+        try:
+            request = json.loads(body)
+        except ValueError:
+            raise ValueError('Request body is not valid JSON.')
+        if not isinstance(request, dict):
+            raise ValueError('Request body must be a JSON object.')
+
+        title = request.get('title')
+        if not isinstance(title, str) or not title.strip():
+            raise ValueError('Title must be a non-blank string.')
+        initial_content = request.get('initial_content') or ''
+        if not isinstance(initial_content, str):
+            raise ValueError('Initial content must be a string.')
+
+        num_samples = request.get('num_samples', 1)
+        if isinstance(num_samples, bool) or not isinstance(num_samples, int) or num_samples < 1:
+            raise ValueError(f'{num_samples} is not a positive int.')
+        num_words = request.get('num_words', MAX_NUM_WORDS)
+        if isinstance(num_words, bool) or not isinstance(num_words, int) or not 0 < num_words <= MAX_NUM_WORDS:
+            raise ValueError(f'Number of words must be a whole number between 1 and {MAX_NUM_WORDS}.')
+        run_name = request.get('run_name')
+        if run_name is not None and (not isinstance(run_name, str) or os.path.basename(run_name) != run_name or
+                                     run_name.strip() in ('', '.', '..')):
+            raise ValueError('Run name must be the name of a folder in the checkpoint folder.')
+        if run_name is not None and self.registry is None:
+            raise ValueError('This server only serves its own model, so run_name cannot be given.')
+
+        return title, initial_content, num_samples, num_words, run_name
+
+    def create_request_handler(self):
+        """Create and return a request handler class that serves requests from this server."""
+        server = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            """This class handles a single HTTP request to the server."""
+
+            def do_GET(self):
+                """Respond with the stats of the server or the metrics of generation."""
+                if self.path == '/stats':
+                    self.send_json(200, server.get_stats())
+                elif self.path == '/metrics':
+                    self.send_text(200, Metrics.get_instance().to_prometheus())
+                else:
+                    self.send_json(404, {'error': f'{self.path} was not found.'})
+
+            def do_POST(self):
+                """Generate samples for the request and respond with them."""
+                if self.path != '/generate':
+                    self.send_json(404, {'error': f'{self.path} was not found.'})
+                    return
+
+                try:
+                    content_length = self.headers.get('Content-Length', '0')
+                    if not content_length.strip().isdigit():
+                        raise ValueError(f'Content-Length must be a non-negative integer, not {content_length!r}.')
+                    arguments = server.parse_request(self.rfile.read(int(content_length)))
+                except ValueError as e:
+                    self.close_connection = True  # A body that was not read would be taken for the next request
+                    self.send_json(400, {'error': str(e)})
+                    return
+
+                try:
+                    samples = server.submit(*arguments)
+                except Exception as e:
+                    self.send_json(500, {'error': str(e)})
+                    return
+                self.send_json(200, {'samples': samples})
+
+            def send_json(self, status, value):
+                """Send a response with the status and the value encoded as JSON."""
+                self.send_body(status, json.dumps(value).encode('utf-8'), 'application/json')
+
+            def send_text(self, status, text):
+                """Send a response with the status and plain text."""
+                self.send_body(status, text.encode('utf-8'), 'text/plain; version=0.0.4')
+
+            def send_body(self, status, body, content_type):
+                """Send a response with the status and a body of the content type."""
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                """Do not log every request to the console."""
+
+        return RequestHandler
@@ -0,0 +1,127 @@
+import json
+import os
+import platform
+import statistics
+import time
+
+# Where the settings tuned for this host are saved by tune and loaded by Gpt2Handler and Generator, and which of its
+# optima they use. 'throughput' has the most tokens per second over many samples, and 'latency' the fewest milliseconds
+# per token of a single sample. Set these before the instances are created.
+TUNING_CONFIG = {
+    'profile_filename': 'tuning_profile.json',
+    'objective': 'throughput'
+}
+OBJECTIVES = ['throughput', 'latency']
+TUNING_TITLE = 'Council approves plan for new bridge'
+TUNING_NUM_WORDS = 32  # The number of words of each sample in the synthetic workload
+TUNING_BATCH_SIZES = [1, 4, 8, 16, 32]
+TUNING_INTER_OP_THREADS = [1, 2]
+TUNING_REPEATS = 2  # The number of times each setting is measured, of which the median is kept
+
+
+def load_profile(objective=None, num_workers=None):
+    """Return the settings tuned for an objective, TUNING_CONFIG['objective'] by default, from the profile file. Return
+    an empty dictionary if there is no profile, or if it was tuned on a host with a different number of cores.
+    If num_workers is given and the objective was tuned for another number of workers, return the threads of the other
+    objective if they were tuned for num_workers, or an empty dictionary otherwise. Its batch size is left out, since
+    it was tuned for another workload."""
+    try:
+        with open(TUNING_CONFIG['profile_filename'], 'r') as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if profile.get('cpu_count') != os.cpu_count():
+        return {}
+    objective = objective or TUNING_CONFIG['objective']
+    if num_workers is None:
+        return profile.get(objective, {})
+    if profile.get(objective, {}).get('num_workers') == num_workers:
+        return profile[objective]
+    for other in OBJECTIVES:
+        if profile.get(other, {}).get('num_workers') == num_workers:
+            return {key: value for key, value in profile[other].items() if key != 'batch_size'}
+    return {}
+
+
+def get_thread_counts(max_threads):
+    """Return the numbers of threads to try up to max_threads: every power of two below it, and max_threads itself."""
+    thread_counts = {max_threads}
+    count = 1
+    while count < max_threads:
+        thread_counts.add(count)
+        count *= 2
+    return sorted(thread_counts)
+
+
+def get_settings(cpu_count, max_workers):
+    """Return the (number of workers, intra-op threads, inter-op threads) settings to try. A single worker tries every
+    number of intra-op threads, and more workers split the cores evenly between them."""
+    settings = []
+    for num_workers in get_thread_counts(min(cpu_count, max_workers)):
+        intra_op_thread_counts = get_thread_counts(cpu_count) if num_workers == 1 else [cpu_count // num_workers]
+        for intra_op_threads in intra_op_thread_counts:
+            settings += [(num_workers, intra_op_threads, inter_op_threads)
+                         for inter_op_threads in TUNING_INTER_OP_THREADS]
+    return settings
+
+
+def measure(pool, batch_size):
+    """Generate batch_size samples on each worker of a pool in a single batch and return the number of tokens generated
+    and the seconds it took."""
+    start = time.perf_counter()
+    results = pool.generate_many([(TUNING_TITLE, '', batch_size * pool.num_workers, TUNING_NUM_WORDS)], batch_size)
+    seconds = time.perf_counter() - start
+    return sum(metadata['tokens_generated'] for sample, metadata in results[0]), seconds
+
+
+def tune(max_workers=None, verbose=True):
+    """Generate a short synthetic workload with every setting of the number of workers, TensorFlow threads and batch
+    size on this host, save the best settings for throughput and for latency to the profile file, and return the
+    profile. Each setting starts its own worker processes, so the model is loaded once for each."""
+    import gpt2handler
+    from worker_pool import WorkerPool
+
+    cpu_count = os.cpu_count() or 1
+    results = []
+    for num_workers, intra_op_threads, inter_op_threads in get_settings(cpu_count, max_workers or cpu_count):
+        pool = WorkerPool(num_workers, intra_op_threads, inter_op_threads)
+        try:
+            measure(pool, 1)  # Warm up the sessions
+            for batch_size in TUNING_BATCH_SIZES:
+                measurements = [measure(pool, batch_size) for _ in range(TUNING_REPEATS)]
+                result = {
+                    'num_workers': num_workers,
+                    'intra_op_threads': intra_op_threads,
+                    'inter_op_threads': inter_op_threads,
+                    'batch_size': batch_size,
+                    'tokens_per_second': statistics.median(tokens / seconds for tokens, seconds in measurements),
+                    # The milliseconds each sample waits for each of its tokens, with every sample decoded at once
+                    'ms_per_token': statistics.median(seconds * 1000 / (tokens / (batch_size * num_workers))
+                                                      for tokens, seconds in measurements)
+                }
+                results.append(result)
+                if verbose:
+                    print(f'workers {num_workers:>2} intra {intra_op_threads:>3} inter {inter_op_threads:>2} '
+                          f'batch {batch_size:>3}: {result["tokens_per_second"]:>8.1f} tokens/s '
+                          f'{result["ms_per_token"]:>8.2f} ms/token')
+        finally:
+            pool.close()
+
+    throughput = max(results, key=lambda r: r['tokens_per_second'])
+    # A single sample is generated by a single worker in a batch of its own, so only the threads matter for latency
+    latency = min((r for r in results if r['num_workers'] == 1 and r['batch_size'] == 1),
+                  key=lambda r: r['ms_per_token'])
+    profile = {
+        'cpu_count': cpu_count,
+        'platform': platform.platform(),
+        'backend': gpt2handler.MODEL_CONFIG['backend'],
+        'precision': gpt2handler.MODEL_CONFIG['precision'],
+        'throughput': {key: throughput[key] for key in ('num_workers', 'intra_op_threads', 'inter_op_threads',
+                                                        'batch_size', 'tokens_per_second')},
+        'latency': {key: latency[key] for key in ('num_workers', 'intra_op_threads', 'inter_op_threads',
+                                                  'ms_per_token')},
+        'results': results
+    }
+    with open(TUNING_CONFIG['profile_filename'], 'w') as f:
+        json.dump(profile, f, indent=2)
+    return profile
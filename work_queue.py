@@ -0,0 +1,242 @@
+import itertools
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+from bulk import ROWS_PER_BATCH, encode_row, read_manifest
+from metrics import Metrics
+from output_sinks import replace_atomically
+
+# The folders of a queue directory. A batch file moves from pending to leased to done as it is claimed and finished,
+# and its results are written to the results folder. Every move is a rename, which is atomic on a local filesystem and
+# on NFS, so exactly one worker succeeds in claiming a batch without any lock.
+PENDING_FOLDER = 'pending'
+LEASED_FOLDER = 'leased'
+DONE_FOLDER = 'done'
+RESULTS_FOLDER = 'results'
+JOB_FILENAME = 'job.json'  # The number of batches and the arguments every batch is generated with
+# A leased batch is renamed to the batch filename, the worker holding it and the time its lease expires in seconds since
+# the epoch, separated by LEASE_SEPARATOR. The clocks of the hosts must agree to well within LEASE_SECONDS.
+LEASE_SEPARATOR = '@'
+LEASE_SECONDS = 300  # How long a lease lasts without being renewed. Leases are renewed every third of this
+POLL_SECONDS = 5  # How long a worker waits before looking again when every remaining batch is leased by another
+RESULTS_EXTENSION = '.jsonl'
+TEMPORARY_EXTENSION = '.tmp'
+
+
+def get_worker_id():
+    """Return an id for this process that is unique across the hosts sharing a queue."""
+    return re.sub('[^A-Za-z0-9_.-]', '_', f'{socket.gethostname()}-{os.getpid()}')
+
+
+def get_lease_filename(batch_filename, worker_id, expires):
+    """Return the filename of a batch leased by a worker until expires."""
+    return LEASE_SEPARATOR.join([batch_filename, worker_id, str(int(expires))])
+
+
+def parse_lease_filename(lease_filename):
+    """Return the batch filename, the worker id and the expiry time of a leased batch."""
+    batch_filename, worker_id, expires = lease_filename.rsplit(LEASE_SEPARATOR, 2)
+    return batch_filename, worker_id, int(expires)
+
+
+def load_job(queue_directory):
+    """Return the job of a queue directory, as a dictionary with the number of batches and the number of samples and
+    words of each sample."""
+    try:
+        with open(os.path.join(queue_directory, JOB_FILENAME), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise Exception(f'\'{queue_directory}\' has no job. Create one with a manifest first.')
+
+
+def create_queue(queue_directory, manifest_filename, num_samples=1, num_words=1023, rows_per_batch=ROWS_PER_BATCH):
+    """Split the rows of a manifest into batches of rows_per_batch rows in the pending folder of a queue directory, for
+    workers on any host to generate with QueueWorker. Return the number of batches."""
+    if os.path.isfile(os.path.join(queue_directory, JOB_FILENAME)):
+        raise Exception(f'\'{queue_directory}\' already has a job.')
+    for folder in (PENDING_FOLDER, LEASED_FOLDER, DONE_FOLDER, RESULTS_FOLDER):
+        os.makedirs(os.path.join(queue_directory, folder), exist_ok=True)
+
+    rows = read_manifest(manifest_filename)
+    num_batches = 0
+    while True:
+        batch = list(itertools.islice(rows, rows_per_batch))
+        if not batch:
+            break
+        # Written outside the pending folder and moved into it once complete, so no worker reads a partial batch
+        batch_filename = f'batch-{num_batches:06d}.json'
+        temporary_filename = os.path.join(queue_directory, batch_filename + TEMPORARY_EXTENSION)
+        with open(temporary_filename, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            json.dump({'rows': batch}, f)
+        os.rename(temporary_filename, os.path.join(queue_directory, PENDING_FOLDER, batch_filename))
+        num_batches += 1
+
+    # The job file is written last, so that workers only start once every batch is in place
+    replace_atomically(os.path.join(queue_directory, JOB_FILENAME), lambda f: f.write(json.dumps({
+        'batches': num_batches,
+        'num_samples': num_samples,
+        'num_words': num_words
+    }).encode('utf-8')))
+    return num_batches
+
+
+def get_queue_status(queue_directory):
+    """Return a dictionary with the number of batches of a queue that are pending, leased, leased past their expiry,
+    and done, and the total number of batches."""
+    now = time.time()
+    leases = [parse_lease_filename(name) for name in os.listdir(os.path.join(queue_directory, LEASED_FOLDER))]
+    return {
+        'pending': len(os.listdir(os.path.join(queue_directory, PENDING_FOLDER))),
+        'leased': len(leases),
+        'expired': sum(1 for _, _, expires in leases if expires < now),
+        'done': len(os.listdir(os.path.join(queue_directory, DONE_FOLDER))),
+        'batches': load_job(queue_directory)['batches']
+    }
+
+
+def collect_results(queue_directory, output_filename):
+    """Write the results of every batch of a finished queue to an output file in the order of the manifest, with one
+    JSON object per row like bulk.generate_from_manifest. Return the number of rows written."""
+    status = get_queue_status(queue_directory)
+    if status['done'] < status['batches']:
+        raise Exception(f'The queue in \'{queue_directory}\' is not finished: {status["done"]} of {status["batches"]} '
+                        f'batches are done, {status["leased"]} are leased and {status["pending"]} are pending.')
+
+    num_rows = 0
+
+    def write(output):
+        nonlocal num_rows
+        for batch_index in range(status['batches']):
+            with open(os.path.join(queue_directory, RESULTS_FOLDER, f'batch-{batch_index:06d}{RESULTS_EXTENSION}'),
+                      'rb') as f:
+                for line in f:
+                    output.write(line)
+                    num_rows += 1
+
+    replace_atomically(output_filename, write)
+    return num_rows
+
+
+class QueueWorker:
+    """This class generates the batches of a queue in a shared directory alongside workers on other hosts.
+    A worker claims a batch by renaming it from the pending folder into the leased folder under a lease filename with
+    its id and the time the lease expires. Only one worker's rename can succeed, so no locks are needed. While it
+    generates, a background thread renews the lease by renaming it with a later expiry. If the worker dies, its lease is
+    not renewed, and once it expires any worker can claim it the same way and generate the batch again.
+    The results of a batch are written under a temporary name and renamed into the results folder, and then the batch
+    is moved to the done folder. A worker that finds its lease was taken over stops generating the batch. If it had
+    already written the results, the batch is generated again and its results replaced, so every row is written
+    exactly once."""
+
+    def __init__(self, queue_directory, model, worker_id=None, lease_seconds=LEASE_SECONDS):
+        """Initialise a worker for a queue directory that generates with a model with the generate_many method of
+        Gpt2Handler."""
+        self.queue_directory = queue_directory
+        self.model = model
+        self.worker_id = worker_id or get_worker_id()
+        self.lease_seconds = lease_seconds
+        self.job = load_job(queue_directory)
+        self.lease = None  # The filename of the batch this worker holds, renamed whenever the lease is renewed
+        self.lease_lock = threading.Lock()
+
+    def get_path(self, folder, filename):
+        """Return the path of a file in a folder of the queue."""
+        return os.path.join(self.queue_directory, folder, filename)
+
+    def run(self):
+        """Claim and generate batches until every batch of the queue is done. Return the number of batches this worker
+        generated."""
+        num_batches = 0
+        while True:
+            lease = self.claim()
+            if lease is not None:
+                num_batches += self.process(lease)
+            elif len(os.listdir(os.path.join(self.queue_directory, DONE_FOLDER))) >= self.job['batches']:
+                return num_batches
+            else:
+                time.sleep(POLL_SECONDS)  # Wait for the other workers to finish their batches or for a lease to expire
+
+    def claim(self):
+        """Lease a pending batch, or a batch whose lease has expired, and return its lease filename. Return None if
+        there is none."""
+        expires = time.time() + self.lease_seconds
+        for batch_filename in sorted(os.listdir(os.path.join(self.queue_directory, PENDING_FOLDER))):
+            lease = get_lease_filename(batch_filename, self.worker_id, expires)
+            try:
+                os.rename(self.get_path(PENDING_FOLDER, batch_filename), self.get_path(LEASED_FOLDER, lease))
+                return lease
+            except FileNotFoundError:  # Another worker claimed it first
+                continue
+
+        now = time.time()
+        for old_lease in sorted(os.listdir(os.path.join(self.queue_directory, LEASED_FOLDER))):
+            batch_filename, _, old_expires = parse_lease_filename(old_lease)
+            if old_expires >= now:
+                continue
+            lease = get_lease_filename(batch_filename, self.worker_id, expires)
+            try:
+                os.rename(self.get_path(LEASED_FOLDER, old_lease), self.get_path(LEASED_FOLDER, lease))
+                return lease
+            except FileNotFoundError:  # Renewed, finished or claimed by another worker in the meantime
+                continue
+        return None
+
+    def renew_lease(self, stop, lost):
+        """Renew the lease of this worker every third of the lease until stop is set. Set lost and return if another
+        worker has taken the batch over."""
+        while not stop.wait(self.lease_seconds / 3):
+            with self.lease_lock:
+                batch_filename, _, _ = parse_lease_filename(self.lease)
+                lease = get_lease_filename(batch_filename, self.worker_id, time.time() + self.lease_seconds)
+                try:
+                    os.rename(self.get_path(LEASED_FOLDER, self.lease), self.get_path(LEASED_FOLDER, lease))
+                except FileNotFoundError:
+                    lost.set()
+                    return
+                self.lease = lease
+
+    def process(self, lease):
+        """Generate the batch of a lease, write its results and mark it done. Return 1 if this worker finished the
+        batch and 0 if its lease was taken over first."""
+        self.lease = lease
+        batch_filename, _, _ = parse_lease_filename(lease)
+        try:
+            with open(self.get_path(LEASED_FOLDER, lease), 'r', encoding='utf-8', errors='surrogateescape') as f:
+                rows = json.load(f)['rows']
+        except FileNotFoundError:  # Taken over before it could be read
+            return 0
+
+        stop, lost = threading.Event(), threading.Event()
+        renewer = threading.Thread(target=self.renew_lease, args=(stop, lost), daemon=True)
+        renewer.start()
+        try:
+            results = self.model.generate_many([(title, initial_content, self.job['num_samples'],
+                                                 self.job['num_words']) for title, initial_content in rows],
+                                               as_tuple=True, stop=lost)
+        finally:
+            stop.set()
+            renewer.join()
+        if results is None or lost.is_set():
+            return 0
+
+        results_filename = os.path.splitext(batch_filename)[0] + RESULTS_EXTENSION
+        with Metrics.get_instance().time('file_write'):
+            # The temporary name includes the worker, so that two workers writing the same batch never share a file
+            temporary_filename = self.get_path(RESULTS_FOLDER,
+                                               results_filename + '.' + self.worker_id + TEMPORARY_EXTENSION)
+            with open(temporary_filename, 'wb') as f:
+                f.writelines(encode_row(title, initial_content, samples)
+                             for (title, initial_content), samples in zip(rows, results))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary_filename, self.get_path(RESULTS_FOLDER, results_filename))
+
+        try:
+            os.rename(self.get_path(LEASED_FOLDER, self.lease), self.get_path(DONE_FOLDER, batch_filename))
+        except FileNotFoundError:  # Taken over after the results were written. The new holder replaces them.
+            return 0
+        return 1
@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+
+import gpt2handler
+import tuning
+from gpt2handler import Gpt2Handler
+
+
+def initialise_worker(num_workers, intra_op_threads, inter_op_threads, model_config, default_config, best_of_config,
+                      cache_config, tuning_config):
+    """Configure the TensorFlow threads of a worker process, copy the settings of the parent into it, and load its own
+    instance of Gpt2Handler. The workers are spawned rather than forked, so they would otherwise start from the
+    defaults."""
+    gpt2handler.SESSION_CONFIG['intra_op_threads'] = intra_op_threads
+    gpt2handler.SESSION_CONFIG['inter_op_threads'] = inter_op_threads
+    gpt2handler.SESSION_CONFIG['num_workers'] = num_workers
+    gpt2handler.MODEL_CONFIG.update(model_config)
+    gpt2handler.DEFAULT_CONFIG.clear()  # Arguments such as the seed that are unset in the parent must be unset here
+    gpt2handler.DEFAULT_CONFIG.update(default_config)
+    gpt2handler.BEST_OF_CONFIG.update(best_of_config)
+    gpt2handler.CACHE_CONFIG.update(cache_config)
+    tuning.TUNING_CONFIG.update(tuning_config)
+    Gpt2Handler.get_instance()
+
+
+def generate_shard(shard_index, prompts, batch_size, as_tuple, score, num_best):
+    """Generate the samples of a shard of prompts in a worker process with generate_many. Each shard uses its own
+    seed stream, so that pieces of the same prompt in different shards do not repeat samples when a seed is set."""
+    return Gpt2Handler.get_instance().generate_many(prompts, batch_size, seed_stream=shard_index, as_tuple=as_tuple,
+                                                    score=score, num_best=num_best)
+
+
+def shard_prompts(prompts, num_shards):
+    """Split prompts into at most num_shards shards with as close to the same number of samples as possible.
+    The samples of a prompt are split across shards if needed. Return the shards, each a list of prompts, and for each
+    shard the index of the prompt each of its prompts came from."""
+    total_samples = sum(prompt[2] for prompt in prompts)
+    samples_per_shard = max(1, -(-total_samples // num_shards))  # Ceiling division
+
+    shards, prompt_indices = [[]], [[]]
+    shard_samples = 0
+    for prompt_index, (title, initial_content, num_samples, num_words) in enumerate(prompts):
+        while num_samples > 0:
+            if shard_samples == samples_per_shard:
+                shards.append([])
+                prompt_indices.append([])
+                shard_samples = 0
+            piece = min(num_samples, samples_per_shard - shard_samples)
+            shards[-1].append((title, initial_content, piece, num_words))
+            prompt_indices[-1].append(prompt_index)
+            shard_samples += piece
+            num_samples -= piece
+
+    return shards, prompt_indices
+
+
+class WorkerPool:
+    """This class runs generation across several worker processes, each holding its own Gpt2Handler session.
+    Prompts are sharded across the workers and the results are merged back in order, so that it can be used in place
+    of Gpt2Handler for generate_many and generate_many_as_tuple."""
+
+    def __init__(self, num_workers, intra_op_threads=None, inter_op_threads=1):
+        """Start num_workers worker processes and load the model in each of them. By default the cores of the host are
+        split evenly between the workers."""
+        if intra_op_threads is None:
+            intra_op_threads = max(1, (os.cpu_count() or 1) // num_workers)
+        self.num_workers = num_workers
+        # TensorFlow is not safe to use after a fork, so the workers are started as new processes
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(num_workers, initializer=initialise_worker,
+                                 initargs=(num_workers, intra_op_threads, inter_op_threads,
+                                           dict(gpt2handler.MODEL_CONFIG), dict(gpt2handler.DEFAULT_CONFIG),
+                                           dict(gpt2handler.BEST_OF_CONFIG), dict(gpt2handler.CACHE_CONFIG),
+                                           dict(tuning.TUNING_CONFIG)))
+
+    def generate_many(self, prompts, batch_size=None, as_tuple=False, stop=None, on_sample=None, score=False,
+                      num_best=None):
+        """Generate samples for several prompts across the workers and return them like Gpt2Handler.generate_many.
+        The workers cannot be stopped once they have their shards, so stop is only checked before they are sent, and
+        on_sample is called for each sample once every shard is finished. If num_best is given, each shard returns its
+        best samples of each prompt, which are ranked again together."""
+        if stop is not None and stop.is_set():
+            return None
+        shards, prompt_indices = shard_prompts(prompts, self.num_workers)
+        shard_arguments = [(shard_index, shard, batch_size, as_tuple, score, num_best)
+                           for shard_index, shard in enumerate(shards)]
+        shard_results = self.pool.starmap(generate_shard, shard_arguments)
+        results = [[] for _ in prompts]
+        for samples_per_prompt, shard_prompt_indices in zip(shard_results, prompt_indices):
+            for prompt_index, samples in zip(shard_prompt_indices, samples_per_prompt):
+                results[prompt_index].extend(samples)
+        if num_best is not None:
+            results = [Gpt2Handler.rank_samples(samples)[:num_best] for samples in results]
+        if on_sample is not None:
+            for prompt_index, samples in enumerate(results):
+                for sample_index, (sample, metadata) in enumerate(samples):
+                    on_sample(prompt_index, sample_index, sample, metadata)
+        return results
+
+    def generate_many_as_tuple(self, prompts, batch_size=None, stop=None):
+        """Generate samples for several prompts across the workers and return them like
+        Gpt2Handler.generate_many_as_tuple."""
+        results = self.generate_many(prompts, batch_size, as_tuple=True, stop=stop)
+        if results is None:
+            return None
+        return [[sample for sample, metadata in samples] for samples in results]
+
+    @staticmethod
+    def sample_to_tuple(sample):
+        """Take a sample and return a list where the first value is the title and the second value is the content."""
+        return Gpt2Handler.sample_to_tuple(sample)
+
+    def close(self):
+        """Stop the worker processes once they have finished their work."""
+        self.pool.close()
+        self.pool.join()